@@ -27,6 +27,28 @@ export default {
         }
     },
 
+    /**
+     * Action to fetch the precomputed related multimedia posts of a multimedia post from the database.
+     * @param {*} param0 destructuring of vuex context object
+     * @param {*} mid id of the multimedia post whose related posts are being fetched
+     */
+    async getRelatedMultimedias({ commit, dispatch }, mid) {
+        try {
+            const response = await this.$axios.get('multimedia/' + mid + '/related')
+            commit("SET_RELATED_MULTIMEDIAS", response.data.Multimedias)
+
+        } catch (error) {
+            if (!!error.response.data) {
+                dispatch('notifications/setSnackbar', { text: error.response.data.Error, color: 'error' }, { root: true })
+                return 'error'
+
+            }else{
+                dispatch('notifications/setSnackbar', {text: error.message, color: 'error'}, {root: true})
+
+            } 
+        }
+    },
+
     /**
      * Action to fetch multimedia posts by their author dashboard user id from the database.
      * @param {*} param0 destructuring of vuex context object
@@ -71,6 +93,28 @@ export default {
         }
     },
 
+    /**
+     * Action to fetch the multimedia posts published in a given month from the database.
+     * @param {*} param0 destructuring of vuex context object
+     * @param {*} param1 destructuring of the year and month of the multimedia posts being fetched
+     */
+    async getMultimediasByMonth({ commit, dispatch }, { year, month }) {
+        try {
+            const response = await this.$axios.get('multimedia/archive/' + year + '/' + month)
+            commit("SET_MULTIMEDIAS", response.data.Multimedias)
+
+        } catch (error) {
+            if (!!error.response.data) {
+                dispatch('notifications/setSnackbar', { text: error.response.data.Error, color: 'error' }, { root: true })
+                return 'error'
+
+            }else{
+                dispatch('notifications/setSnackbar', {text: error.message, color: 'error'}, {root: true})
+
+            } 
+        }
+    },
+
     /**
      * Action to add a new multimedia post to the system given the information
      * in the multimedia post creation form
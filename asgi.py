@@ -0,0 +1,159 @@
+"""
+Asynchronous ASGI app serving the public multimedia read routes.
+
+The routes answer like their Flask counterparts in main.py, with the same bodies, statuses and cache
+headers, but run on an event loop over an asyncpg pool, so a client waiting on the database only costs
+a coroutine and a single worker holds thousands of concurrent slow clients. The rest of the API keeps
+being served by the Flask app, and a reverse proxy sends the public GET routes of /multimedia here.
+
+Every statement is limited to ASYNC_STATEMENT_TIMEOUT milliseconds, 2000 by default, and a request
+whose statement timed out is answered with a 503 and a Retry-After header. The circuit breakers and
+load shedding of the Flask app do not apply here: the asyncpg pool bounds the connections, and waiting
+requests only cost a coroutine.
+
+With DB_REPLICAS set, every replica gets its own asyncpg pool and the reads are spread over the healthy
+replicas exactly as the Flask app spreads its readReplica() routes, clients reading their own writes
+from the primary.
+
+Run with:
+    uvicorn asgi:app --workers 1 --loop uvloop
+"""
+import asyncpg
+import contextlib
+import datetime
+import decimal
+import functools
+import json
+import logging
+import os
+import uuid
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route
+from werkzeug.http import http_date
+from handler.async_multimedia import AsyncMultimediaHandler
+from handler.dao.async_multimedia_dao import createMultimediaPool
+from handler.dao.config.sqlconfig import db_config
+from handler.dao.read_replicas import readsOwnWrites, replicaRouter
+
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+#Seconds clients are asked to wait before retrying a request whose statement timed out
+TIMEOUT_RETRY_AFTER = int(os.getenv('DB_TIMEOUT_RETRY_AFTER', '5'))
+
+
+def _default(value):
+    #Same encoding as the default JSON provider of Flask, so both apps return identical bodies
+    if isinstance(value, datetime.date):
+        return http_date(value)
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def respond(result):
+    """
+    Summary:
+        Converts the body, status and optional headers returned by an AsyncMultimediaHandler into a response.
+    """
+    body, status = result[0], result[1]
+    headers = result[2] if len(result) > 2 else None
+    if body is None:
+        return Response(status_code = status, headers = headers)
+    return Response(json.dumps(body, default = _default, sort_keys = True, separators = (',', ':')) + '\n',
+                    status_code = status, headers = headers, media_type = 'application/json')
+
+
+def _timedOut():
+    return Response(json.dumps({'Error': "La base de datos tardó demasiado en responder, intente nuevamente."},
+                               sort_keys = True, separators = (',', ':')) + '\n',
+                    status_code = 503, headers = {'Retry-After': str(TIMEOUT_RETRY_AFTER)}, media_type = 'application/json')
+
+
+def budgeted(route):
+    """
+    Summary:
+        Answers with a 503 and a Retry-After header the requests of the route whose statement was canceled by
+        the statement timeout, as the Flask app does.
+    """
+    @functools.wraps(route)
+    async def wrapper(request):
+        try:
+            return await route(request)
+        except asyncpg.QueryCanceledError:
+            logger.warning("%s %s canceled a statement over its statement timeout", request.method, request.url.path)
+            return _timedOut()
+    return wrapper
+
+
+def _primaryDsn():
+    return "dbname={} user={} password={} host={} ".format(
+        db_config['database'], db_config['username'], db_config['password'], db_config['host'])
+
+
+def _pool(request):
+    #Reads go to a healthy replica, as the readReplica() routes of the Flask app, unless the client must
+    #read its own writes
+    pools = request.app.state.replicaPools
+    if pools and not readsOwnWrites(request.headers, request.cookies):
+        replica = replicaRouter.choose(_primaryDsn())
+        if replica is not None:
+            return pools[replica]
+    return request.app.state.pool
+
+
+def _handler(request):
+    return AsyncMultimediaHandler(_pool(request))
+
+
+@budgeted
+async def getAllMultimedia(request):
+    return respond(await _handler(request).getAllMultimedia())
+
+
+@budgeted
+async def getMultimediaByID(request):
+    return respond(await _handler(request).getMultimediaByID(request.path_params['mid']))
+
+
+@budgeted
+async def getRelatedMultimedia(request):
+    return respond(await _handler(request).getRelatedMultimedia(request.path_params['mid']))
+
+
+@budgeted
+async def getMultimediaArchive(request):
+    return respond(await _handler(request).getMultimediaArchive(request.path_params['year'], request.path_params['month'],
+                                                                   request.headers.get('If-None-Match')))
+
+
+@budgeted
+async def getMultimediaByType(request):
+    return respond(await _handler(request).getMultimediaByType(request.path_params['mType']))
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    app.state.pool = await createMultimediaPool()
+    app.state.replicaPools = {replica: await createMultimediaPool(replica.host, replica.port)
+                              for replica in replicaRouter.replicas}
+    try:
+        yield
+    finally:
+        for pool in app.state.replicaPools.values():
+            await pool.close()
+        await app.state.pool.close()
+
+
+app = Starlette(routes = [
+    Route('/multimedia', getAllMultimedia, methods = ['GET']),
+    Route('/multimedia/{mid:int}', getMultimediaByID, methods = ['GET']),
+    Route('/multimedia/{mid:int}/related', getRelatedMultimedia, methods = ['GET']),
+    Route('/multimedia/archive/{year:int}/{month:int}', getMultimediaArchive, methods = ['GET']),
+    Route('/multimedia/{mType}', getMultimediaByType, methods = ['GET']),
+], lifespan = lifespan)
@@ -0,0 +1,75 @@
+from .dao.async_multimedia_dao import AsyncMultimediaDAO
+from .multimedia import MultimediaHandler
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMultimediaHandler(MultimediaHandler):
+    """
+    Asynchronous variants of the public read methods of MultimediaHandler, served by the ASGI app. They
+    share its validations and results, and return the body, status and headers of the response instead
+    of a Flask response, as there is no Flask app context to jsonify in.
+    """
+
+    def __init__(self, pool):
+        self.dao = AsyncMultimediaDAO(pool)
+
+    async def getAllMultimedia(self):
+        """
+        Summary:
+            Gets a list of all multimedia posts that are valid in the database and maps the result to a
+            dictionary containing all the valid multimedia posts and their information.
+        """
+
+        return self._allMultimediaResult(await self.dao.getAllMultimedia())
+
+    async def getMultimediaByID(self, mID):
+        """
+        Summary:
+            Gets a single multimedia post specified by the given multimedia post id that is valid in the
+            database and maps the result to a dictionary containing its information.
+        """
+
+        invalid = self._validateMultimediaID(mID)
+        if invalid is not None:
+            return invalid
+        return self._multimediaByIDResult(mID, await self.dao.getMultimediaByID(mID))
+
+    async def getRelatedMultimedia(self, mID):
+        """
+        Summary:
+            Gets the list of precomputed related multimedia posts of the multimedia post with the given id
+            that are valid in the database and maps the result to a dictionary containing their information.
+        """
+
+        invalid = self._validateMultimediaID(mID)
+        if invalid is not None:
+            return invalid
+        return self._relatedMultimediaResult(mID, await self.dao.getRelatedMultimedia(mID))
+
+    async def getMultimediaByType(self, mType):
+        """
+        Summary:
+            Gets a list of multimedia posts specified by the given multimedia type that are valid in the
+            database and maps the result to a dictionary containing its information.
+        """
+
+        invalid = self._validateMultimediaType(mType)
+        if invalid is not None:
+            return invalid
+        return self._multimediaByTypeResult(await self.dao.getMultimediaByType(mType))
+
+    async def getMultimediaArchive(self, year, month, ifNoneMatch = None):
+        """
+        Summary:
+            Gets a list of multimedia posts published in the given month that are valid in the database and
+            maps the result to a dictionary containing their information, with the cache headers of the month,
+            or an empty 304 if it still matches the ETag in ifNoneMatch.
+        """
+
+        archiveMonth = self._archiveMonth(year, month)
+        if archiveMonth is None:
+            return self._invalidMonth()
+        start, end, headers = archiveMonth
+        return self._multimediaArchiveResult(await self.dao.getMultimediaByMonth(start, end), headers, ifNoneMatch)
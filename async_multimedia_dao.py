@@ -0,0 +1,192 @@
+from .config.sqlconfig import db_config
+import asyncpg
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+#Time limit in milliseconds of every statement of the asynchronous read API, as the time budgets of the
+#public read routes of the Flask app
+STATEMENT_TIMEOUT = int(os.getenv('ASYNC_STATEMENT_TIMEOUT', '2000'))
+
+
+async def createMultimediaPool(host = None, port = None):
+    """
+    Summary:
+        Opens the asyncpg connection pool used by the asynchronous read API. asyncpg prepares and caches
+        the statements of every pooled connection by itself, and every statement is limited to
+        ASYNC_STATEMENT_TIMEOUT milliseconds.
+
+    Params:
+        host: the host of a read replica, the configured primary database if not given.
+        port: the port of the read replica.
+
+    Returns:
+        The asyncpg pool, holding up to ASYNC_DB_POOL_SIZE connections, 20 by default.
+    """
+    return await asyncpg.create_pool(
+        database = db_config['database'],
+        user = db_config['username'],
+        password = db_config['password'],
+        host = host or db_config['host'],
+        port = port,
+        #A replica that is down when the app starts must not keep it from starting
+        min_size = 1 if host is None else 0,
+        max_size = int(os.getenv('ASYNC_DB_POOL_SIZE', '20')),
+        server_settings = {'statement_timeout': str(STATEMENT_TIMEOUT)},
+    )
+
+
+class AsyncMultimediaDAO:
+    """
+    Read methods of MultimediaDAO over an asyncpg pool. Every method borrows a pooled connection only for
+    its own statement, so waiting clients do not hold connections.
+
+    Statements canceled by the statement timeout raise QueryCanceledError instead of returning an error,
+    so the app answers them with a 503.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def getAllMultimedia(self):
+        """
+        Summary:
+            Returns a list of all multimedia posts that are valid in the database with their corresponding information.
+
+        Returns:
+            A list containing all the valid multimedia posts with their information.
+        """
+
+        query = """select mid, title, content, type, date_published
+                   from multimedia
+                   where is_invalid = false
+                """
+
+        try:
+            return await self.pool.fetch(query)
+        except asyncpg.QueryCanceledError:
+            raise
+        except asyncpg.PostgresError:
+            logger.exception("Error in AsyncMultimediaDAO.getAllMultimedia")
+            return "Ocurrió un error interno buscando todas las publicaciones multimedia."
+
+    async def getMultimediaByID(self, mID):
+        """
+        Summary:
+            Returns a single multimedia post that is valid in the database with their corresponding information
+            with the given multimedia post id.
+
+        Params:
+            mID: the id of the multimedia post id to be fetched.
+
+        Returns:
+            A record containing all the information of the valid multimedia post, or None if there is none.
+        """
+
+        query = """select mid, title, content, type, date_published
+                   from multimedia
+                   where mid = $1
+                   and is_invalid = false
+                """
+
+        try:
+            return await self.pool.fetchrow(query, mID)
+        except asyncpg.QueryCanceledError:
+            raise
+        except asyncpg.PostgresError:
+            logger.exception("Error in AsyncMultimediaDAO.getMultimediaByID")
+            return "Ocurrió un error interno buscando una publicación multimedia por su identificador."
+
+    async def getMultimediaByType(self, mType):
+        """
+        Summary:
+            Returns a list of multimedia posts that are valid in the database with their corresponding information
+            and are of the given type.
+
+        Params:
+            mType: the type of the multimedia posts to be fetched.
+
+        Returns:
+            A list containing all the valid multimedia posts with their information and are of the given type.
+        """
+
+        query = """select mid, title, content, type, date_published
+                   from multimedia
+                   where type = $1
+                   and is_invalid = false
+                """
+
+        try:
+            return await self.pool.fetch(query, mType)
+        except asyncpg.QueryCanceledError:
+            raise
+        except asyncpg.PostgresError:
+            logger.exception("Error in AsyncMultimediaDAO.getMultimediaByType")
+            return "Occurrió un error interno buscando publicaciones del tipo de multimedia dado."
+
+    async def getMultimediaByMonth(self, start, end):
+        """
+        Summary:
+            Returns a list of multimedia posts that are valid in the database with their corresponding information
+            and were published between the given dates.
+
+        Params:
+            start: the first date of the month, inclusive.
+            end: the first date of the following month, exclusive.
+
+        Returns:
+            A list containing all the valid multimedia posts with their information published in the given month.
+        """
+
+        query = """select mid, title, content, type, date_published
+                   from multimedia
+                   where date_published >= $1
+                   and date_published < $2
+                   and is_invalid = false
+                   order by date_published
+                """
+
+        try:
+            return await self.pool.fetch(query, start, end)
+        except asyncpg.QueryCanceledError:
+            raise
+        except asyncpg.PostgresError:
+            logger.exception("Error in AsyncMultimediaDAO.getMultimediaByMonth")
+            return "Ocurrió un error interno buscando las publicaciones multimedia del mes dado."
+
+    async def getRelatedMultimedia(self, mID):
+        """
+        Summary:
+            Returns the list of precomputed related multimedia posts of the multimedia post with the given id that
+            are valid in the database, checking the existence of the multimedia post in the same statement.
+
+        Params:
+            mID: the id of the multimedia post whose related posts are fetched.
+
+        Returns:
+            None if there is no valid multimedia post with the given id, otherwise a list containing its valid
+            related multimedia posts with their information.
+        """
+
+        #The valid post always yields a row, with nulls when it has no valid related posts
+        query = """select M.mid, M.title, M.content, M.type, M.date_published
+                   from multimedia as P
+                   left join multimedia_related as R on R.mid = P.mid
+                   left join multimedia as M on M.mid = R.related_mid and M.is_invalid = false
+                   where P.mid = $1
+                   and P.is_invalid = false
+                   order by R.rank
+                """
+
+        try:
+            rows = await self.pool.fetch(query, mID)
+            if not rows:
+                return None
+            return [row for row in rows if row['mid'] is not None]
+        except asyncpg.QueryCanceledError:
+            raise
+        except asyncpg.PostgresError:
+            logger.exception("Error in AsyncMultimediaDAO.getRelatedMultimedia")
+            return "Ocurrió un error interno buscando las publicaciones multimedia relacionadas."
@@ -0,0 +1,188 @@
+"""
+Benchmark of the concurrent connection capacity of the threaded and gevent serving modes.
+
+Starts the app in a child process under each serving mode, with the in-memory DAOs waiting --db-latency
+milliseconds per call as a stand-in for the database round trips, which the gevent mode turns into
+cooperative waits like the psycopg2 wait callback does. Then holds increasing amounts of concurrent
+clients against GET /multimedia/<mid> for --duration seconds, each client sending its next request as
+soon as the previous one is answered, and reports the requests per second, errors and latencies of each
+level. The threaded server is bound by its worker threads, the gevent server only by the latency.
+
+Usage:
+    python bench_concurrency.py --levels 50,200,1000,2000 --threads 32 --db-latency 50
+    python bench_concurrency.py --modes gevent --levels 5000 --connections 10000
+"""
+import argparse
+import asyncio
+import functools
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+from bench_multimedia import percentile
+from replay_load import _asyncRequest, _freePort, _waitForServer
+
+
+def serve(args):
+    """
+    Summary:
+        Serves the app with the slowed down in-memory DAOs in the given mode, until killed. Runs in the
+        child process, which for the gevent mode is started through gevent.monkey so the standard library
+        is patched before anything else is imported.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from werkzeug.serving import BaseWSGIServer
+    from handler.dao.in_memory_dao import InMemoryStore, InMemoryMultimediaDAO, InMemoryUserDAO, generateMultimediaFixtures
+    from handler.multimedia import MultimediaHandler
+    from handler.multimedia_duplicates import duplicateIndex
+
+    latency = args.db_latency / 1000
+
+    def slowed(method):
+        @functools.wraps(method)
+        def wrapper(*methodArgs, **methodKwargs):
+            time.sleep(latency)
+            return method(*methodArgs, **methodKwargs)
+        return wrapper
+
+    class SlowInMemoryMultimediaDAO(InMemoryMultimediaDAO):
+        pass
+
+    for name, method in vars(InMemoryMultimediaDAO).items():
+        if callable(method) and not name.startswith('_'):
+            setattr(SlowInMemoryMultimediaDAO, name, slowed(method))
+
+    SlowInMemoryMultimediaDAO.store = InMemoryUserDAO.store = generateMultimediaFixtures(InMemoryStore(), args.size)
+    MultimediaHandler.multimediaDAO = SlowInMemoryMultimediaDAO
+    MultimediaHandler.userDAO = InMemoryUserDAO
+    duplicateIndex.multimediaDAO = SlowInMemoryMultimediaDAO
+
+    import main
+
+    if args.serve == 'gevent':
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('127.0.0.1', args.port), main.app, spawn = Pool(args.connections), log = None).serve_forever()
+        return
+
+    class PooledWSGIServer(BaseWSGIServer):
+        """
+        WSGI server handling each connection in a fixed pool of threads, like a threaded production server.
+        """
+
+        def __init__(self, host, port, app, threads):
+            super().__init__(host, port, app)
+            self.executor = ThreadPoolExecutor(max_workers = threads)
+
+        def process_request(self, request, client_address):
+            self.executor.submit(self._handle, request, client_address)
+
+        def _handle(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    server = PooledWSGIServer('127.0.0.1', args.port, main.app, args.threads)
+    server.request_queue_size = 4096
+    server.serve_forever()
+
+
+def measure(port, clients, duration, mIDs, seed):
+    """
+    Summary:
+        Keeps the given amount of clients sending requests for the given seconds.
+
+    Returns:
+        A dictionary with the requests per second, errors and p50 and p99 latencies in milliseconds.
+    """
+    latencies = []
+    errors = 0
+
+    async def client(generator, deadline):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            path = '/multimedia/{}'.format(generator.choice(mIDs))
+            start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(_asyncRequest('127.0.0.1', port, 'GET', path, {}, None), 30)
+            except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+                status = 599
+            latencies.append(time.perf_counter() - start)
+            if status >= 500:
+                errors += 1
+
+    async def run():
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(client(random.Random(seed + index), deadline) for index in range(clients)))
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def runBenchmark(args):
+    """
+    Summary:
+        Runs every concurrency level against every serving mode and returns the results keyed by
+        "<mode>/<clients>".
+    """
+    #Thousands of concurrent clients need as many file descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    #The fixtures number their posts from 1
+    mIDs = list(range(1, args.size + 1))
+    results = {}
+    for mode in args.modes:
+        port = _freePort()
+        command = [sys.executable] + (['-m', 'gevent.monkey'] if mode == 'gevent' else []) + [
+            __file__, '--serve', mode, '--port', str(port), '--size', str(args.size), '--threads', str(args.threads),
+            '--connections', str(args.connections), '--db-latency', str(args.db_latency)]
+        process = subprocess.Popen(command)
+        try:
+            _waitForServer(port, process)
+            for clients in args.levels:
+                results['{}/{}'.format(mode, clients)] = measure(port, clients, args.duration, mIDs, args.random_seed)
+        finally:
+            process.kill()
+            process.wait()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmarks the concurrent connections of the serving modes.")
+    parser.add_argument('--modes', type = lambda value: value.split(','), default = ['threaded', 'gevent'])
+    parser.add_argument('--levels', type = lambda value: [int(level) for level in value.split(',')], default = [50, 200, 1000, 2000])
+    parser.add_argument('--duration', type = float, default = 10.0, help = "seconds measured per level")
+    parser.add_argument('--threads', type = int, default = 32, help = "worker threads of the threaded server")
+    parser.add_argument('--connections', type = int, default = 10000, help = "greenlets of the gevent server")
+    parser.add_argument('--db-latency', type = float, default = 50.0, help = "milliseconds waited per DAO call")
+    parser.add_argument('--size', type = int, default = 10000, help = "multimedia posts of the dataset")
+    parser.add_argument('--random-seed', type = int, default = 1)
+    parser.add_argument('--serve', choices = ('threaded', 'gevent'), help = argparse.SUPPRESS)
+    parser.add_argument('--port', type = int, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        sys.exit(0)
+
+    results = runBenchmark(args)
+    print("{:<20} {:>10} {:>8} {:>10} {:>10} {:>10}".format('mode/clients', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+    for key, result in results.items():
+        print("{:<20} {:>10} {:>8} {:>10} {:>10} {:>10}".format(
+            key, result['requests'], result['errors'], result['rps'], result['p50_ms'], result['p99_ms']))
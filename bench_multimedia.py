@@ -0,0 +1,390 @@
+"""
+Benchmark of the multimedia routes.
+
+Drives every /multimedia route through the Flask test client or through a real WSGI server, against
+the in-memory DAOs or a seeded local Postgres, at several dataset sizes. Reports the p50, p95 and p99
+latencies and the requests per second of each route, and compares them against a stored baseline.
+
+Usage:
+    python bench_multimedia.py --backend memory --sizes 1000,10000,100000 --save-baseline baseline.json
+    python bench_multimedia.py --backend memory --client server --baseline baseline.json
+    python bench_multimedia.py --backend postgres --seed --sizes 10000 --token "Bearer ..."
+    python bench_multimedia.py --client server --url http://127.0.0.1:8000 --sizes 10000
+
+Without --token the token check and session lookup are bypassed, so only the multimedia handling is
+measured. The exit status is 1 when a route regresses against the baseline by more than the tolerance.
+
+Heavy routes get fewer requests on large datasets, but never less than --min-requests, 100 by default,
+so their p99 is not just their slowest request. With --url the requests use the multimedia post and
+author ids of the target server, read from it before measuring.
+"""
+import argparse
+import datetime
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from handler.dao.in_memory_dao import InMemoryStore, InMemoryMultimediaDAO, InMemoryUserDAO, generateMultimediaFixtures
+from handler.multimedia_duplicates import duplicateIndex
+
+#Routes returning every matching post are far heavier and get a fraction of the requests
+HEAVY_ROUTES = ('GET /multimedia', 'GET /multimedia/<mType>', 'GET /multimedia/author/<duid>')
+
+
+def percentile(values, fraction):
+    """
+    Summary:
+        Returns the value below which the given fraction of the sorted values fall.
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def buildRequests(route, count, store, generator):
+    """
+    Summary:
+        Builds the (method, path, body) requests sent to a route.
+
+    Params:
+        route: the route name, e.g. 'GET /multimedia/<mid>'.
+        count: the amount of requests.
+        store: the store holding the benchmark dataset, used to pick existing ids.
+        generator: the random generator of the run.
+
+    Returns:
+        A list of (method, path, body) tuples.
+    """
+    mIDs = sorted(store.multimedia)
+    authors = sorted(store.users)
+    now = datetime.datetime.now()
+    requests = []
+
+    for i in range(count):
+        mID = generator.choice(mIDs)
+        if route == 'GET /multimedia':
+            requests.append(('GET', '/multimedia', None))
+        elif route == 'GET /multimedia/<mid>':
+            requests.append(('GET', '/multimedia/{}'.format(mID), None))
+        elif route == 'GET /multimedia/<mType>':
+            requests.append(('GET', '/multimedia/{}'.format(generator.choice(('text', 'image', 'video', 'livestream'))), None))
+        elif route == 'GET /multimedia/<mid>/related':
+            requests.append(('GET', '/multimedia/{}/related'.format(mID), None))
+        elif route == 'GET /multimedia/archive/<yyyy>/<mm>':
+            month = now - datetime.timedelta(days = generator.randint(31, 4 * 365))
+            requests.append(('GET', '/multimedia/archive/{}/{}'.format(month.year, month.month), None))
+        elif route == 'GET /multimedia/author/<duid>':
+            requests.append(('GET', '/multimedia/author/{}'.format(generator.choice(authors)), None))
+        elif route == 'GET /multimedia/<mid>/versions/<n>':
+            requests.append(('GET', '/multimedia/{}/versions/1'.format(mID), None))
+        elif route == 'POST /multimedia':
+            body = {'attributes': {'title': 'Benchmark {}'.format(i), 'content': 'Contenido de prueba {} '.format(i) * 50,
+                                   'type': 'text', 'duid': generator.choice(authors)}}
+            requests.append(('POST', '/multimedia', body))
+        elif route == 'PUT /multimedia/<mid>':
+            body = {'attributes': {'title': 'Editado {}'.format(i), 'content': 'Contenido editado {} '.format(i) * 50}}
+            requests.append(('PUT', '/multimedia/{}'.format(mID), body))
+        elif route == 'DELETE /multimedia/<mid>':
+            #Each removal targets a different post from the end of the dataset
+            requests.append(('DELETE', '/multimedia/{}'.format(mIDs[-1 - i]), None))
+
+    return requests
+
+
+ROUTES = (
+    'GET /multimedia',
+    'GET /multimedia/<mid>',
+    'GET /multimedia/<mType>',
+    'GET /multimedia/<mid>/related',
+    'GET /multimedia/archive/<yyyy>/<mm>',
+    'GET /multimedia/author/<duid>',
+    'GET /multimedia/<mid>/versions/<n>',
+    'POST /multimedia',
+    'PUT /multimedia/<mid>',
+    'DELETE /multimedia/<mid>',
+)
+
+
+class TestClientDriver:
+    """
+    Sends requests sequentially through the Flask test client.
+    """
+
+    def __init__(self, app, headers):
+        self.client = app.test_client()
+        self.headers = headers
+
+    def run(self, requests, concurrency):
+        latencies = []
+        errors = 0
+        started = time.perf_counter()
+        for method, path, body in requests:
+            start = time.perf_counter()
+            response = self.client.open(path, method = method, json = body, headers = self.headers)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 500:
+                errors += 1
+        return latencies, errors, time.perf_counter() - started
+
+
+class ServerDriver:
+    """
+    Sends requests concurrently over HTTP to a WSGI server, started in process unless a URL is given.
+    """
+
+    def __init__(self, app, headers, url = None):
+        self.headers = dict(headers, **{'Content-Type': 'application/json'})
+        self.server = None
+        if url is None:
+            from werkzeug.serving import make_server
+            self.server = make_server('127.0.0.1', 0, app, threaded = True)
+            threading.Thread(target = self.server.serve_forever, daemon = True).start()
+            url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.local = threading.local()
+
+    def _send(self, request):
+        method, path, body = request
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout = 60)
+        payload = json.dumps(body) if body is not None else None
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body = payload, headers = self.headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+                connection.close()
+                self.local.connection = None
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            status = 599
+        return time.perf_counter() - start, status
+
+    def run(self, requests, concurrency):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers = concurrency) as executor:
+            results = list(executor.map(self._send, requests))
+        elapsed = time.perf_counter() - started
+        return [latency for latency, _ in results], sum(1 for _, status in results if status >= 500), elapsed
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def bypassAuthentication(main):
+    """
+    Summary:
+        Replaces the token verification and session lookup of the app so protected routes can be
+        benchmarked without dashboard users.
+    """
+    main.verifyToken = lambda token: True
+    main.getTokenInfo = lambda token: {'user': 'benchmark', 'permissions': []}
+    main.customSession.isLoggedIn = lambda user: user
+
+
+def fetchTargetIDs(url, headers):
+    """
+    Summary:
+        Reads the multimedia post ids, and the dashboard user ids when the headers allow listing them, of the
+        server benchmarked with --url, so the requests hit rows that exist there.
+
+    Returns:
+        An InMemoryStore holding only those ids, as read by buildRequests.
+    """
+    parsed = urllib.parse.urlparse(url)
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout = 600)
+
+    def get(path):
+        connection.request('GET', path, headers = headers)
+        response = connection.getresponse()
+        body = response.read()
+        return json.loads(body) if response.status == 200 else {}
+
+    try:
+        multimedia = get('/multimedia').get('Multimedias', [])
+        users = next((value for value in get('/users/').values() if isinstance(value, list)), [])
+    finally:
+        connection.close()
+
+    store = InMemoryStore()
+    store.multimedia = {post['mid']: None for post in multimedia}
+    store.users = {user.get('id', user.get('duid')): None for user in users if isinstance(user, dict)}
+    store.users.pop(None, None)
+    if not store.multimedia:
+        raise SystemExit("The target server has no multimedia posts to benchmark.")
+    if not store.users:
+        #The author routes answer 400 for unknown authors, which still measures the handler
+        print("Could not list the dashboard users of the target, the author routes use generated ids.", file = sys.stderr)
+        store.users = {duid: None for duid in range(1, 51)}
+    return store
+
+
+def seedPostgres(store):
+    """
+    Summary:
+        Replaces the multimedia posts of the local Postgres database configured for the app with the
+        benchmark dataset, authored by the existing dashboard users.
+    """
+    import psycopg2.extras
+    from handler.dao.multimedia_dao import MultimediaDAO
+
+    dao = MultimediaDAO()
+    cursor = dao.conn.cursor()
+    cursor.execute("select id from dashboard_user order by id")
+    authors = [row[0] for row in cursor.fetchall()]
+    if not authors:
+        raise SystemExit("The database needs at least one dashboard user to seed multimedia posts.")
+
+    cursor.execute("truncate multimedia_related, multimedia_version")
+    cursor.execute("delete from multimedia")
+    rows = ((row[1], row[2], row[3], row[4], authors[row[5] % len(authors)]) for row in store.multimedia.values())
+    psycopg2.extras.execute_values(cursor,
+        "insert into multimedia (title, content, type, date_published, is_invalid, duid) values %s",
+        rows, template = "(%s, %s, %s, %s, false, %s)", page_size = 1000)
+    cursor.execute("select mid from multimedia order by mid")
+    mIDs = [row[0] for row in cursor.fetchall()]
+    dao._commitChanges()
+    dao._closeConnection()
+
+    #Point the store at the ids and authors Postgres assigned so the requests hit existing rows
+    store.multimedia = {mID: row for mID, row in zip(mIDs, store.multimedia.values())}
+    store.users = {duid: (duid,) for duid in authors}
+
+
+def runBenchmark(args):
+    """
+    Summary:
+        Runs every route at every dataset size and returns the results keyed by
+        "<client>/<backend>/<size>/<route>".
+    """
+    generator = random.Random(args.random_seed)
+    results = {}
+
+    if args.backend == 'memory':
+        from handler.multimedia import MultimediaHandler
+        MultimediaHandler.multimediaDAO = InMemoryMultimediaDAO
+        MultimediaHandler.userDAO = InMemoryUserDAO
+        duplicateIndex.multimediaDAO = InMemoryMultimediaDAO
+
+    import main
+
+    headers = {'Authorization': args.token} if args.token else {'Authorization': 'Bearer benchmark'}
+    if not args.token:
+        bypassAuthentication(main)
+
+    for size in args.sizes:
+        store = generateMultimediaFixtures(InMemoryStore(), size)
+        if args.backend == 'memory':
+            InMemoryMultimediaDAO.store = InMemoryUserDAO.store = store
+        elif args.seed:
+            seedPostgres(store)
+
+        #Measure with the near-duplicate index fully built, as in steady state
+        duplicateIndex.rebuild()
+
+        if args.client == 'test':
+            driver = TestClientDriver(main.app, headers)
+        else:
+            driver = ServerDriver(main.app, headers, args.url)
+        if args.url:
+            store = fetchTargetIDs(args.url, headers)
+
+        for route in ROUTES:
+            count = args.requests
+            if route in HEAVY_ROUTES:
+                count = max(args.min_requests, args.requests // max(1, size // 1000))
+            requests = buildRequests(route, count + args.warmup, store, generator)
+            driver.run(requests[:args.warmup], args.concurrency)
+            latencies, errors, elapsed = driver.run(requests[args.warmup:], args.concurrency)
+            latencies.sort()
+
+            results['{}/{}/{}/{}'.format(args.client, args.backend, size, route)] = {
+                'requests': len(latencies),
+                'errors': errors,
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+                'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            }
+
+        if args.client == 'server':
+            driver.close()
+
+    return results
+
+
+def compareBaseline(results, baseline, tolerance):
+    """
+    Summary:
+        Compares the p95 latency and requests per second of each result against the baseline.
+
+    Returns:
+        A list of messages describing each regression beyond the tolerance.
+    """
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        if previous['p95_ms'] and result['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append("{}: p95 {} ms -> {} ms".format(key, previous['p95_ms'], result['p95_ms']))
+        if previous['rps'] and result['rps'] < previous['rps'] * (1 - tolerance):
+            regressions.append("{}: {} req/s -> {} req/s".format(key, previous['rps'], result['rps']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmarks the multimedia routes.")
+    parser.add_argument('--backend', choices = ('memory', 'postgres'), default = 'memory')
+    parser.add_argument('--seed', action = 'store_true', help = "replace the Postgres multimedia posts with the dataset")
+    parser.add_argument('--client', choices = ('test', 'server'), default = 'test')
+    parser.add_argument('--url', help = "benchmark an already running server instead of an in process one")
+    parser.add_argument('--sizes', type = lambda value: [int(size) for size in value.split(',')], default = [1000, 10000, 100000])
+    parser.add_argument('--requests', type = int, default = 200, help = "requests per route")
+    parser.add_argument('--min-requests', type = int, default = 100, help = "fewest requests of a heavy route, for a meaningful p99")
+    parser.add_argument('--warmup', type = int, default = 10, help = "unmeasured requests per route")
+    parser.add_argument('--concurrency', type = int, default = 8, help = "concurrent clients against the server")
+    parser.add_argument('--token', help = "Authorization header value of a logged in dashboard user")
+    parser.add_argument('--random-seed', type = int, default = 1)
+    parser.add_argument('--output', help = "write the results to this JSON file")
+    parser.add_argument('--baseline', help = "compare the results against this JSON file")
+    parser.add_argument('--save-baseline', help = "store the results as the baseline in this JSON file")
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = "allowed relative regression")
+    args = parser.parse_args()
+
+    if args.url and args.client != 'server':
+        parser.error("--url requires --client server")
+
+    results = runBenchmark(args)
+
+    print("{:<70} {:>8} {:>10} {:>10} {:>10} {:>10}".format('route', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+    for key, result in results.items():
+        print("{:<70} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            key, result['errors'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['rps']))
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as output:
+                json.dump(results, output, indent = 2, sort_keys = True)
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            regressions = compareBaseline(results, json.load(baselineFile), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
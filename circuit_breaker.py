@@ -0,0 +1,145 @@
+"""
+Circuit breakers in front of each database the DAOs connect to.
+
+Every connection attempt and statement reports its outcome to the breaker of its database. Once at
+least BREAKER_MIN_CALLS of them were made in a window of BREAKER_WINDOW seconds, 10 by default, and
+BREAKER_FAILURE_RATE of them, half by default, failed to connect or lost the connection, the breaker
+opens: for the next BREAKER_RESET_TIMEOUT seconds, 10 by default, connect() fails at once with
+CircuitOpenError instead of waiting on a database that is not answering. Then a single trial request
+is let through, and its first statement closes the breaker again or keeps it open.
+
+Errors and timeouts of the statements themselves, as constraint violations or a slow query canceled by
+statement_timeout, and waiting for a connection of a full pool do not count as failures: the database
+answered, and a single slow route must not cut every route off the database.
+"""
+import logging
+import os
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(psycopg2.OperationalError):
+    """
+    Raised instead of connecting to a database whose circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, minCalls = 20, failureRate = 0.5, window = 10.0, resetTimeout = 10.0):
+        self.name = name
+        self.minCalls = minCalls
+        self.failureRate = failureRate
+        self.window = window
+        self.resetTimeout = resetTimeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.windowStart = time.monotonic()
+        self.calls = 0
+        self.failures = 0
+        self.openedAt = 0.0
+        self.trialStartedAt = None
+
+    @property
+    def isOpen(self):
+        return self.state == OPEN and time.monotonic() - self.openedAt < self.resetTimeout
+
+    def allow(self):
+        """
+        Summary:
+            Raises CircuitOpenError unless the database may be used now. After the reset timeout a single
+            trial is allowed at a time, or again if the previous trial never reported back.
+        """
+        if self.state == CLOSED:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if self.state == OPEN and now - self.openedAt >= self.resetTimeout:
+                self.state = HALF_OPEN
+                self.trialStartedAt = None
+            if self.state == HALF_OPEN and (self.trialStartedAt is None or now - self.trialStartedAt >= self.resetTimeout):
+                self.trialStartedAt = now
+                return
+            if self.state == CLOSED:
+                return
+        raise CircuitOpenError("The circuit breaker of {} is open".format(self.name))
+
+    def recordSuccess(self):
+        #Counted without the lock while closed, as every statement of every request reports here, at the
+        #cost of losing a count now and then to a race
+        if self.state == CLOSED:
+            self._count(False)
+            return
+        with self.lock:
+            if self.state == HALF_OPEN:
+                logger.info("Circuit breaker of %s closed", self.name)
+                self.state = CLOSED
+                self.windowStart, self.calls, self.failures = time.monotonic(), 0, 0
+                return
+            self._count(False)
+
+    def recordFailure(self):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self._open("its trial request failed")
+                return
+            if self.state == OPEN:
+                return
+            self._count(True)
+            if self.calls >= self.minCalls and self.failures >= self.calls * self.failureRate:
+                self._open("{} of its last {} calls failed".format(self.failures, self.calls))
+
+    def _count(self, failed):
+        now = time.monotonic()
+        if now - self.windowStart >= self.window:
+            self.windowStart, self.calls, self.failures = now, 0, 0
+        self.calls += 1
+        self.failures += int(failed)
+
+    def _open(self, reason):
+        logger.warning("Circuit breaker of %s opened for %.0f seconds: %s", self.name, self.resetTimeout, reason)
+        self.state = OPEN
+        self.openedAt = time.monotonic()
+        self.windowStart, self.calls, self.failures = self.openedAt, 0, 0
+
+    def toDict(self):
+        return {'name': self.name, 'state': OPEN if self.isOpen else self.state, 'calls': self.calls, 'failures': self.failures}
+
+
+_breakers = {}
+_breakersLock = threading.Lock()
+
+
+def _describe(dsn):
+    #Breakers are logged by host and database, never with the password of the connection string
+    parameters = psycopg2.extensions.parse_dsn(dsn)
+    return '{}:{}/{}'.format(parameters.get('host', 'localhost'), parameters.get('port', 5432), parameters.get('dbname', ''))
+
+
+def circuitBreaker(dsn):
+    """
+    Summary:
+        Returns the circuit breaker of the given database, creating it on first use.
+    """
+    breaker = _breakers.get(dsn)
+    if breaker is not None:
+        return breaker
+    with _breakersLock:
+        breaker = _breakers.get(dsn)
+        if breaker is None:
+            breaker = _breakers[dsn] = CircuitBreaker(_describe(dsn),
+                int(os.getenv('BREAKER_MIN_CALLS', '20')), float(os.getenv('BREAKER_FAILURE_RATE', '0.5')),
+                float(os.getenv('BREAKER_WINDOW', '10')), float(os.getenv('BREAKER_RESET_TIMEOUT', '10')))
+        return breaker
+
+
+def breakerStatus():
+    return [breaker.toDict() for breaker in list(_breakers.values())]
@@ -12,5 +12,9 @@ export default{
      * Getter for loaded multimedia posts state.
      */
     multimedias: state => state.multimedias,
+    /**
+     * Getter for loaded related multimedia posts state.
+     */
+    relatedMultimedias: state => state.relatedMultimedias,
 
 }
\ No newline at end of file
@@ -0,0 +1,400 @@
+"""
+In-memory replacements of MultimediaDAO and UserDAO for benchmarking the handlers without a database.
+
+The DAOs keep the same method signatures and record shapes as their Postgres counterparts and share
+an InMemoryStore, so the time measured through them is the cost of the handlers and serialization alone.
+They are swapped in through the DAO class attributes of the handlers:
+
+    store = InMemoryStore()
+    generateMultimediaFixtures(store, 100000)
+    InMemoryMultimediaDAO.store = InMemoryUserDAO.store = store
+    MultimediaHandler.multimediaDAO = InMemoryMultimediaDAO
+    MultimediaHandler.userDAO = InMemoryUserDAO
+"""
+import bisect
+import datetime
+import random
+import threading
+
+TYPES = ('text', 'image', 'video', 'livestream')
+
+WORDS = ('partido', 'equipo', 'temporada', 'victoria', 'derrota', 'atleta', 'entrenador', 'torneo', 'cancha',
+         'jugada', 'punto', 'set', 'gol', 'canasta', 'entrada', 'final', 'semifinal', 'liga', 'colegio', 'recinto',
+         'tarzanos', 'juezas', 'baloncesto', 'voleibol', 'balompié', 'béisbol', 'atletismo', 'natación',
+         'campeonato', 'récord', 'marca', 'medalla', 'oro', 'plata', 'bronce', 'resultado', 'estadística')
+
+
+class InMemoryStore:
+    """
+    Tables of the in-memory DAOs with the indexes the Postgres queries rely on.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.multimedia = {}
+        self.byType = {mType: set() for mType in TYPES}
+        self.byAuthor = {}
+        self.dates = []
+        self.related = {}
+        self.versions = {}
+        self.users = {}
+        self.nextMID = 1
+
+    def insertMultimedia(self, title, content, mType, duid, datePublished):
+        """
+        Summary:
+            Inserts a valid multimedia post and returns its id.
+        """
+        with self.lock:
+            mID = self.nextMID
+            self.nextMID += 1
+            self.multimedia[mID] = [mID, title, content, mType, datePublished, duid, False]
+            self.byType[mType].add(mID)
+            self.byAuthor.setdefault(duid, set()).add(mID)
+            bisect.insort(self.dates, (datePublished, mID))
+            return mID
+
+
+def generateMultimediaFixtures(store, count = 100000, authors = 50, seed = 1):
+    """
+    Summary:
+        Fills the store with dashboard users and multimedia posts of realistic sizes: titles of a few
+        words and contents following a long tailed distribution up to the 63206 characters allowed,
+        published over the last four years.
+
+    Params:
+        store: the InMemoryStore to fill.
+        count: the amount of multimedia posts generated.
+        authors: the amount of dashboard users authoring them.
+        seed: the seed of the generator, so runs are comparable.
+
+    Returns:
+        The store.
+    """
+    generator = random.Random(seed)
+
+    for duid in range(1, authors + 1):
+        store.users[duid] = (duid, 'usuario{}'.format(duid), 'usuario{}@upr.edu'.format(duid), True)
+
+    #A pool of paragraphs keeps generation fast while contents stay varied
+    paragraphs = [' '.join(generator.choice(WORDS) for _ in range(generator.randint(20, 120))) + '.' for _ in range(500)]
+
+    now = datetime.datetime.now().replace(microsecond = 0)
+    for _ in range(count):
+        title = ' '.join(generator.choice(WORDS) for _ in range(generator.randint(3, 12))).capitalize()
+        length = min(int(generator.lognormvariate(7, 1)), 63206)
+        parts = []
+        size = 0
+        while size < length:
+            paragraph = generator.choice(paragraphs)
+            parts.append(paragraph)
+            size += len(paragraph) + 1
+        content = '\n'.join(parts)[:length] or title
+        datePublished = now - datetime.timedelta(seconds = generator.randint(0, 4 * 365 * 24 * 3600))
+        store.insertMultimedia(title, content, generator.choice(TYPES), generator.randint(1, authors), datePublished)
+
+    return store
+
+
+class InMemoryMultimediaDAO:
+    """
+    MultimediaDAO backed by an InMemoryStore. Every method reads and changes the store under its lock, so
+    concurrent requests see each post either before or after a change, as with database transactions.
+    """
+
+    #Store shared by every instance, replaced by the benchmarks with a generated one
+    store = InMemoryStore()
+
+    def __init__(self):
+        self.conn = None
+
+    def _record(self, row):
+        return row[0], row[1], row[2], row[3], row[4]
+
+    def _validRecords(self, mIDs):
+        #The caller must hold the lock of the store
+        rows = self.store.multimedia
+        return [self._record(rows[mID]) for mID in sorted(mIDs) if not rows[mID][6]]
+
+    def _validRecord(self, mID):
+        #The caller must hold the lock of the store
+        row = self.store.multimedia.get(mID)
+        if row is None or row[6]:
+            return None
+        return self._record(row)
+
+    def addMultimedia(self, title, content, mType, duid):
+        """
+        Summary:
+            Creates a valid multimedia post with the given information, published now.
+
+        Params:
+            title: the title of the multimedia post.
+            content: the content of the post.
+            mType: the type of multimedia post.
+            duid: the dashboard user id of the author of the multimedia post.
+
+        Returns:
+            The id of the newly added multimedia post.
+        """
+        return self.store.insertMultimedia(title, content, mType, duid, datetime.datetime.now())
+
+    def getAllMultimedia(self):
+        """
+        Summary:
+            Returns a list of all valid multimedia posts with their corresponding information.
+
+        Returns:
+            A list containing all the valid multimedia posts with their information.
+        """
+        with self.store.lock:
+            return [self._record(row) for row in self.store.multimedia.values() if not row[6]]
+
+    def getMultimediaByID(self, mID):
+        """
+        Summary:
+            Returns the valid multimedia post with the given id.
+
+        Params:
+            mID: the id of the multimedia post to be fetched.
+
+        Returns:
+            A tuple containing the information of the multimedia post, or None if there is no such valid post.
+        """
+        with self.store.lock:
+            return self._validRecord(mID)
+
+    def getMultimediaByType(self, mType):
+        """
+        Summary:
+            Returns a list of the valid multimedia posts of the given type.
+
+        Params:
+            mType: the type of multimedia post.
+
+        Returns:
+            A list containing the valid multimedia posts of the type with their information.
+        """
+        with self.store.lock:
+            return self._validRecords(self.store.byType.get(mType, ()))
+
+    def getMultimediaByAuthor(self, duid):
+        """
+        Summary:
+            Returns a list of the valid multimedia posts authored by the dashboard user with the given id.
+
+        Params:
+            duid: the dashboard user id of the author.
+
+        Returns:
+            A list containing the valid multimedia posts of the author with their information.
+        """
+        with self.store.lock:
+            return self._validRecords(self.store.byAuthor.get(duid, ()))
+
+    def getMultimediaByMonth(self, start, end):
+        """
+        Summary:
+            Returns a list of the valid multimedia posts published between the given dates.
+
+        Params:
+            start: the first date of the month, inclusive.
+            end: the first date of the following month, exclusive.
+
+        Returns:
+            A list containing the valid multimedia posts published in the month with their information.
+        """
+        with self.store.lock:
+            dates = self.store.dates
+            first = bisect.bisect_left(dates, (start, 0))
+            last = bisect.bisect_left(dates, (end, 0))
+            rows = self.store.multimedia
+            return [self._record(rows[mID]) for _, mID in dates[first:last] if not rows[mID][6]]
+
+    def getMultimediaCorpus(self, batchSize = 1000):
+        """
+        Summary:
+            Streams the id, title and content of every valid multimedia post, as stored when the stream started.
+
+        Params:
+            batchSize: unused, kept for the signature of MultimediaDAO.
+
+        Returns:
+            A generator of (mid, title, content) tuples.
+        """
+        with self.store.lock:
+            corpus = [(row[0], row[1], row[2]) for row in self.store.multimedia.values() if not row[6]]
+        yield from corpus
+
+    def getRelatedMultimedia(self, mID):
+        """
+        Summary:
+            Returns a list of the valid related multimedia posts of the multimedia post with the given id.
+
+        Params:
+            mID: the id of the multimedia post whose related posts are fetched.
+
+        Returns:
+            A list containing the valid related multimedia posts with their information, or None if there is
+            no valid multimedia post with the given id.
+        """
+        with self.store.lock:
+            rows = self.store.multimedia
+            if mID not in rows or rows[mID][6]:
+                return None
+            return [self._record(rows[related]) for related in self.store.related.get(mID, ()) if not rows[related][6]]
+
+    def editMultimedia(self, mID, title, content):
+        """
+        Summary:
+            Updates the title and content of the multimedia post with the given id.
+
+        Params:
+            mID: the id of the multimedia post to be updated.
+            title: the new title of the multimedia post.
+            content: the new content of the multimedia post.
+
+        Returns:
+            The id of the updated multimedia post.
+        """
+        with self.store.lock:
+            row = self.store.multimedia[mID]
+            row[1] = title
+            row[2] = content
+        return mID
+
+    def getMultimediaForEdit(self, mID):
+        """
+        Summary:
+            Returns the valid multimedia post with the given id followed by the number of its latest version.
+
+        Params:
+            mID: the id of the multimedia post to be edited.
+
+        Returns:
+            A tuple containing the information of the multimedia post and its latest version number, or None
+            if there is no such valid multimedia post.
+        """
+        with self.store.lock:
+            record = self._validRecord(mID)
+            if record is None:
+                return None
+            return record + (len(self.store.versions.get(mID, ())),)
+
+    def editMultimediaWithVersions(self, mID, title, content, versions):
+        """
+        Summary:
+            Stores the given versions in the edit history of a multimedia post and updates its title and content.
+
+        Params:
+            mID: the id of the multimedia post to be updated.
+            title: the new title of the multimedia post.
+            content: the new content of the multimedia post.
+            versions: a list of (version, isSnapshot, title, data, dateEdited) tuples to store.
+
+        Returns:
+            A tuple containing the information of the updated multimedia post.
+        """
+        with self.store.lock:
+            history = self.store.versions.setdefault(mID, [])
+            for version, isSnapshot, versionTitle, data, dateEdited in versions:
+                history.append((version, isSnapshot, versionTitle, data, dateEdited or datetime.datetime.now()))
+            row = self.store.multimedia[mID]
+            row[1] = title
+            row[2] = content
+            return self._record(row)
+
+    def removeMultimedia(self, mID):
+        """
+        Summary:
+            Marks the multimedia post with the given id as invalid.
+
+        Params:
+            mID: the id of the multimedia post to be removed.
+
+        Returns:
+            The id of the removed multimedia post.
+        """
+        with self.store.lock:
+            self.store.multimedia[mID][6] = True
+        return mID
+
+    def multimediaExists(self, mID):
+        """
+        Summary:
+            Confirms the existence of a valid multimedia post with the given id.
+
+        Params:
+            mID: the id of the multimedia post in question.
+
+        Returns:
+            True if the multimedia post exists, false otherwise.
+        """
+        with self.store.lock:
+            return self._validRecord(mID) is not None
+
+    def getLatestMultimediaVersion(self, mID):
+        """
+        Summary:
+            Returns the number of the latest stored version of the multimedia post with the given id.
+
+        Params:
+            mID: the id of the multimedia post in question.
+
+        Returns:
+            The latest version number, or 0 if the multimedia post has no stored versions.
+        """
+        with self.store.lock:
+            return len(self.store.versions.get(mID, ()))
+
+    def getMultimediaVersionChain(self, mID, version):
+        """
+        Summary:
+            Returns the stored versions needed to rebuild the given version of a multimedia post: its nearest
+            previous snapshot and every delta after it up to the requested version.
+
+        Params:
+            mID: the id of the multimedia post.
+            version: the number of the version to rebuild.
+
+        Returns:
+            A list of (version, is_snapshot, title, data, date_edited) records ordered by version.
+        """
+        with self.store.lock:
+            versions = self.store.versions.get(mID, [])[:version]
+        start = max((index for index, row in enumerate(versions) if row[1]), default = 0)
+        return versions[start:]
+
+    def _commitChanges(self):
+        pass
+
+    def _closeConnection(self):
+        pass
+
+
+class InMemoryUserDAO:
+    """
+    UserDAO backed by an InMemoryStore, covering the lookups done by the multimedia handler.
+    """
+
+    store = InMemoryMultimediaDAO.store
+
+    def __init__(self):
+        self.conn = None
+
+    def getDashUserByID(self, duid):
+        """
+        Summary:
+            Returns the dashboard user with the given id.
+
+        Params:
+            duid: the id of the dashboard user.
+
+        Returns:
+            A tuple containing the information of the dashboard user, or None if there is no such user.
+        """
+        with self.store.lock:
+            return self.store.users.get(duid)
+
+    def _closeConnection(self):
+        pass
@@ -0,0 +1,203 @@
+"""
+Admission control and stale responses for when the database cannot keep up.
+
+Each route belongs to a class: the public read-only routes marked with readReplica(), the other reads
+and the writes. Every class admits a limited amount of requests in flight per process, set with
+ADMISSION_LIMIT_PUBLIC, ADMISSION_LIMIT_READ and ADMISSION_LIMIT_WRITE. A request over the limit of
+its class waits up to ADMISSION_WAIT seconds, 0.05 by default, for another one to finish, and is then
+shed instead of piling up on the database connections. The metrics and admin routes are always
+admitted, so the app can be observed while it sheds.
+
+A request is in flight from the start of its handling until it returns its response, not while the
+client sends the request or reads the response, so the limits follow how many requests the database
+connections can serve rather than how many clients are connected. With DB_POOL_MAX set, as in the
+gevent serving mode, the limits default to 4, 2 and 1 times it, which keeps a pool of 50 connections
+busy without bounding the thousands of connections gevent holds. Otherwise they default to 64, 32 and
+16, above the threads of a threaded server.
+
+The last successful response of every public route is kept, up to STALE_CACHE_BYTES bytes, 64 MB by
+default, for STALE_CACHE_MAX_AGE seconds, one hour by default. A public request that is shed, finds
+the circuit breaker of the database open or fails with a server error gets that response, marked with
+an Age header, instead. Every other shed or failed fast request is answered with a 503 and a
+Retry-After header of LOAD_SHEDDING_RETRY_AFTER seconds.
+"""
+import collections
+import os
+import threading
+import time
+from flask import Response, current_app, g, jsonify, request
+from handler.dao.circuit_breaker import CircuitOpenError
+
+PUBLIC = 'public'
+READ = 'read'
+WRITE = 'write'
+
+#Routes never shed, the ones operators need to see why the app is shedding
+EXEMPT_PATHS = ('/metrics',)
+EXEMPT_PREFIXES = ('/admin/',)
+
+#Admission limits per DB_POOL_MAX connection, and without a bounded pool
+POOL_LIMIT_FACTORS = {PUBLIC: 4, READ: 2, WRITE: 1}
+DEFAULT_LIMITS = {PUBLIC: 64, READ: 32, WRITE: 16}
+
+
+def routeClass(view, method):
+    """
+    Summary:
+        Returns the admission class of a request to the given view function with the given method.
+    """
+    if method not in ('GET', 'HEAD', 'OPTIONS'):
+        return WRITE
+    if getattr(view, 'readReplica', False):
+        return PUBLIC
+    return READ
+
+
+class StaleResponseCache:
+    """
+    Last successful response of each public route, least recently stored first out once the bodies
+    exceed the size of the cache.
+    """
+
+    def __init__(self, maxBytes, maxAge):
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def store(self, key, response):
+        body = response.get_data()
+        if len(body) > self.maxBytes:
+            return
+        entry = (time.time(), body, response.mimetype)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self.entries[key] = entry
+            self.size += len(body)
+            while self.size > self.maxBytes:
+                self.size -= len(self.entries.popitem(last = False)[1][1])
+
+    def response(self, key):
+        """
+        Summary:
+            Returns the kept response of the given key, or None if there is none recent enough.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        storedAt, body, mimetype = entry
+        age = time.time() - storedAt
+        if age > self.maxAge:
+            return None
+        #Caches in front of the app must not keep the stale response as a fresh one
+        return Response(body, status = 200, mimetype = mimetype, headers = {'Age': str(int(age)), 'Cache-Control': 'no-store'})
+
+
+def _admissionLimits():
+    poolLimit = os.getenv('DB_POOL_MAX')
+    limits = {}
+    for name in (PUBLIC, READ, WRITE):
+        default = int(poolLimit) * POOL_LIMIT_FACTORS[name] if poolLimit else DEFAULT_LIMITS[name]
+        limits[name] = int(os.getenv('ADMISSION_LIMIT_' + name.upper(), str(default)))
+    return limits
+
+
+class LoadShedder:
+
+    def __init__(self):
+        self.limits = _admissionLimits()
+        self.wait = float(os.getenv('ADMISSION_WAIT', '0.05'))
+        self.retryAfter = int(os.getenv('LOAD_SHEDDING_RETRY_AFTER', '5'))
+        self.slots = {name: threading.BoundedSemaphore(limit) for name, limit in self.limits.items()}
+        self.lock = threading.Lock()
+        self.inFlight = collections.Counter()
+        self.shed = collections.Counter()
+        self.staleServed = 0
+        self.cache = StaleResponseCache(int(os.getenv('STALE_CACHE_BYTES', str(64 * 1024 * 1024))),
+                                        float(os.getenv('STALE_CACHE_MAX_AGE', '3600')))
+
+    def register(self, app):
+        """
+        Summary:
+            Installs the request hooks that admit, shed and answer from the stale cache the requests of the
+            app. They must be registered before registerQueryAccounting() and registerUnitOfWork(), so
+            the stale responses replace the errors those hooks return.
+        """
+        app.before_request(self._admit)
+        app.after_request(self._afterRequest)
+        app.teardown_request(self._release)
+        app.register_error_handler(CircuitOpenError, self._circuitOpen)
+
+    def _admit(self):
+        if request.path in EXEMPT_PATHS or request.path.startswith(EXEMPT_PREFIXES):
+            return None
+        name = routeClass(current_app.view_functions.get(request.endpoint), request.method)
+        g.admissionClass = name
+        if self.slots[name].acquire(timeout = self.wait):
+            g.admitted = name
+            with self.lock:
+                self.inFlight[name] += 1
+            return None
+        with self.lock:
+            self.shed[name] += 1
+        return self._unavailable("El servidor está sobrecargado, intente nuevamente.")
+
+    def _release(self, exception):
+        name = g.pop('admitted', None)
+        if name is None:
+            return
+        with self.lock:
+            self.inFlight[name] -= 1
+        self.slots[name].release()
+
+    def _cacheable(self):
+        return g.get('admissionClass') == PUBLIC and request.method == 'GET'
+
+    def _staleResponse(self):
+        if not self._cacheable():
+            return None
+        response = self.cache.response(request.full_path)
+        if response is not None:
+            g.staleResponse = True
+            with self.lock:
+                self.staleServed += 1
+        return response
+
+    def _unavailable(self, message):
+        response = self._staleResponse()
+        if response is not None:
+            return response
+        response = jsonify(Error = message)
+        response.status_code = 503
+        response.headers['Retry-After'] = str(self.retryAfter)
+        return response
+
+    def _circuitOpen(self, error):
+        return self._unavailable("La base de datos no está disponible, intente nuevamente.")
+
+    def _afterRequest(self, response):
+        if not self._cacheable() or g.get('staleResponse'):
+            return response
+        if response.status_code == 200 and not response.is_streamed:
+            self.cache.store(request.full_path, response)
+        elif response.status_code >= 500:
+            return self._staleResponse() or response
+        return response
+
+    def status(self):
+        with self.lock:
+            return {
+                'limits': dict(self.limits),
+                'in_flight': dict(self.inFlight),
+                'shed': dict(self.shed),
+                'stale_served': self.staleServed,
+                'stale_cache_entries': len(self.cache.entries),
+                'stale_cache_bytes': self.cache.size,
+            }
+
+
+loadShedder = LoadShedder()
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import os
 import datetime
@@ -6,6 +6,15 @@ from handler.user import UserHandler
 from handler.athlete import AthleteHandler
 from auth import verifyHash, generateToken, verifyToken, getTokenInfo
 from customSession import CustomSession
+from metrics import RequestMetrics
+from structured_logging import configureLogging
+from handler.tracing import registerTracing, span, traced, traceMethods
+from profiling import stackSampler, memoryProfiler, collapsedStacks, speedscopeProfile, registerRequestProfiling, ProfilerBusy
+from handler.dao.query_accounting import registerQueryAccounting, queryBudget, timeBudget, liveObjectCounts
+from handler.dao.unit_of_work import registerUnitOfWork
+from handler.dao.read_replicas import registerReadReplicas, readReplica, replicaRouter
+from handler.dao.circuit_breaker import breakerStatus
+from load_shedding import loadShedder
 from functools import wraps
 from dotenv import load_dotenv
 import os
@@ -23,6 +32,7 @@ from handler.team import TeamHandler
 from handler.event_result import EventResultHandler
 from handler.medal_based_event import MedalBasedEventHandler
 from handler.multimedia import MultimediaHandler
+from handler.multimedia_duplicates import duplicateIndex
 
 
 # Load environment variables
@@ -35,6 +45,43 @@ app.secret_key = os.getenv('SECRET_KEY')
 customSession = CustomSession()
 CORS(app)
 
+# Write the logs of every module as JSON lines from a background thread, tagged with the request id.
+configureLogging(app)
+
+# Record per-route latency, status and in-flight metrics of every request.
+requestMetrics = RequestMetrics()
+requestMetrics.register(app)
+
+# Shed the requests over the admission limit of their route class and answer the public routes
+# from their last successful response while the database is overloaded or unavailable.
+loadShedder.register(app)
+
+# Report the database work of every request and enforce the route query and database time budgets.
+registerQueryAccounting(app)
+
+# Share one connection and transaction between the DAOs of each request, committed once at its end.
+registerUnitOfWork(app)
+
+# Send the DAOs of the read-only routes to the healthy read replicas listed in DB_REPLICAS.
+registerReadReplicas(app)
+
+# Trace a sample of the requests through the session lookup, handlers, DAOs and serialization.
+registerTracing(app)
+customSession.isLoggedIn = traced('CustomSession.isLoggedIn')(customSession.isLoggedIn)
+for handlerClass in (UserHandler, AthleteHandler, PositionHandler, EventHandler, BasketballEventHandler,
+                     VolleyballEventHandler, SoccerEventHandler, BaseballEventHandler, SportHandler,
+                     VolleyballPBPHandler, MatchBasedEventHandler, TeamHandler, EventResultHandler,
+                     MedalBasedEventHandler, MultimediaHandler):
+    traceMethods(handlerClass)
+
+# Profile with cProfile the requests sent with the X-Profile header.
+registerRequestProfiling(app)
+
+# Build the multimedia near-duplicate index in the background as the app and its workers start.
+# Edge nodes serving the SQLite snapshot only handle reads and have no Postgres.
+if os.getenv('MULTIMEDIA_BACKEND') != 'sqlite':
+    duplicateIndex.buildOnStart()
+
 
 def token_check(func):
     """
@@ -46,19 +93,20 @@ def token_check(func):
     @wraps(func)
     def decorated(*args, **kwargs):
 
-        if request.headers.get('Authorization') == None:
-            return jsonify(Error='Token is missing'), 403
+        with span('token_check'):
+            if request.headers.get('Authorization') == None:
+                return jsonify(Error='Token is missing'), 403
 
-        # Extract token from auth header.
-        token = request.headers.get('Authorization').split(' ')[1]
+            # Extract token from auth header.
+            token = request.headers.get('Authorization').split(' ')[1]
 
-        if not token:
-            return jsonify(Error='Token is missing'), 403
+            if not token:
+                return jsonify(Error='Token is missing'), 403
 
-        if not verifyToken(token):
-            return jsonify(Error="Token is invalid"), 403
-        else:
-            return func(*args, **kwargs)
+            if not verifyToken(token):
+                return jsonify(Error="Token is invalid"), 403
+
+        return func(*args, **kwargs)
     return decorated
 
 
@@ -89,9 +137,125 @@ def validateRequestPermissions(token, permissionNumber):
     index = switch(permissionNumber)
     return(token['permissions'][index][permissionNumber])
 
+#--------- Metrics Routes ---------#
+
+@app.route("/metrics", methods=['GET'])
+def getMetrics():
+    if request.method == 'GET':
+        return Response(requestMetrics.render(), mimetype='text/plain; version=0.0.4')
+
+#--------- Admin Routes ---------#
+
+@app.route("/admin/profile", methods=['GET'])
+@token_check
+def getProfile():
+    # Check user making the reques has a valid session.
+    token = extractUserInfoFormToken()
+    loggedUser = customSession.isLoggedIn(token['user'])
+    if(loggedUser == None):
+        return jsonify(Error='No hay una sesión valida.'), 401
+
+    # Profiling is restricted to the users allowed to manage dashboard users.
+    if(not validateRequestPermissions(token, '22')):
+        return jsonify(Error='El usuario no tiene permiso para acceder a estos recursos.'), 403
+
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', 0.01))
+    except ValueError:
+        return jsonify(Error="Argumentos incorrectos fueron dados."), 400
+    outputFormat = request.args.get('format', 'speedscope')
+    if seconds <= 0 or interval <= 0 or outputFormat not in ('speedscope', 'collapsed'):
+        return jsonify(Error="Argumentos incorrectos fueron dados."), 400
+
+    try:
+        samples = stackSampler.sample(seconds, interval)
+    except ProfilerBusy:
+        return jsonify(Error="Ya se está perfilando este proceso."), 409
+
+    if outputFormat == 'collapsed':
+        return Response(collapsedStacks(samples), mimetype='text/plain')
+    return Response(speedscopeProfile(samples, interval), mimetype='application/json',
+                    headers={'Content-Disposition': 'attachment; filename=profile.speedscope.json'})
+
+@app.route("/admin/memory", methods=['GET', 'POST', 'DELETE'])
+@token_check
+def adminMemory():
+    # Check user making the reques has a valid session.
+    token = extractUserInfoFormToken()
+    loggedUser = customSession.isLoggedIn(token['user'])
+    if(loggedUser == None):
+        return jsonify(Error='No hay una sesión valida.'), 401
+
+    # Profiling is restricted to the users allowed to manage dashboard users.
+    if(not validateRequestPermissions(token, '22')):
+        return jsonify(Error='El usuario no tiene permiso para acceder a estos recursos.'), 403
+
+    if request.method == 'POST':
+        # Start tracing allocations, the next GET reports the growth since now.
+        try:
+            frames = int(request.args.get('frames', 10))
+        except ValueError:
+            return jsonify(Error="Argumentos incorrectos fueron dados."), 400
+        if frames < 1:
+            return jsonify(Error="Argumentos incorrectos fueron dados."), 400
+        memoryProfiler.start(frames)
+        return jsonify(Message='Se comenzó a rastrear la memoria.'), 200
+    if request.method == 'DELETE':
+        memoryProfiler.stop()
+        return jsonify(Message='Se dejó de rastrear la memoria.'), 200
+
+    groupBy = request.args.get('group_by', 'lineno')
+    try:
+        limit = int(request.args.get('limit', 25))
+    except ValueError:
+        return jsonify(Error="Argumentos incorrectos fueron dados."), 400
+    if groupBy not in ('lineno', 'filename', 'traceback') or limit < 1:
+        return jsonify(Error="Argumentos incorrectos fueron dados."), 400
+
+    objects = liveObjectCounts()
+    objects['duplicate_index_entries'] = len(duplicateIndex)
+    objects['metrics_series'] = len(requestMetrics.histograms)
+    report = memoryProfiler.report(groupBy, limit)
+    if report is None:
+        return jsonify(Objects=objects, Warning='No se está rastreando la memoria.'), 200
+    return jsonify(Memory=report, Objects=objects), 200
+
+@app.route("/admin/replicas", methods=['GET'])
+@token_check
+def getReplicas():
+    # Check user making the reques has a valid session.
+    token = extractUserInfoFormToken()
+    loggedUser = customSession.isLoggedIn(token['user'])
+    if(loggedUser == None):
+        return jsonify(Error='No hay una sesión valida.'), 401
+
+    # The database topology is restricted to the users allowed to manage dashboard users.
+    if(not validateRequestPermissions(token, '22')):
+        return jsonify(Error='El usuario no tiene permiso para acceder a estos recursos.'), 403
+
+    return jsonify(Replicas=replicaRouter.status(), MaxLag=replicaRouter.maxLag), 200
+
+@app.route("/admin/overload", methods=['GET'])
+@token_check
+def getOverload():
+    # Check user making the reques has a valid session.
+    token = extractUserInfoFormToken()
+    loggedUser = customSession.isLoggedIn(token['user'])
+    if(loggedUser == None):
+        return jsonify(Error='No hay una sesión valida.'), 401
+
+    # The database topology is restricted to the users allowed to manage dashboard users.
+    if(not validateRequestPermissions(token, '22')):
+        return jsonify(Error='El usuario no tiene permiso para acceder a estos recursos.'), 403
+
+    return jsonify(Breakers=breakerStatus(), Shedding=loadShedder.status()), 200
+
 #--------- Multimedia Routes ---------#
 
 @app.route("/multimedia", methods=['POST'])
+@queryBudget(3)
+@timeBudget(5000)
 @token_check
 def addMultimedia():
     #Check if dashboard user making the request has a valid session.
@@ -111,24 +275,53 @@ def addMultimedia():
         return handler.addMultimedia(json['attributes'])
 
 @app.route("/multimedia", methods=['GET'])
+@queryBudget(1)
+@timeBudget(2000)
+@readReplica
 def getAllMultimedia():
     if request.method == 'GET':
         handler = MultimediaHandler()
         return handler.getAllMultimedia()
 
 @app.route("/multimedia/<int:mid>", methods=['GET'])
+@queryBudget(1)
+@timeBudget(2000)
+@readReplica
 def getMultimediaByID(mid):
     if request.method == 'GET':
         handler = MultimediaHandler()
         return handler.getMultimediaByID(mid)
 
+@app.route("/multimedia/<int:mid>/related", methods=['GET'])
+@queryBudget(1)
+@timeBudget(2000)
+@readReplica
+def getRelatedMultimedia(mid):
+    if request.method == 'GET':
+        handler = MultimediaHandler()
+        return handler.getRelatedMultimedia(mid)
+
+@app.route("/multimedia/archive/<int:year>/<int:month>", methods=['GET'])
+@queryBudget(1)
+@timeBudget(2000)
+@readReplica
+def getMultimediaArchive(year, month):
+    if request.method == 'GET':
+        handler = MultimediaHandler()
+        return handler.getMultimediaArchive(year, month, request.headers.get('If-None-Match'))
+
 @app.route("/multimedia/<mType>", methods=['GET'])
+@queryBudget(1)
+@timeBudget(2000)
+@readReplica
 def getMultimediaByType(mType):
     if request.method == 'GET':
         handler = MultimediaHandler()
         return handler.getMultimediaByType(mType)
 
 @app.route("/multimedia/author/<int:duid>", methods=['GET'])
+@queryBudget(2)
+@timeBudget(2000)
 @token_check
 def getMultimediaByAuthor(duid):
     #Check if dashboard user making the request has a valid session.
@@ -142,6 +335,8 @@ def getMultimediaByAuthor(duid):
         return handler.getMultimediaByAuthor(duid)
 
 @app.route("/multimedia/<int:mid>", methods=['PUT'])
+@queryBudget(4)
+@timeBudget(5000)
 @token_check
 def editMultimedia(mid):
     #Check if dashboard user making the request has a valid session.
@@ -160,7 +355,24 @@ def editMultimedia(mid):
         handler = MultimediaHandler()
         return handler.editMultimedia(mid, json['attributes'])
 
+@app.route("/multimedia/<int:mid>/versions/<int:version>", methods=['GET'])
+@queryBudget(4)
+@timeBudget(3000)
+@token_check
+def getMultimediaVersion(mid, version):
+    #Check if dashboard user making the request has a valid session.
+    token = extractUserInfoFormToken()
+    loggedUser = customSession.isLoggedIn(token['user'])
+    if(loggedUser == None):
+        return jsonify(Error='No hay una sesión valida.'), 401
+    
+    if request.method == 'GET':
+        handler = MultimediaHandler()
+        return handler.getMultimediaVersion(mid, version)
+
 @app.route("/multimedia/<int:mid>", methods=['DELETE'])
+@queryBudget(2)
+@timeBudget(5000)
 @token_check
 def removeMultimedia(mid):
     #Check if dashboard user making the request has a valid session.
@@ -175,6 +387,7 @@ def removeMultimedia(mid):
 
 #--------- Athlete Routes ---------#
 @app.route("/athletes/public/", methods=['GET'])
+@readReplica
 def p_athletes():
     if request.method == "GET":
         handler = AthleteHandler()
@@ -221,6 +434,7 @@ def athletesDetailed():
 
 
 @app.route("/athletes/<int:aid>/public/", methods=['GET'])
+@readReplica
 def p_athleteByID(aid):
     if request.method == 'GET':
         return AthleteHandler().getAthleteByID(aid)
@@ -285,7 +499,7 @@ def logout():
         return jsonify(Error='No hay una sesión valida.'), 401
 
     customSession.logout(loggedUser)
-    print('logout successfuly')
+    app.logger.info("User %s logged out", token['user'])
     return jsonify(Message='Se terminó la sesión exitosamente!'), 200
 
 ###########################################
@@ -301,7 +515,7 @@ def allUsers():
         return jsonify(Error='No hay una sesión valida.'), 401
     token = extractUserInfoFormToken()
     loggedUser = customSession.isLoggedIn(token['user'])
-    print(loggedUser)
+    app.logger.debug("Request of dashboard user %s", token['user'])
     if(loggedUser == None):
         return jsonify(Error='No hay una sesión valida.'), 401
 
@@ -337,7 +551,7 @@ def userByID(duid):
         return jsonify(Error='No hay una sesión valida.'), 401
     token = extractUserInfoFormToken()
     loggedUser = customSession.isLoggedIn(token['user'])
-    print(loggedUser)
+    app.logger.debug("Request of dashboard user %s", token['user'])
     if(loggedUser == None):
         return jsonify(Error='No hay una sesión valida.'), 401
     handler = UserHandler()
@@ -526,6 +740,7 @@ def events():
 
 
 @app.route("/events/<int:eID>/public/", methods=['GET'])
+@readReplica
 def p_eventById(eID):
     if request.method == 'GET':
         return EventHandler().getEventByID(eID)
@@ -557,6 +772,7 @@ def eventById(eID):
 
 
 @app.route("/events/team/<int:tID>/public/", methods=['GET'])
+@readReplica
 def p_teamEvents(tID):
     if request.method == 'GET':
         return EventHandler().getEventsByTeam(tID)
@@ -687,6 +903,7 @@ def basketballStatistics():
 
 
 @app.route("/results/basketball/public/", methods=['GET'])
+@readReplica
 def getBasketballStatistics():
     json = request.args
     if json is None:
@@ -770,6 +987,7 @@ def basketballAthleteStatistics():
 
 
 @app.route("/results/basketball/individual/public/", methods=['GET'])
+@readReplica
 def getBasketballAthleteStatistics():
     json = request.args
     if json is None:
@@ -857,6 +1075,7 @@ def basketballTeamStatistics():
 
 
 @app.route("/results/basketball/team/public/", methods=['GET'])
+@readReplica
 def getBasketballTeamStatistics():
     json = request.args
     if json is None:
@@ -928,6 +1147,7 @@ def basketballFinalScores():
 
 
 @app.route("/results/basketball/score/public/", methods=['GET'])
+@readReplica
 def getBasketballFinalScores():
     json = request.args
     if json is None:
@@ -1161,7 +1381,7 @@ def pbp_set_color(sport):
     body = request.get_json()
     args = request.args
     handler = None
-    print(body)
+    app.logger.debug("PBP color change for %s: %s", sport, body)
 
     if len(args) != 0:
         return jsonify(Error="No se aceptan argumentos en esta ruta."), 400
@@ -1496,6 +1716,7 @@ def volleyballStatistics():
 
 
 @app.route("/results/volleyball/public/", methods=['GET'])
+@readReplica
 def getVolleyballStatistics():
     json = request.args
     if json is None:
@@ -1582,6 +1803,7 @@ def volleyballAthleteStatistics():
 
 
 @app.route("/results/volleyball/individual/public/", methods=['GET'])
+@readReplica
 def getVolleyballAthleteStatistics():
     json = request.args
     if json is None:
@@ -1671,6 +1893,7 @@ def volleyballTeamStatistics():
 
 
 @app.route("/results/volleyball/team/public/", methods=['GET'])
+@readReplica
 def getVolleyballTeamStatistics():
     json = request.args
     if json is None:
@@ -1742,6 +1965,7 @@ def volleyballFinalScores():
 
 
 @app.route("/results/volleyball/score/public/", methods=['GET'])
+@readReplica
 def getVolleyballFinalScores():
     json = request.args
     if json is None:
@@ -1967,6 +2191,7 @@ def soccerStatistics():
 
 
 @app.route("/results/soccer/public/", methods=['GET'])
+@readReplica
 def getSoccerStatistics():
     json = request.args
     if json is None:
@@ -2047,6 +2272,7 @@ def soccerAthleteStatistics():
 
 
 @app.route("/results/soccer/individual/public/", methods=['GET'])
+@readReplica
 def getSoccerAthleteStatistics():
     json = request.args
     if json is None:
@@ -2132,6 +2358,7 @@ def soccerTeamStatistics():
 
 
 @app.route("/results/soccer/team/public/", methods=['GET'])
+@readReplica
 def getSoccerTeamStatistics():
     json = request.args
     if json is None:
@@ -2204,6 +2431,7 @@ def soccerFinalScores():
 
 
 @app.route("/results/soccer/score/public/", methods=['GET'])
+@readReplica
 def getSoccerFinalScores():
     json = request.args
     if json is None:
@@ -2435,6 +2663,7 @@ def baseballStatistics():
 
 
 @app.route("/results/baseball/public/", methods=['GET'])
+@readReplica
 def getBaseballStatistics():
     json = request.args
     if json is None:
@@ -2518,6 +2747,7 @@ def baseballAthleteStatistics():
 
 
 @app.route("/results/baseball/individual/public/", methods=['GET'])
+@readReplica
 def getBaseballAthleteStatistics():
     json = request.args
     if json is None:
@@ -2605,6 +2835,7 @@ def baseballTeamStatistics():
 
 
 @app.route("/results/baseball/team/public/", methods=['GET'])
+@readReplica
 def getBaseballTeamStatistics():
     json = request.args
     if json is None:
@@ -2676,6 +2907,7 @@ def baseballFinalScores():
 
 
 @app.route("/results/baseball/score/public/", methods=['GET'])
+@readReplica
 def getBaseballFinalScores():
     json = request.args
     if json is None:
@@ -2924,6 +3156,7 @@ def teamByYear():
         return jsonify(Error="Metodo no Permitido."), 405
 # V2 GET ONLY
 @app.route("/teams/public/", methods=['GET'])
+@readReplica
 def getTeamByYear():
     if request.method == 'GET':
         json = request.args
@@ -2983,6 +3216,7 @@ def teamMembers():
         return jsonify(Error="Metodo no Permitido."), 405
 # V2 GET ONLY
 @app.route("/teams/members/public/", methods=['GET'])
+@readReplica
 def getTeamMembers():
     if request.method == 'GET':
         json = request.args
@@ -3037,6 +3271,7 @@ def teamMemberByIDs():
         return jsonify(Error="Metodo no Permitido."), 405
 # V2 Get Only
 @app.route("/teams/member/public/", methods=['GET'])
+@readReplica
 def getTeamMemberByIDs():
     if request.method == 'GET':
         json = request.args
@@ -3072,6 +3307,7 @@ def getAllTeams():
 
 
 @app.route("/results/matchbased/public/", methods=['GET'])
+@readReplica
 def p_matchbasedStatistics():
     json = request.args
     if not json or 'event_id' not in json:
@@ -3109,6 +3345,7 @@ def matchbasedStatistics():
 
 
 @app.route("/results/matchbased/individual/public/", methods=['GET'])
+@readReplica
 def p_matchbasedAthleteStatistics():
     json = request.args
     if not json or 'event_id' not in json or 'athlete_id' not in json or "category_id" not in json:
@@ -3175,6 +3412,7 @@ def matchbasedAthleteStatistics():
 
 
 @app.route("/results/matchbased/team/public/", methods=['GET'])
+@readReplica
 def p_matchbasedTeamStatistics():
     json = request.args
 
@@ -3245,6 +3483,7 @@ def matchbasedTeamStatistics():
 
 
 @app.route("/results/matchbased/score/public/", methods=['GET'])
+@readReplica
 def p_matchbasedFinalScores():
     json = request.args
     if not json or 'event_id' not in json:
@@ -3377,6 +3616,7 @@ def matchbasedAggregateTeamStatistics():
 # =======================//MEDAL BASED RESULTS ROUTES//===============================
 # ===================================================================================
 @app.route("/results/medalbased/public/")
+@readReplica
 def p_medalbasedStatistics():
     json = request.args
     if not json or 'event_id' not in json:
@@ -3414,6 +3654,7 @@ def medalbasedStatistics():
 
 
 @app.route("/results/medalbased/individual/public/", methods=['GET'])
+@readReplica
 def p_medalbasedAthleteStatistics():
     json = request.args
     if not json or 'event_id' not in json or 'athlete_id' not in json or 'category_id' not in json:
@@ -3482,6 +3723,7 @@ def medalbasedAthleteStatistics():
 
 
 @app.route("/results/medalbased/team/public/", methods=['GET'])
+@readReplica
 def p_medalbasedTeamStatistics():
     json = request.args
     if not json or 'event_id' not in json or 'category_id' not in json:
@@ -3548,6 +3790,7 @@ def medalbasedTeamStatistics():
 
 
 @app.route("/results/medalbased/score/public/", methods=['GET'])
+@readReplica
 def p_medalbasedFinalScores():
     json = request.args
 
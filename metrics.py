@@ -0,0 +1,295 @@
+"""
+Per-route request metrics exposed in the Prometheus text format.
+
+Request hooks record, for every route and method, a latency histogram with logarithmic buckets, the
+count of each response status and the amount of requests in flight. Recording a request takes a lock,
+a bisect over the bucket bounds and a few increments.
+
+Each process keeps its own metrics. When METRICS_MULTIPROC_DIR is set, as with prefork servers, every
+process also writes its metrics to a file in that directory from a background thread, once per second
+while they change, and the /metrics route of any worker merges the files of all of them. The file of a
+worker that exited is merged into a file aggregating every dead worker, when it exits or, if it was
+killed, by the next /metrics request, so its counters survive a new worker reusing its PID.
+"""
+import atexit
+import bisect
+import fcntl
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from flask import g, request
+
+#Histogram bucket upper bounds in seconds, two per power of two from 0.125 ms to 128 s, which bounds
+#the relative error of a percentile read from the histogram to about 41%.
+BUCKET_BOUNDS = [0.000125 * 2 ** (index / 2) for index in range(41)]
+
+FLUSH_INTERVAL = 1.0
+
+#Metrics of the workers that exited, merged, out of the metrics_*.json pattern of the live ones
+DEAD_WORKERS_FILE = 'dead_workers.json'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #Serializes the flushes of the flusher thread and the requests, so an older snapshot never wins
+        self.flushLock = threading.Lock()
+        self.histograms = {}
+        self.statuses = {}
+        self.inFlight = {}
+        self.directory = os.getenv('METRICS_MULTIPROC_DIR')
+        self.changed = False
+        self.flusherPID = None
+
+    def register(self, app):
+        """
+        Summary:
+            Installs the request hooks that record the metrics of every request of the app.
+        """
+        app.before_request(self._beforeRequest)
+        app.after_request(self._afterRequest)
+        app.teardown_request(self._teardownRequest)
+
+    def _key(self):
+        rule = request.url_rule
+        return (rule.rule if rule is not None else '<unmatched>', request.method)
+
+    def _beforeRequest(self):
+        if self.directory and self.flusherPID != os.getpid():
+            self._startFlusher()
+        key = self._key()
+        g.metricsKey = key
+        g.metricsStart = time.perf_counter()
+        g.metricsRecorded = False
+        with self.lock:
+            self.inFlight[key] = self.inFlight.get(key, 0) + 1
+            self.changed = True
+
+    def _afterRequest(self, response):
+        if 'metricsStart' in g:
+            self._record(g.metricsKey, time.perf_counter() - g.metricsStart, response.status_code)
+            g.metricsRecorded = True
+        return response
+
+    def _teardownRequest(self, exception):
+        if 'metricsStart' not in g:
+            return
+        key = g.metricsKey
+        #Unhandled exceptions skip the after request hooks and end as a 500
+        if not g.metricsRecorded:
+            self._record(key, time.perf_counter() - g.metricsStart, 500)
+        with self.lock:
+            self.inFlight[key] -= 1
+            self.changed = True
+
+    def _record(self, key, duration, status):
+        bucket = bisect.bisect_left(BUCKET_BOUNDS, duration)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                #One count per bucket, then the overflow bucket and the sum of durations
+                histogram = self.histograms[key] = [0] * (len(BUCKET_BOUNDS) + 1) + [0.0]
+            histogram[bucket] += 1
+            histogram[-1] += duration
+            statusKey = key + (status,)
+            self.statuses[statusKey] = self.statuses.get(statusKey, 0) + 1
+            self.changed = True
+
+    def _snapshot(self):
+        with self.lock:
+            self.changed = False
+            return {
+                'pid': os.getpid(),
+                'histograms': [[list(key), list(values)] for key, values in self.histograms.items()],
+                'statuses': [[list(key), count] for key, count in self.statuses.items()],
+                'in_flight': [[list(key), count] for key, count in self.inFlight.items()],
+            }
+
+    def flush(self):
+        """
+        Summary:
+            Writes the metrics of this process to the multiprocess directory, replacing its previous file.
+        """
+        with self.flushLock:
+            _write(self._path(os.getpid()), self._snapshot())
+
+    def _path(self, pid):
+        return os.path.join(self.directory, 'metrics_{}.json'.format(pid))
+
+    def _startFlusher(self):
+        """
+        Summary:
+            Starts the thread flushing the metrics of this process, first merging into the dead workers the
+            file a previous process with the same PID left behind.
+        """
+        with self.lock:
+            #Threads do not survive the fork of a worker, every process flushes on its own
+            if self.flusherPID == os.getpid():
+                return
+            self.flusherPID = os.getpid()
+        self._retire(os.getpid(), force = True)
+        atexit.register(self._exit)
+        threading.Thread(target = self._runFlusher, name = 'metrics-flush', daemon = True).start()
+
+    def _runFlusher(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            #The file of an exiting process was already merged into the dead workers
+            if self.flusherPID != os.getpid():
+                return
+            if self.changed:
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+
+    def _exit(self):
+        if self.flusherPID != os.getpid():
+            return
+        self.flusherPID = None
+        self.flush()
+        self._retire(os.getpid(), force = True)
+
+    def _retire(self, pid, force = False):
+        """
+        Summary:
+            Merges the file of the given process into the metrics of the dead workers and removes it.
+
+        Params:
+            pid: the process the file belongs to.
+            force: whether to merge it even if a process with that PID is running, as when it is this one.
+        """
+        path = self._path(pid)
+        with open(os.path.join(self.directory, DEAD_WORKERS_FILE + '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            #A new process may have taken the PID since it was found dead
+            if not force and _isAlive(pid):
+                return
+            snapshot = _read(path)
+            if snapshot is None:
+                return
+            deadPath = os.path.join(self.directory, DEAD_WORKERS_FILE)
+            dead = _read(deadPath) or {'pid': None, 'histograms': [], 'statuses': [], 'in_flight': []}
+            histograms, statuses, _ = _merge([dead, snapshot])
+            _write(deadPath, {
+                'pid': None,
+                'histograms': [[list(key), values] for key, values in histograms.items()],
+                'statuses': [[list(key), count] for key, count in statuses.items()],
+                'in_flight': [],
+            })
+            os.remove(path)
+
+    def _collect(self):
+        """
+        Summary:
+            Returns the snapshots of every process, or only of this one without a multiprocess directory.
+        """
+        if not self.directory:
+            return [self._snapshot()]
+
+        self.flush()
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+            snapshot = _read(path)
+            #Workers killed before merging their own file
+            if snapshot is not None and not _isAlive(snapshot['pid']):
+                self._retire(snapshot['pid'])
+
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.json')) + [os.path.join(self.directory, DEAD_WORKERS_FILE)]:
+            snapshot = _read(path)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        return snapshots
+
+    def render(self):
+        """
+        Summary:
+            Returns the merged metrics of every process in the Prometheus text exposition format.
+        """
+        histograms, statuses, inFlight = _merge(self._collect())
+
+        lines = [
+            '# HELP http_request_duration_seconds Latency of the requests by route and method.',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        for (route, method), values in sorted(histograms.items()):
+            labels = 'route="{}",method="{}"'.format(_escape(route), _escape(method))
+            cumulative = 0
+            for bound, count in zip(BUCKET_BOUNDS, values):
+                cumulative += count
+                lines.append('http_request_duration_seconds_bucket{{{},le="{:.6g}"}} {}'.format(labels, bound, cumulative))
+            cumulative += values[len(BUCKET_BOUNDS)]
+            lines.append('http_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, cumulative))
+            lines.append('http_request_duration_seconds_sum{{{}}} {:.6f}'.format(labels, values[-1]))
+            lines.append('http_request_duration_seconds_count{{{}}} {}'.format(labels, cumulative))
+
+        lines.append('# HELP http_requests_total Requests by route, method and response status.')
+        lines.append('# TYPE http_requests_total counter')
+        for (route, method, status), count in sorted(statuses.items()):
+            lines.append('http_requests_total{{route="{}",method="{}",status="{}"}} {}'.format(
+                _escape(route), _escape(method), status, count))
+
+        lines.append('# HELP http_requests_in_flight Requests being handled by route and method.')
+        lines.append('# TYPE http_requests_in_flight gauge')
+        for (route, method), count in sorted(inFlight.items()):
+            lines.append('http_requests_in_flight{{route="{}",method="{}"}} {}'.format(_escape(route), _escape(method), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _merge(snapshots):
+    """
+    Summary:
+        Adds up the histograms, status counts and requests in flight of the given snapshots.
+    """
+    histograms = {}
+    statuses = {}
+    inFlight = {}
+    for snapshot in snapshots:
+        for key, values in snapshot['histograms']:
+            merged = histograms.setdefault(tuple(key), [0] * len(values))
+            for index, value in enumerate(values):
+                merged[index] += value
+        for key, count in snapshot['statuses']:
+            statuses[tuple(key)] = statuses.get(tuple(key), 0) + count
+        for key, count in snapshot['in_flight']:
+            inFlight[tuple(key)] = inFlight.get(tuple(key), 0) + count
+    return histograms, statuses, inFlight
+
+
+def _read(path):
+    try:
+        with open(path) as source:
+            return json.load(source)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, snapshot):
+    #Readers never see a partially written file, and every writer has its own temporary file
+    descriptor, temporaryPath = tempfile.mkstemp(dir = os.path.dirname(path), prefix = os.path.basename(path) + '.', suffix = '.tmp')
+    try:
+        with os.fdopen(descriptor, 'w') as output:
+            json.dump(snapshot, output)
+        os.replace(temporaryPath, path)
+    except BaseException:
+        os.unlink(temporaryPath)
+        raise
+
+
+def _isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
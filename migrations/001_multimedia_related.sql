@@ -0,0 +1,11 @@
+-- Precomputed related multimedia posts.
+-- Filled by the related multimedia job (python -m handler.related_multimedia) so that
+-- GET /multimedia/<mid>/related is a single primary key range lookup.
+
+create table if not exists multimedia_related (
+    mid integer not null references multimedia (mid),
+    rank smallint not null,
+    related_mid integer not null references multimedia (mid),
+    score real not null,
+    primary key (mid, rank)
+);
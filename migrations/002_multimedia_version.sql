@@ -0,0 +1,18 @@
+-- Edit history of multimedia posts.
+-- Each row holds either a zlib compressed full snapshot of the content or a zlib compressed
+-- delta against the previous version. A snapshot is stored every few versions so any version
+-- is rebuilt from a bounded amount of rows.
+
+create table if not exists multimedia_version (
+    mid integer not null references multimedia (mid),
+    version integer not null,
+    is_snapshot boolean not null,
+    title varchar(300) not null,
+    data bytea not null,
+    date_edited timestamp not null default current_timestamp,
+    primary key (mid, version)
+);
+
+create index if not exists multimedia_version_snapshot_idx
+    on multimedia_version (mid, version)
+    where is_snapshot;
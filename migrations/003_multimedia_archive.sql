@@ -0,0 +1,25 @@
+-- Archival of soft deleted multimedia posts.
+-- removeMultimedia records when a post was invalidated, and the compaction job
+-- (python -m handler.multimedia_compaction) moves posts invalid for longer than the
+-- retention window from multimedia into multimedia_archive, from where they can be restored.
+
+alter table multimedia add column if not exists date_invalidated timestamp;
+
+-- Posts removed before the column existed start their retention window now.
+update multimedia
+set date_invalidated = current_timestamp
+where is_invalid = true
+and date_invalidated is null;
+
+create index if not exists multimedia_invalidated_idx
+    on multimedia (date_invalidated)
+    where is_invalid = true;
+
+create table if not exists multimedia_archive (
+    like multimedia,
+    date_archived timestamp not null default current_timestamp,
+    primary key (mid)
+);
+
+-- The edit history of archived posts is kept so it is still there after a restore.
+alter table multimedia_version drop constraint if exists multimedia_version_mid_fkey;
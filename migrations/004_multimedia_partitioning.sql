@@ -0,0 +1,61 @@
+-- Range partitioning of multimedia by date_published.
+-- Every month gets its own partition so queries bounded by date_published only touch the months
+-- they ask for, and old months stay untouched by new writes. create_multimedia_partitions creates
+-- the partitions ahead of time; it is called here and by the nightly compaction job
+-- (python -m handler.multimedia_compaction). Rows outside the created months land in the default
+-- partition so inserts never fail.
+--
+-- A primary key of a partitioned table has to include the partition key, so mid is only unique
+-- through its sequence and tables can no longer reference multimedia (mid) with a foreign key.
+
+begin;
+
+alter table multimedia rename to multimedia_unpartitioned;
+
+create table multimedia (
+    like multimedia_unpartitioned including defaults,
+    primary key (mid, date_published),
+    foreign key (duid) references dashboard_user (id)
+) partition by range (date_published);
+
+create table multimedia_default partition of multimedia default;
+
+create or replace function create_multimedia_partitions(from_month date default current_date, months_ahead integer default 3)
+returns integer as $$
+declare
+    partition_month date := date_trunc('month', from_month)::date;
+    last_month date := (date_trunc('month', current_date) + make_interval(months => months_ahead))::date;
+    partition_name text;
+    created integer := 0;
+begin
+    while partition_month <= last_month loop
+        partition_name := format('multimedia_%s', to_char(partition_month, 'YYYY_MM'));
+        if to_regclass(partition_name) is null then
+            execute format('create table if not exists %I partition of multimedia for values from (%L) to (%L)',
+                           partition_name, partition_month, (partition_month + interval '1 month')::date);
+            created := created + 1;
+        end if;
+        partition_month := (partition_month + interval '1 month')::date;
+    end loop;
+    return created;
+end;
+$$ language plpgsql;
+
+select create_multimedia_partitions(coalesce((select min(date_published) from multimedia_unpartitioned)::date, current_date));
+
+insert into multimedia
+select * from multimedia_unpartitioned;
+
+alter table multimedia_related drop constraint if exists multimedia_related_mid_fkey;
+alter table multimedia_related drop constraint if exists multimedia_related_related_mid_fkey;
+
+alter sequence multimedia_mid_seq owned by multimedia.mid;
+
+drop table multimedia_unpartitioned;
+
+create index multimedia_mid_idx on multimedia (mid);
+create index multimedia_duid_idx on multimedia (duid) where is_invalid = false;
+create index multimedia_type_idx on multimedia (type) where is_invalid = false;
+create index multimedia_invalidated_idx on multimedia (date_invalidated) where is_invalid = true;
+
+commit;
@@ -1,9 +1,46 @@
 from flask import jsonify
+from werkzeug.http import parse_etags
+import datetime
+import hashlib
+import json
+import logging
+import os
 from .dao.multimedia_dao import MultimediaDAO
+from .dao.multimedia_sqlite_dao import MultimediaSQLiteDAO
 from .dao.user_dao import UserDAO
+from .multimedia_duplicates import duplicateIndex
+from .multimedia_versions import isSnapshotVersion, encodeSnapshot, encodeDelta, reconstructVersion
+
+logger = logging.getLogger(__name__)
+
+#Errors of the public read routes, answered by both the Flask and the ASGI apps
+ALL_MULTIMEDIA_ERROR = "Ocurrió un error interno buscando todas las publicaciones multimedia."
+MULTIMEDIA_BY_ID_ERROR = "Ocurrió un error interno buscando una publicación multimedia por su identificador."
+RELATED_MULTIMEDIA_ERROR = "Ocurrió un error interno buscando las publicaciones multimedia relacionadas."
+MULTIMEDIA_BY_TYPE_ERROR = "Occurrió un error interno buscando publicaciones del tipo de multimedia dado."
+MULTIMEDIA_ARCHIVE_ERROR = "Ocurrió un error interno buscando las publicaciones multimedia del mes dado."
+
+#Seconds caches keep the archive of a month that already ended before revalidating it, old posts can
+#still be edited or removed
+ARCHIVE_MAX_AGE = int(os.getenv('ARCHIVE_MAX_AGE', '3600'))
 
 class MultimediaHandler:
+
+    #DAO classes used by the handler. The benchmarks replace them with the in-memory DAOs.
+    multimediaDAO = MultimediaDAO
+    userDAO = UserDAO
     
+    def _readDAO(self):
+        """
+        Summary:
+            Returns the DAO used by the read-only multimedia routes. Edge nodes configured with
+            MULTIMEDIA_BACKEND=sqlite read from their local SQLite snapshot instead of Postgres.
+        """
+
+        if os.getenv('MULTIMEDIA_BACKEND') == 'sqlite':
+            return MultimediaSQLiteDAO()
+        return self.multimediaDAO()
+
     def mapMultimediaToDict(self, record):
         """
         Summary:
@@ -43,7 +80,7 @@ class MultimediaHandler:
         if isinstance(validationResult, str):
             return jsonify(Error = validationResult), 400
 
-        dao = MultimediaDAO()
+        dao = self.multimediaDAO()
 
         try:
             #Add multimedia post using DAO
@@ -55,9 +92,16 @@ class MultimediaHandler:
 
             #Convert multimedia post record into a dictionary
             mappedResult = self.mapMultimediaToDict(multimedia)
+
+            #Index the new multimedia post and warn about near-duplicates already published
+            duplicates = duplicateIndex.add(mappedResult['mid'], mappedResult['title'], mappedResult['content'])
+            if duplicates:
+                mappedDuplicates = [{'mid': mid, 'similarity': similarity} for mid, similarity in duplicates]
+                return jsonify(Multimedia = mappedResult, Duplicates = mappedDuplicates,
+                    Warning = "La publicación multimedia es muy similar a otras publicaciones existentes."), 201
             return jsonify(Multimedia = mappedResult), 201
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception("Error in MultimediaHandler.addMultimedia")
             dao._closeConnection()
             return jsonify(Error = "Ocurrió un error interno tratando de añadir una nueva publicación multimedia."), 500
 
@@ -72,24 +116,17 @@ class MultimediaHandler:
             A JSON object containing all valid multimedia posts and their information.
         """
     
-        dao = MultimediaDAO()
+        dao = self._readDAO()
         
         try:
             #Get all multimedia posts using DAO
             result = dao.getAllMultimedia()
             dao._closeConnection()
-            if not result:
-                return jsonify(Error = "Ninguna publicación multimedia fue encontrada."), 404
-
-            #Convert multimedia post records into a list of dictionaries
-            mappedResult = []
-            for multimedia in result:
-                mappedResult.append(self.mapMultimediaToDict(multimedia))
-            return jsonify(Multimedias = mappedResult), 200
-        except Exception as e:
-            print(e)
+            return self._respond(self._allMultimediaResult(result))
+        except Exception:
+            logger.exception("Error in MultimediaHandler.getAllMultimedia")
             dao._closeConnection()
-            return jsonify(Error = "Ocurrió un error interno buscando todas las publicaciones multimedia."), 500
+            return self._respond(self._internalError(ALL_MULTIMEDIA_ERROR))
 
     def getMultimediaByID(self, mID):
         """
@@ -106,28 +143,52 @@ class MultimediaHandler:
         """
 
         #Validate multimedia post id is an intenger greater than 0
-        if not isinstance(mID, int) or mID < 1:
-            return jsonify(Error = "El identificador de la publicación multimedia no es válido."), 400
+        invalid = self._validateMultimediaID(mID)
+        if invalid is not None:
+            return self._respond(invalid)
         
-        dao = MultimediaDAO()
+        dao = self._readDAO()
         
         try:
-            #Check if multimedia post with given id exists
-            if not dao.multimediaExists(mID):
-                dao._closeConnection()
-                return jsonify(Error = "No existe una publicación multimedia con el identificador: {}".format(mID)), 404
-
-            #Get multimedia post given its id using DAO
+            #Get multimedia post given its id using DAO, None if there is no valid one
             multimedia = dao.getMultimediaByID(mID)
             dao._closeConnection()
+            return self._respond(self._multimediaByIDResult(mID, multimedia))
+        except Exception:
+            logger.exception("Error in MultimediaHandler.getMultimediaByID")
+            dao._closeConnection()
+            return self._respond(self._internalError(MULTIMEDIA_BY_ID_ERROR))
 
-            #Convert multimedia post record into a dictionary
-            mappedResult = self.mapMultimediaToDict(multimedia)
-            return jsonify(Multimedia = mappedResult), 200
-        except Exception as e:
-            print(e)
+    def getRelatedMultimedia(self, mID):
+        """
+        Summary:
+            Gets the list of precomputed related multimedia posts of the multimedia post with the given id
+            that are valid in the database and maps the result to a JSON object containing their information.
+            The JSON objects is then returned or an error if otherwise.
+
+        Params:
+            mID: the id of the multimedia post whose related posts are fetched.
+
+        Returns:
+            A JSON object containing the valid related multimedia posts and their information.
+        """
+
+        #Validate multimedia post id is an intenger greater than 0
+        invalid = self._validateMultimediaID(mID)
+        if invalid is not None:
+            return self._respond(invalid)
+
+        dao = self._readDAO()
+
+        try:
+            #Get precomputed related multimedia posts using DAO, None if the multimedia post does not exist
+            result = dao.getRelatedMultimedia(mID)
             dao._closeConnection()
-            return jsonify(Error = "Ocurrió un error interno buscando una publicación multimedia por su identificador."), 500
+            return self._respond(self._relatedMultimediaResult(mID, result))
+        except Exception:
+            logger.exception("Error in MultimediaHandler.getRelatedMultimedia")
+            dao._closeConnection()
+            return self._respond(self._internalError(RELATED_MULTIMEDIA_ERROR))
 
     def getMultimediaByType(self, mType):
         """
@@ -144,27 +205,187 @@ class MultimediaHandler:
         """
 
         #Validate that the type of multimedia exists
-        if not (mType == 'text' or mType == 'image' or mType == 'video' or mType == 'livestream'): 
-            return jsonify(Error = "El identificador del tipo de multimedia dado no es válido."), 400
+        invalid = self._validateMultimediaType(mType)
+        if invalid is not None:
+            return self._respond(invalid)
         
-        dao = MultimediaDAO()
+        dao = self._readDAO()
         
         try:  
             #Get multimedia post given its type using DAO
             result = dao.getMultimediaByType(mType) 
             dao._closeConnection()
-            if not result:
-                return jsonify(Error = "Ninguna publicación del tipo de multimedia dado fue encontrada."), 404
+            return self._respond(self._multimediaByTypeResult(result))
+        except Exception:
+            logger.exception("Error in MultimediaHandler.getMultimediaByType")
+            dao._closeConnection()
+            return self._respond(self._internalError(MULTIMEDIA_BY_TYPE_ERROR))
 
-            #Convert multimedia post records of the given type into a list of dictionaries
-            mappedResult = []
-            for multimedia in result:
-                mappedResult.append(self.mapMultimediaToDict(multimedia))
-            return jsonify(Multimedias = mappedResult), 200        
-        except Exception as e:
-            print(e)
+    def getMultimediaArchive(self, year, month, ifNoneMatch = None):
+        """
+        Summary:
+            Gets a list of multimedia posts published in the given month that are valid in the database and
+            maps the result to a JSON object containing their information. Months that already ended no longer
+            receive new posts, so their response is cacheable for ARCHIVE_MAX_AGE seconds, and every response
+            carries an ETag so caches revalidate it with an empty 304 while it did not change. The JSON objects
+            is then returned or an error if otherwise.
+
+        Params:
+            year: the year of the month, e.g. 2021.
+            month: the number of the month, from 1 to 12.
+            ifNoneMatch: the If-None-Match header of the request, if any.
+
+        Returns:
+            A JSON object containing all valid multimedia posts and their information published in the given month.
+        """
+
+        #Validate year and month form a valid month
+        archiveMonth = self._archiveMonth(year, month)
+        if archiveMonth is None:
+            return self._respond(self._invalidMonth())
+        start, end, headers = archiveMonth
+
+        dao = self._readDAO()
+
+        try:
+            #Get multimedia posts published in the month using DAO
+            result = dao.getMultimediaByMonth(start, end)
+            dao._closeConnection()
+            return self._respond(self._multimediaArchiveResult(result, headers, ifNoneMatch))
+        except Exception:
+            logger.exception("Error in MultimediaHandler.getMultimediaArchive")
             dao._closeConnection()
-            return jsonify(Error = "Occurrió un error interno buscando publicaciones del tipo de multimedia dado."), 500
+            return self._respond(self._internalError(MULTIMEDIA_ARCHIVE_ERROR))
+
+    def _archiveMonth(self, year, month):
+        """
+        Summary:
+            Returns the bounds of the given month and the cache headers of its archive, or None if the year
+            and month do not form a valid month. The bounds are in UTC, as the publication dates are stored.
+        """
+
+        if not isinstance(year, int) or not isinstance(month, int) or year < 1 or month < 1 or month > 12:
+            return None
+        #The end of December of the last year datetime supports would fall in the year after it
+        if year > datetime.MAXYEAR or (year == datetime.MAXYEAR and month == 12):
+            return None
+
+        start = datetime.datetime(year, month, 1)
+        end = datetime.datetime(year + 1, 1, 1) if month == 12 else datetime.datetime(year, month + 1, 1)
+
+        #Past months only change when an old post is edited or removed, while the current month can still
+        #receive posts
+        if end <= datetime.datetime.now(datetime.timezone.utc).replace(tzinfo = None):
+            headers = {'Cache-Control': 'public, max-age={}'.format(ARCHIVE_MAX_AGE)}
+        else:
+            headers = {'Cache-Control': 'public, max-age=60'}
+        return start, end, headers
+
+    #Validations and results of the public read routes. They return the body, status and optional headers
+    #of the response instead of a Flask response, so the Flask app and the AsyncMultimediaHandler of the
+    #ASGI app answer the same.
+
+    def _respond(self, result):
+        """
+        Summary:
+            Converts a (body, status[, headers]) result into the response returned by the Flask routes, with
+            an empty body when the body is None.
+        """
+        if result[0] is None:
+            return ('',) + tuple(result[1:])
+        return (jsonify(**result[0]),) + tuple(result[1:])
+
+    def _internalError(self, message):
+        return {'Error': message}, 500
+
+    def _mapMultimediaList(self, result):
+        return [self.mapMultimediaToDict(multimedia) for multimedia in result]
+
+    def _validateMultimediaID(self, mID):
+        """
+        Summary:
+            Returns the error result of an invalid multimedia post id, or None if it is an integer greater than 0.
+        """
+        if not isinstance(mID, int) or mID < 1:
+            return {'Error': "El identificador de la publicación multimedia no es válido."}, 400
+        return None
+
+    def _validateMultimediaType(self, mType):
+        """
+        Summary:
+            Returns the error result of an unknown type of multimedia, or None if the type exists.
+        """
+        if not (mType == 'text' or mType == 'image' or mType == 'video' or mType == 'livestream'):
+            return {'Error': "El identificador del tipo de multimedia dado no es válido."}, 400
+        return None
+
+    def _invalidMonth(self):
+        return {'Error': "El mes dado no es válido."}, 400
+
+    def _multimediaNotFound(self, mID):
+        return {'Error': "No existe una publicación multimedia con el identificador: {}".format(mID)}, 404
+
+    def _allMultimediaResult(self, result):
+        """
+        Summary:
+            Returns the result of the list of all multimedia posts returned by the DAO, which is an error
+            string if it failed.
+        """
+        if isinstance(result, str):
+            return self._internalError(ALL_MULTIMEDIA_ERROR)
+        if not result:
+            return {'Error': "Ninguna publicación multimedia fue encontrada."}, 404
+        return {'Multimedias': self._mapMultimediaList(result)}, 200
+
+    def _multimediaByIDResult(self, mID, multimedia):
+        """
+        Summary:
+            Returns the result of the multimedia post with the given id returned by the DAO, None if there is
+            no valid one.
+        """
+        if isinstance(multimedia, str):
+            return self._internalError(MULTIMEDIA_BY_ID_ERROR)
+        if multimedia is None:
+            return self._multimediaNotFound(mID)
+        return {'Multimedia': self.mapMultimediaToDict(multimedia)}, 200
+
+    def _relatedMultimediaResult(self, mID, result):
+        """
+        Summary:
+            Returns the result of the related multimedia posts of the multimedia post with the given id
+            returned by the DAO, None if there is no valid multimedia post with the id.
+        """
+        if isinstance(result, str):
+            return self._internalError(RELATED_MULTIMEDIA_ERROR)
+        if result is None:
+            return self._multimediaNotFound(mID)
+        return {'Multimedias': self._mapMultimediaList(result)}, 200
+
+    def _multimediaByTypeResult(self, result):
+        """
+        Summary:
+            Returns the result of the multimedia posts of a type returned by the DAO.
+        """
+        if isinstance(result, str):
+            return self._internalError(MULTIMEDIA_BY_TYPE_ERROR)
+        if not result:
+            return {'Error': "Ninguna publicación del tipo de multimedia dado fue encontrada."}, 404
+        return {'Multimedias': self._mapMultimediaList(result)}, 200
+
+    def _multimediaArchiveResult(self, result, headers, ifNoneMatch = None):
+        """
+        Summary:
+            Returns the result of the multimedia posts of a month returned by the DAO, with the cache headers
+            of the month and an ETag of its posts, or an empty 304 if the ETag matches ifNoneMatch.
+        """
+        if isinstance(result, str):
+            return self._internalError(MULTIMEDIA_ARCHIVE_ERROR)
+        body = {'Multimedias': self._mapMultimediaList(result)}
+        etag = hashlib.sha256(json.dumps(body, default = str, sort_keys = True).encode('utf-8')).hexdigest()[:32]
+        headers = dict(headers, ETag = '"{}"'.format(etag))
+        if ifNoneMatch and parse_etags(ifNoneMatch).contains_weak(etag):
+            return None, 304, headers
+        return body, 200, headers
 
     def getMultimediaByAuthor(self, duid):
         """
@@ -180,14 +401,17 @@ class MultimediaHandler:
             A JSON object containing all valid multimedia posts and their information authored by the dashboard user with the given id.        
         """
 
-        user_dao = UserDAO()
-        dao = MultimediaDAO()
-        
+        #Check dashboard user with given id exists
         try:
-            #Check dashboard user with given id exists
-            if not user_dao.getDashUserByID(duid):
+            if not self._authorExists(duid):
                 return jsonify(Error = "El identificador del autor de la publicación multimedia dado no es válido."), 400
+        except Exception:
+            logger.exception("Error in MultimediaHandler.getMultimediaByAuthor")
+            return jsonify(Error = "Occurrió un error interno buscando publicaciones de multimedia del autor dado."), 500
 
+        dao = self.multimediaDAO()
+        
+        try:
             #Get multimedia posts by author using DAO
             result = dao.getMultimediaByAuthor(duid) 
             dao._closeConnection()
@@ -199,8 +423,8 @@ class MultimediaHandler:
             for multimedia in result:
                 mappedResult.append(self.mapMultimediaToDict(multimedia))
             return jsonify(Multimedias = mappedResult), 200        
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception("Error in MultimediaHandler.getMultimediaByAuthor")
             dao._closeConnection()
             return jsonify(Error = "Occurrió un error interno buscando publicaciones de multimedia del autor dado."), 500
 
@@ -228,29 +452,91 @@ class MultimediaHandler:
         if isinstance(validationResult, str):
             return jsonify(Error = validationResult), 400
 
-        dao = MultimediaDAO()
+        dao = self.multimediaDAO()
         
         try:
-            #Check if multimedia post with given id exists
-            if not dao.multimediaExists(mID):
+            #Check if multimedia post with given id exists, reading its current version along
+            previous = dao.getMultimediaForEdit(mID)
+            if not previous:
                 dao._closeConnection()
                 return jsonify(Error = "No existe una publicación multimedia con identificador: {}".format(mID)), 404
 
-            #Edit multimedia post using DAO
-            result = dao.editMultimedia(mID, attributes['title'], attributes['content'])
-
-            #Fetch newly updated multimedia post by its id to return
-            multimedia = dao.getMultimediaByID(result)
+            #Store the new version in the edit history and edit multimedia post using DAO in one round trip
+            versions = self._multimediaVersions(previous, attributes['title'], attributes['content'])
+            multimedia = dao.editMultimediaWithVersions(mID, attributes['title'], attributes['content'], versions)
             dao._closeConnection()
+            if isinstance(multimedia, str):
+                return jsonify(Error = "Ocurrió un error interno editando una publicación multimedia existente."), 500
 
             #Convert multimedia post record into a dictionary
             mappedResult = self.mapMultimediaToDict(multimedia)
+
+            #Keep the near-duplicate index in sync with the edited content
+            duplicateIndex.add(mappedResult['mid'], mappedResult['title'], mappedResult['content'])
             return jsonify(Multimedia = mappedResult), 200
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception("Error in MultimediaHandler.editMultimedia")
             dao._closeConnection()
             return jsonify(Error = "Ocurrió un error interno editando una publicación multimedia existente."), 500
     
+    def getMultimediaVersion(self, mID, version):
+        """
+        Summary:
+            Rebuilds the given version of the multimedia post with the given id from its edit history and
+            maps the result to a JSON object containing its information. The JSON objects is then returned
+            or an error if otherwise.
+
+        Params:
+            mID: the id of the multimedia post.
+            version: the number of the version to fetch, the first version being 1.
+
+        Returns:
+            A JSON object containing the title and content of the multimedia post in the given version.
+        """
+
+        #Validate multimedia post id is an intenger greater than 0
+        if not isinstance(mID, int) or mID < 1:
+            return jsonify(Error = "El identificador de la publicación multimedia dado no es válido."), 400
+
+        #Validate version is an intenger greater than 0
+        if not isinstance(version, int) or version < 1:
+            return jsonify(Error = "La versión de la publicación multimedia dada no es válida."), 400
+
+        dao = self.multimediaDAO()
+
+        try:
+            #Check if multimedia post with given id exists
+            if not dao.multimediaExists(mID):
+                dao._closeConnection()
+                return jsonify(Error = "No existe una publicación multimedia con identificador: {}".format(mID)), 404
+
+            #Get the snapshot and deltas needed to rebuild the version using DAO
+            rows = dao.getMultimediaVersionChain(mID, version)
+            if isinstance(rows, str):
+                dao._closeConnection()
+                return jsonify(Error = "Ocurrió un error interno buscando una versión de una publicación multimedia."), 500
+
+            #Multimedia posts that were never edited only have their current version
+            if not rows and version == 1 and dao.getLatestMultimediaVersion(mID) == 0:
+                multimedia = dao.getMultimediaByID(mID)
+                if isinstance(multimedia, str):
+                    dao._closeConnection()
+                    return jsonify(Error = "Ocurrió un error interno buscando una versión de una publicación multimedia."), 500
+                rows = [(1, True, multimedia[1], encodeSnapshot(multimedia[2]), multimedia[4])]
+            dao._closeConnection()
+
+            if not rows or rows[-1][0] != version:
+                return jsonify(Error = "No existe la versión {} de la publicación multimedia con identificador: {}".format(version, mID)), 404
+
+            #Convert the rebuilt version into a dictionary
+            version, title, content, dateEdited = reconstructVersion(rows)
+            mappedResult = {'mid': mID, 'version': version, 'title': title, 'content': content, 'date_edited': dateEdited}
+            return jsonify(MultimediaVersion = mappedResult), 200
+        except Exception:
+            logger.exception("Error in MultimediaHandler.getMultimediaVersion")
+            dao._closeConnection()
+            return jsonify(Error = "Ocurrió un error interno buscando una versión de una publicación multimedia."), 500
+
     def removeMultimedia(self, mID):
         """
         Summary:
@@ -268,7 +554,7 @@ class MultimediaHandler:
         if not isinstance(mID, int) or mID < 1:
             return jsonify(Error = "El identificador de la publicación multimedia dado no es válido."), 400
 
-        dao = MultimediaDAO()
+        dao = self.multimediaDAO()
         
         try:
             #Check if multimedia post with given id exists
@@ -279,14 +565,57 @@ class MultimediaHandler:
             #Remove multimedia post using DAO
             result = dao.removeMultimedia(mID)
             dao._closeConnection()
-            if not result:
+            if not result or isinstance(result, str):
                 return jsonify(Error = "Occurrió un error interno removiendo una publicación multimedia existente"), 500
+            duplicateIndex.remove(mID)
             return jsonify(Multimedia = "Se removió la publicación multimedia con identificador: {}".format(result)), 200
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception("Error in MultimediaHandler.removeMultimedia")
             dao._closeConnection()
             return jsonify(Error = "Ocurrió un error interno removiendo una publicación multimedia existente"), 500
 
+    def _multimediaVersions(self, previous, title, content):
+        """
+        Summary:
+            Returns the versions to add to the edit history of a multimedia post for an edit of its title and
+            content. The version is stored as a full snapshot every few versions and as a delta against the
+            current content otherwise. Multimedia posts without history first get their current content
+            stored as version 1.
+
+        Params:
+            previous: the multimedia post being edited followed by its latest version, as returned by
+                getMultimediaForEdit.
+            title: the new title of the multimedia post.
+            content: the new content of the multimedia post.
+
+        Returns:
+            A list of (version, isSnapshot, title, data, dateEdited) tuples.
+        """
+
+        versions = []
+        latest = previous[5]
+        if latest == 0:
+            versions.append((1, True, previous[1], encodeSnapshot(previous[2]), previous[4]))
+            latest = 1
+
+        version = latest + 1
+        if isSnapshotVersion(version):
+            versions.append((version, True, title, encodeSnapshot(content), None))
+        else:
+            versions.append((version, False, title, encodeDelta(previous[2], content), None))
+        return versions
+
+    def _authorExists(self, duid):
+        """
+        Summary:
+            Checks whether a dashboard user with the given id exists, closing the connection used to do so.
+        """
+        dao = self.userDAO()
+        try:
+            return bool(dao.getDashUserByID(duid))
+        finally:
+            dao._closeConnection()
+
     def _validateInsertAttributes(self,attributes):
         """
         Summary:
@@ -319,15 +648,14 @@ class MultimediaHandler:
 
             #Type can take the value of: text, image, video, or livestream. 
             if not mType or not (mType == 'text' or mType == 'image' or mType == 'video' or mType == 'livestream'): 
-                print(mType)
-               
+                logger.debug("Invalid multimedia type: %r", mType)
                 return "El identificador del tipo de multimedia dado no es válido."
 
             #Dashboard user id must be an integer greater than 0 and must correspond to a user    
-            if not duid or not isinstance(duid, int) or duid < 1 or not UserDAO().getDashUserByID(duid):
+            if not duid or not isinstance(duid, int) or duid < 1 or not self._authorExists(duid):
                 return "El identificador del autor de la publicación dado no es válido."
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception("Error in MultimediaHandler._validateInsertAttributes")
             return "Los argumentos dados no son válidos." 
         
         #If succesful return 1
@@ -361,8 +689,8 @@ class MultimediaHandler:
             if not content or not isinstance(content, str) or len(content) > 63206:
                 return "El contenido dado no es válido."
 
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception("Error in MultimediaHandler._validateUpdateAttributes")
             return "Los argumentos dados no son válidos." 
         
         #If succesful return 1
@@ -0,0 +1,102 @@
+"""
+Scheduled compaction job that archives soft deleted multimedia posts.
+
+Multimedia posts invalid for longer than the retention window are moved from the multimedia table
+into multimedia_archive in bounded batches, each committed on its own so locks are held briefly.
+The table is vacuumed afterwards so the space of the moved rows is reused by new rows, and the monthly
+partitions of the coming months are created ahead of time. A plain VACUUM keeps the files of the table
+at their size rather than returning the space to the operating system, so the job reports the bytes of
+the archived rows, the space made reusable, and not a change of the table size.
+
+Meant to run from cron on one node, for example nightly:
+    0 4 * * * python -m handler.multimedia_compaction --retention-days 30
+
+Archived multimedia posts are restored with:
+    python -m handler.multimedia_compaction --restore MID
+"""
+import argparse
+from .dao.multimedia_dao import MultimediaDAO
+
+DEFAULT_RETENTION_DAYS = 30
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_MAX_BATCHES = 1000
+DEFAULT_MONTHS_AHEAD = 3
+
+
+def compactMultimedia(retentionDays = DEFAULT_RETENTION_DAYS, batchSize = DEFAULT_BATCH_SIZE, maxBatches = DEFAULT_MAX_BATCHES):
+    """
+    Summary:
+        Archives the multimedia posts invalid for longer than the retention window batch by batch,
+        vacuums the multimedia table and creates its upcoming monthly partitions.
+
+    Params:
+        retentionDays: the amount of days a multimedia post stays invalid before it is archived.
+        batchSize: the maximum amount of multimedia posts moved per transaction.
+        maxBatches: the maximum amount of batches moved in one run.
+
+    Returns:
+        A dictionary with the amount of archived posts, the size of their rows and the amount of
+        partitions created, or an error message string otherwise.
+    """
+    dao = MultimediaDAO()
+
+    try:
+        archived = 0
+        archivedBytes = 0
+
+        for _ in range(maxBatches):
+            result = dao.archiveInvalidMultimedia(retentionDays, batchSize)
+            if isinstance(result, str):
+                return result
+
+            count, size = result
+            archived += count
+            archivedBytes += size
+            if count < batchSize:
+                break
+
+        if archived:
+            dao.vacuumMultimedia()
+
+        partitions = dao.createMultimediaPartitions(DEFAULT_MONTHS_AHEAD)
+
+        return {
+            'archived': archived,
+            'archived_bytes': archivedBytes,
+            'partitions_created': partitions,
+        }
+    finally:
+        dao._closeConnection()
+
+
+def restoreMultimedia(mID):
+    """
+    Summary:
+        Moves an archived multimedia post back into the multimedia table as a valid multimedia post.
+
+    Params:
+        mID: the id of the archived multimedia post.
+
+    Returns:
+        The id of the restored multimedia post, None if it was not archived, or an error message string otherwise.
+    """
+    dao = MultimediaDAO()
+
+    try:
+        return dao.restoreMultimedia(mID)
+    finally:
+        dao._closeConnection()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Archives multimedia posts removed longer than the retention window.")
+    parser.add_argument('--retention-days', type = int, default = DEFAULT_RETENTION_DAYS, help = "days a removed post is kept")
+    parser.add_argument('--batch-size', type = int, default = DEFAULT_BATCH_SIZE, help = "posts moved per transaction")
+    parser.add_argument('--max-batches', type = int, default = DEFAULT_MAX_BATCHES, help = "batches moved per run")
+    parser.add_argument('--restore', type = int, metavar = 'MID', help = "restore an archived multimedia post instead")
+    args = parser.parse_args()
+
+    if args.restore is not None:
+        print(restoreMultimedia(args.restore))
+    else:
+        print(compactMultimedia(args.retention_days, args.batch_size, args.max_batches))
@@ -1,6 +1,11 @@
 from .config.sqlconfig import db_config
+from .query_accounting import connect
 from flask import jsonify
+import logging
 import psycopg2
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
 
 class MultimediaDAO:
 
@@ -13,8 +18,8 @@ class MultimediaDAO:
         db_config['host']
         )
         
-        #Establish a connection with the relational database.
-        self.conn = psycopg2.connect(connection_url) 
+        #Establish a connection with the relational database, accounted to the current request.
+        self.conn = connect(connection_url)
 
     def addMultimedia(self, title, content, mType, duid):
         """
@@ -42,12 +47,13 @@ class MultimediaDAO:
         try:
             cursor.execute(query, (title, content, mType, duid,))       
             mID = cursor.fetchone()[0]
-            cursor.close()
             if not mID:
                 return "Occurrió un error interno tratando de añadir una publicación multimedia."       
-        except psycopg2.DatabaseError as e:
-            print(e)
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.addMultimedia")
             return "Occurrió un error interno tratando de añadir una publicación multimedia."
+        finally:
+            cursor.close()
         
         #Commits the changes done on the database after insertion
         try:
@@ -81,9 +87,11 @@ class MultimediaDAO:
             for row in cursor:
                 result.append(row)
             return result
-        except psycopg2.DatabaseError as e:
-            print(e)
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.getAllMultimedia")
             return "Ocurrió un error interno buscando todas las publicaciones multimedia."
+        finally:
+            cursor.close()
 
     def getMultimediaByID(self, mID):
         """
@@ -107,12 +115,14 @@ class MultimediaDAO:
                 """
         
         try:
-            cursor.execute(query,(mID,))
+            cursor.execute(query, (mID,), prepare = True)
             result = cursor.fetchone()
             return result
-        except psycopg2.DatabaseError as e:
-            print(e)
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.getMultimediaByID")
             return "Ocurrió un error interno buscando una publicación multimedia por su identificador."
+        finally:
+            cursor.close()
     
     def getMultimediaByType(self, mType):
         """
@@ -138,13 +148,53 @@ class MultimediaDAO:
         result = []
         
         try:
-            cursor.execute(query, (mType,))
+            cursor.execute(query, (mType,), prepare = True)
             for row in cursor:
                 result.append(row)
             return result
-        except psycopg2.DatabaseError as e:
-            print(e)
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.getMultimediaByType")
             return "Occurrió un error interno buscando publicaciones del tipo de multimedia dado."
+        finally:
+            cursor.close()
+
+    def getMultimediaByMonth(self, start, end):
+        """
+        Summary:
+            Returns a list of multimedia posts that are valid in the database with their corresponding information
+            and were published between the given dates. The bounds are compared directly against date_published
+            so only the partitions of the requested months are scanned.
+
+        Params:
+            start: the first date of the month, inclusive.
+            end: the first date of the following month, exclusive.
+
+        Returns:
+            A list containing all the valid multimedia posts with their information published in the given month.
+        """
+
+        cursor = self.conn.cursor()
+
+        query = """select mid, title, content, type, date_published
+                   from multimedia
+                   where date_published >= %s
+                   and date_published < %s
+                   and is_invalid = false
+                   order by date_published
+                """
+
+        result = []
+
+        try:
+            cursor.execute(query, (start, end,))
+            for row in cursor:
+                result.append(row)
+            return result
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.getMultimediaByMonth")
+            return "Ocurrió un error interno buscando las publicaciones multimedia del mes dado."
+        finally:
+            cursor.close()
 
     def getMultimediaByAuthor(self, duid):
         """
@@ -171,13 +221,15 @@ class MultimediaDAO:
         result = []
         
         try:
-            cursor.execute(query, (duid,))
+            cursor.execute(query, (duid,), prepare = True)
             for row in cursor:
                 result.append(row)
             return result
-        except psycopg2.DatabaseError as e:
-            print(e)
-            return "Occurrió un error interno buscando publicaciones de multimedia del autor dado." 
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.getMultimediaByAuthor")
+            return "Occurrió un error interno buscando publicaciones de multimedia del autor dado."
+        finally:
+            cursor.close()
 
     def editMultimedia(self, mID, title, content):
         """
@@ -212,9 +264,11 @@ class MultimediaDAO:
             result = cursor.fetchone()
             if not result:
                 return "Occurrió un error interno editando una publicación multimedia existente."
-        except Exception as e:
-            print(e)
-            return "Ocurrió un error interno editando una publicación multimedia existente."             
+        except Exception:
+            logger.exception("Error in MultimediaDAO.editMultimedia")
+            return "Ocurrió un error interno editando una publicación multimedia existente."
+        finally:
+            cursor.close()
         
         try:
             self._commitChanges()                  
@@ -224,6 +278,91 @@ class MultimediaDAO:
         #Return id of the newly updated multimedia post
         return result[0] 
     
+    def getMultimediaForEdit(self, mID):
+        """
+        Summary:
+            Returns a multimedia post that is valid in the database with the given id together with the number
+            of its latest stored version, so an edit checks its existence and reads what its edit history
+            needs in a single round trip. The row of the multimedia post stays locked until the transaction
+            ends, so concurrent edits of the same post number their versions one after the other.
+
+        Params:
+            mID: the id of the multimedia post to be edited.
+
+        Returns:
+            A list containing the information of the valid multimedia post followed by its latest version
+            number, 0 if it has no stored versions, or None if there is no such valid multimedia post.
+        """
+
+        cursor = self.conn.cursor()
+
+        query = """select M.mid, M.title, M.content, M.type, M.date_published,
+                          (select coalesce(max(V.version), 0) from multimedia_version as V where V.mid = M.mid)
+                   from multimedia as M
+                   where M.mid = %s
+                   and M.is_invalid = false
+                   for update of M
+                """
+
+        cursor.execute(query, (mID,), prepare = True)
+        result = cursor.fetchone()
+        cursor.close()
+        return result
+
+    def editMultimediaWithVersions(self, mID, title, content, versions):
+        """
+        Summary:
+            Stores the given versions in the edit history of a multimedia post, updates its title and content
+            and returns the updated multimedia post, sending every statement in a single round trip. The
+            changes are committed together.
+
+        Params:
+            mID: the id of the multimedia post to be updated.
+            title: the new title of the multimedia post.
+            content: the new content of the multimedia post.
+            versions: a list of (version, isSnapshot, title, data, dateEdited) tuples to store, where data
+                holds the full compressed content or a compressed delta and dateEdited defaults to the
+                current timestamp.
+
+        Returns:
+            A list containing the information of the updated multimedia post.
+        """
+
+        cursor = self.conn.cursor()
+
+        versionQuery = """insert into multimedia_version (mid, version, is_snapshot, title, data, date_edited)
+                          values (%s, %s, %s, %s, %s, coalesce(%s, current_timestamp))
+                       """
+
+        query = """update multimedia
+                   set title = %s,
+                       content = %s
+                   where mid = %s
+                   returning mid, title, content, type, date_published
+                """
+
+        statements = [(versionQuery, (mID, version, isSnapshot, versionTitle, psycopg2.Binary(data), dateEdited,))
+                      for version, isSnapshot, versionTitle, data, dateEdited in versions]
+        statements.append((query, (title, content, mID,)))
+
+        try:
+            cursor.executeBatch(statements)
+            result = cursor.fetchone()
+            if not result:
+                return "Occurrió un error interno editando una publicación multimedia existente."
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.editMultimediaWithVersions")
+            return "Ocurrió un error interno editando una publicación multimedia existente."
+        finally:
+            cursor.close()
+
+        try:
+            self._commitChanges()
+        except:
+            return "Ocurrió un error interno editando una publicación multimedia existente."
+
+        return result
+
     def removeMultimedia(self, mID):
         """
         Summary:
@@ -240,7 +379,8 @@ class MultimediaDAO:
         cursor = self.conn.cursor()
         
         query = """update multimedia
-                   set is_invalid = true
+                   set is_invalid = true,
+                       date_invalidated = current_timestamp
                    where mid = %s
                    returning mid;
                 """
@@ -252,9 +392,11 @@ class MultimediaDAO:
             result = cursor.fetchone()
             if not result:
                 return "Occurrió un error interno removiendo una publicación multimedia existente."
-        except Exception as e:
-            print(e)
-            return "Ocurrió un error interno removiendo una publicación multimedia existente."             
+        except Exception:
+            logger.exception("Error in MultimediaDAO.removeMultimedia")
+            return "Ocurrió un error interno removiendo una publicación multimedia existente."
+        finally:
+            cursor.close()
         
         try:
             self._commitChanges()                  
@@ -264,6 +406,391 @@ class MultimediaDAO:
         #Return id of the newly updated multimedia post
         return result[0] 
 
+    def getRelatedMultimedia(self, mID):
+        """
+        Summary:
+            Returns a list of the precomputed related multimedia posts of the multimedia post with the given id
+            that are valid in the database, ordered from most to least similar. The existence of the multimedia
+            post is checked by the same statement.
+
+        Params:
+            mID: the id of the multimedia post whose related posts are fetched.
+
+        Returns:
+            A list containing the valid related multimedia posts with their information, or None if there is
+            no valid multimedia post with the given id.
+        """
+
+        cursor = self.conn.cursor()
+
+        #The valid post always yields a row, with nulls when it has no valid related posts
+        query = """select M.mid, M.title, M.content, M.type, M.date_published
+                   from multimedia as P
+                   left join multimedia_related as R on R.mid = P.mid
+                   left join multimedia as M on M.mid = R.related_mid and M.is_invalid = false
+                   where P.mid = %s
+                   and P.is_invalid = false
+                   order by R.rank
+                """
+
+        try:
+            cursor.execute(query, (mID,), prepare = True)
+            rows = cursor.fetchall()
+            if not rows:
+                return None
+            return [row for row in rows if row[0] is not None]
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.getRelatedMultimedia")
+            return "Ocurrió un error interno buscando las publicaciones multimedia relacionadas."
+        finally:
+            cursor.close()
+
+    def getMultimediaRelatedTo(self, mIDs):
+        """
+        Summary:
+            Returns the ids of the multimedia posts whose stored related posts include any of the given ones.
+
+        Params:
+            mIDs: the ids of the related multimedia posts.
+
+        Returns:
+            A list of multimedia post ids, or an error message string otherwise.
+        """
+
+        cursor = self.conn.cursor()
+
+        query = """select distinct mid
+                   from multimedia_related
+                   where related_mid = any(%s)
+                """
+
+        try:
+            cursor.execute(query, (list(mIDs),))
+            return [row[0] for row in cursor.fetchall()]
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.getMultimediaRelatedTo")
+            return "Ocurrió un error interno buscando las publicaciones multimedia relacionadas."
+        finally:
+            cursor.close()
+
+    def getMultimediaCorpus(self, batchSize = 1000):
+        """
+        Summary:
+            Streams the id, title and content of every valid multimedia post in the database using a
+            server side cursor, so the whole table is never held twice in memory.
+
+        Params:
+            batchSize: the amount of rows fetched from the database on each round trip.
+
+        Returns:
+            A generator of (mid, title, content) tuples ordered by multimedia post id.
+        """
+
+        cursor = self.conn.cursor(name = 'multimedia_corpus')
+        cursor.itersize = batchSize
+
+        query = """select mid, title, content
+                   from multimedia
+                   where is_invalid = false
+                   order by mid
+                """
+
+        try:
+            cursor.execute(query)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+    def getMultimediaSnapshot(self, batchSize = 1000):
+        """
+        Summary:
+            Streams every valid multimedia post in the database with its author using a server side cursor,
+            to export them into a read-only snapshot.
+
+        Params:
+            batchSize: the amount of rows fetched from the database on each round trip.
+
+        Returns:
+            A generator of (mid, title, content, type, date_published, duid) tuples ordered by multimedia post id.
+        """
+
+        cursor = self.conn.cursor(name = 'multimedia_snapshot')
+        cursor.itersize = batchSize
+
+        query = """select mid, title, content, type, date_published, duid
+                   from multimedia
+                   where is_invalid = false
+                   order by mid
+                """
+
+        try:
+            cursor.execute(query)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+    def getAllRelatedMultimedia(self, batchSize = 1000):
+        """
+        Summary:
+            Streams every precomputed related multimedia row using a server side cursor.
+
+        Params:
+            batchSize: the amount of rows fetched from the database on each round trip.
+
+        Returns:
+            A generator of (mid, rank, related_mid, score) tuples.
+        """
+
+        cursor = self.conn.cursor(name = 'multimedia_related_snapshot')
+        cursor.itersize = batchSize
+
+        try:
+            cursor.execute("select mid, rank, related_mid, score from multimedia_related")
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+    def replaceRelatedMultimedia(self, rows, mIDs = None):
+        """
+        Summary:
+            Replaces the stored related multimedia posts with the given rows in a single transaction.
+            When multimedia post ids are given only the related posts of those multimedia posts are replaced.
+
+        Params:
+            rows: an iterable of (mid, rank, related_mid, score) tuples.
+            mIDs: optional list of multimedia post ids whose related posts are being replaced.
+
+        Returns:
+            The amount of related multimedia rows stored.
+        """
+
+        cursor = self.conn.cursor()
+
+        try:
+            if mIDs is None:
+                cursor.execute("delete from multimedia_related")
+            else:
+                cursor.execute("delete from multimedia_related where mid = any(%s)", (list(mIDs),))
+
+            rows = list(rows)
+            psycopg2.extras.execute_values(cursor,
+                "insert into multimedia_related (mid, rank, related_mid, score) values %s", rows, page_size = 1000)
+            cursor.close()
+            self._commitChanges()
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.replaceRelatedMultimedia")
+            self.conn.rollback()
+            return "Ocurrió un error interno guardando las publicaciones multimedia relacionadas."
+
+        return len(rows)
+
+    def getLatestMultimediaVersion(self, mID):
+        """
+        Summary:
+            Returns the number of the latest stored version of the multimedia post with the given id.
+
+        Params:
+            mID: the id of the multimedia post in question.
+
+        Returns:
+            The latest version number, or 0 if the multimedia post has no stored versions.
+        """
+
+        cursor = self.conn.cursor()
+
+        query = """select coalesce(max(version), 0)
+                   from multimedia_version
+                   where mid = %s
+                """
+
+        cursor.execute(query, (mID,), prepare = True)
+        result = cursor.fetchone()[0]
+        cursor.close()
+        return result
+
+    def getMultimediaVersionChain(self, mID, version):
+        """
+        Summary:
+            Returns the stored versions needed to rebuild the given version of a multimedia post: its nearest
+            previous snapshot and every delta after it up to the requested version.
+
+        Params:
+            mID: the id of the multimedia post.
+            version: the number of the version to rebuild.
+
+        Returns:
+            A list of (version, is_snapshot, title, data, date_edited) records ordered by version.
+        """
+
+        cursor = self.conn.cursor()
+
+        query = """select version, is_snapshot, title, data, date_edited
+                   from multimedia_version
+                   where mid = %s
+                   and version <= %s
+                   and version >= (select max(version)
+                                   from multimedia_version
+                                   where mid = %s
+                                   and version <= %s
+                                   and is_snapshot)
+                   order by version
+                """
+
+        result = []
+
+        try:
+            cursor.execute(query, (mID, version, mID, version,))
+            for row in cursor:
+                result.append(row)
+            return result
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.getMultimediaVersionChain")
+            return "Ocurrió un error interno buscando una versión de una publicación multimedia."
+        finally:
+            cursor.close()
+
+    def archiveInvalidMultimedia(self, retentionDays, batchSize):
+        """
+        Summary:
+            Moves one batch of multimedia posts that have been invalid for longer than the retention window
+            from the multimedia table into the multimedia_archive table and commits it. Their precomputed
+            related posts are deleted since they are rebuilt by the related multimedia job.
+
+        Params:
+            retentionDays: the amount of days a multimedia post stays invalid before it is archived.
+            batchSize: the maximum amount of multimedia posts moved.
+
+        Returns:
+            A (count, bytes) tuple with the amount of multimedia posts archived and the size of their rows.
+        """
+
+        cursor = self.conn.cursor()
+
+        batchQuery = """select mid
+                        from multimedia
+                        where is_invalid = true
+                        and date_invalidated < current_timestamp - make_interval(days => %s)
+                        order by date_invalidated
+                        limit %s
+                        for update skip locked
+                     """
+
+        unrelateQuery = """delete from multimedia_related
+                           where mid = any(%s)
+                           or related_mid = any(%s)
+                        """
+
+        moveQuery = """with moved as (
+                           delete from multimedia
+                           where mid = any(%s)
+                           returning mid, title, content, type, date_published, is_invalid, duid, date_invalidated,
+                                     pg_column_size(multimedia.*) as size
+                       ), archived as (
+                           insert into multimedia_archive (mid, title, content, type, date_published, is_invalid, duid, date_invalidated)
+                           select mid, title, content, type, date_published, is_invalid, duid, date_invalidated
+                           from moved
+                       )
+                       select count(*), coalesce(sum(size), 0)
+                       from moved
+                    """
+
+        try:
+            cursor.execute(batchQuery, (retentionDays, batchSize,))
+            mIDs = [row[0] for row in cursor.fetchall()]
+            if not mIDs:
+                cursor.close()
+                self.conn.rollback()
+                return 0, 0
+
+            cursor.execute(unrelateQuery, (mIDs, mIDs,))
+            cursor.execute(moveQuery, (mIDs,))
+            result = cursor.fetchone()
+            cursor.close()
+            self._commitChanges()
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.archiveInvalidMultimedia")
+            self.conn.rollback()
+            return "Ocurrió un error interno archivando publicaciones multimedia removidas."
+
+        return result[0], int(result[1])
+
+    def restoreMultimedia(self, mID):
+        """
+        Summary:
+            Moves an archived multimedia post back into the multimedia table as a valid multimedia post.
+
+        Params:
+            mID: the id of the archived multimedia post to restore.
+
+        Returns:
+            The id of the restored multimedia post, or None if no archived multimedia post has the given id.
+        """
+
+        cursor = self.conn.cursor()
+
+        query = """with restored as (
+                       delete from multimedia_archive
+                       where mid = %s
+                       returning mid, title, content, type, date_published, duid
+                   )
+                   insert into multimedia (mid, title, content, type, date_published, is_invalid, duid, date_invalidated)
+                   select mid, title, content, type, date_published, false, duid, null
+                   from restored
+                   returning mid
+                """
+
+        try:
+            cursor.execute(query, (mID,))
+            result = cursor.fetchone()
+            cursor.close()
+            self._commitChanges()
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.restoreMultimedia")
+            self.conn.rollback()
+            return "Ocurrió un error interno restaurando una publicación multimedia archivada."
+
+        return result[0] if result else None
+
+    def createMultimediaPartitions(self, monthsAhead = 3):
+        """
+        Summary:
+            Creates the monthly partitions of the multimedia table from the current month up to the given
+            amount of months ahead, skipping the ones that already exist.
+
+        Params:
+            monthsAhead: the amount of future months that must have a partition.
+
+        Returns:
+            The amount of partitions created.
+        """
+
+        cursor = self.conn.cursor()
+        cursor.execute("select create_multimedia_partitions(current_date, %s)", (monthsAhead,))
+        result = cursor.fetchone()[0]
+        cursor.close()
+        self._commitChanges()
+        return result
+
+    def vacuumMultimedia(self):
+        """
+        Summary:
+            Vacuums the multimedia table so the space of archived rows can be reused and the visibility
+            map is up to date for index only scans. VACUUM cannot run inside a transaction, so the
+            connection is switched to autocommit for the statement.
+        """
+
+        self.conn.commit()
+        self.conn.autocommit = True
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("vacuum (analyze) multimedia")
+            cursor.close()
+        finally:
+            self.conn.autocommit = False
+
     def multimediaExists(self, mID):
         """
         Summary:
@@ -273,7 +800,8 @@ class MultimediaDAO:
             mID: the id of the multimedia post in question.
 
         Returns:
-            True if the multimedia post exists, false otherwise.
+            True if the multimedia post exists, false otherwise. Database errors are raised, so callers answer
+            a 500 instead of a 404.
         """
         
         cursor = self.conn.cursor()
@@ -286,12 +814,14 @@ class MultimediaDAO:
                    and is_invalid = false
                 """
         try:
-            cursor.execute(query,(mID,))
+            cursor.execute(query, (mID,), prepare = True)
             if not cursor.fetchone():
                 exists = False
-        except Exception as e:
-            print(e)
-            exists = False
+        except psycopg2.DatabaseError:
+            logger.exception("Error in MultimediaDAO.multimediaExists")
+            raise
+        finally:
+            cursor.close()
         
         return exists
 
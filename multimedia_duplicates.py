@@ -0,0 +1,295 @@
+"""
+Near-duplicate detection for multimedia posts.
+
+Every valid multimedia post is summarized by a MinHash signature of its word shingles. Signatures are
+split into bands and stored in a locality sensitive hashing (LSH) index, so the posts similar to a new
+post are found by looking up its bands instead of comparing it against the whole table.
+
+The index is built in a background thread as the app starts. Workers forked before that build ends build
+their own, while workers forked after it reuse its index. A build that cannot read the table is retried
+with a growing delay. Until the first build ends the index is empty, so the posts published by a
+worker in that window are indexed but get no near-duplicate warning. A rebuild fills a new index while the
+current one keeps answering, and the posts added or removed meanwhile are applied to the new index before
+it replaces the current one.
+"""
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+import numpy as np
+from .dao.multimedia_dao import MultimediaDAO
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+#Amount of consecutive words in a shingle
+SHINGLE_SIZE = 3
+
+#Signature length is BANDS * ROWS. With 8 bands of 8 rows, posts with a Jaccard similarity
+#above ~0.77 are very likely to share a band and below ~0.5 are very unlikely to.
+BANDS = 8
+ROWS = 8
+
+#Minimum estimated Jaccard similarity for a candidate to be reported as a near-duplicate
+SIMILARITY_THRESHOLD = 0.8
+
+#Largest prime below 2^32. Hashes and coefficients are reduced below it, so a * x + b fits in 64 bits.
+PRIME = np.uint64(4294967291)
+
+#Seconds before retrying a build that could not read the table, doubled on every failure up to the maximum
+RETRY_DELAY = 5.0
+MAX_RETRY_DELAY = 300.0
+
+
+class MultimediaDuplicateIndex:
+
+    #DAO class the index is rebuilt from. The benchmarks replace it with the in-memory DAO.
+    multimediaDAO = MultimediaDAO
+
+    def __init__(self, bands = BANDS, rows = ROWS, threshold = SIMILARITY_THRESHOLD, seed = 1):
+        self.bands = bands
+        self.rows = rows
+        self.threshold = threshold
+
+        #Fixed seed so signatures are comparable across workers and restarts
+        generator = np.random.RandomState(seed)
+        permutations = bands * rows
+        self._a = generator.randint(1, int(PRIME), size = permutations, dtype = np.uint64)
+        self._b = generator.randint(0, int(PRIME), size = permutations, dtype = np.uint64)
+
+        self._lock = threading.Lock()
+        self._signatures = {}
+        self._buckets = [{} for _ in range(bands)]
+        self.ready = False
+
+        #Changes made while a rebuild runs, replayed on the rebuilt index before it is swapped in
+        self._rebuildLock = threading.Lock()
+        self._pending = None
+        self._builderPID = None
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def signature(self, title, content):
+        """
+        Summary:
+            Computes the MinHash signature of a multimedia post from the word shingles of its title and content.
+
+        Params:
+            title: the title of the multimedia post.
+            content: the content of the multimedia post.
+
+        Returns:
+            A numpy array of uint32 with one minimum hash per permutation.
+        """
+        words = TOKEN_PATTERN.findall("{} {}".format(title or '', content or '').lower())
+        if len(words) < SHINGLE_SIZE:
+            shingles = {' '.join(words)}
+        else:
+            shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                             dtype = np.uint64, count = len(shingles)) % PRIME
+
+        #Universal hashing (a * x + b) mod p simulates one random permutation per column
+        permuted = (np.outer(hashes, self._a) + self._b) % PRIME
+        return permuted.min(axis = 0).astype(np.uint32)
+
+    def _bandKeys(self, signature):
+        """
+        Summary:
+            Splits a signature into the hashable keys of each of its bands.
+        """
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def findDuplicates(self, signature, exclude = None):
+        """
+        Summary:
+            Looks up the multimedia posts that share at least one band with the given signature and keeps
+            those whose estimated Jaccard similarity reaches the threshold.
+
+        Params:
+            signature: the MinHash signature of the multimedia post in question.
+            exclude: optional id of a multimedia post to leave out of the results.
+
+        Returns:
+            A list of (mid, similarity) tuples ordered from most to least similar.
+        """
+        with self._lock:
+            candidates = set()
+            for band, key in enumerate(self._bandKeys(signature)):
+                candidates.update(self._buckets[band].get(key, ()))
+            candidates.discard(exclude)
+
+            result = []
+            for mid in candidates:
+                similarity = float(np.mean(self._signatures[mid] == signature))
+                if similarity >= self.threshold:
+                    result.append((mid, round(similarity, 2)))
+
+        result.sort(key = lambda duplicate: duplicate[1], reverse = True)
+        return result
+
+    def add(self, mID, title, content):
+        """
+        Summary:
+            Indexes a multimedia post and returns its near-duplicates among the previously indexed posts.
+
+        Params:
+            mID: the id of the multimedia post.
+            title: the title of the multimedia post.
+            content: the content of the multimedia post.
+
+        Returns:
+            A list of (mid, similarity) tuples of the near-duplicates of the multimedia post, empty until
+            the first build of the index ends.
+        """
+        self.ensureBuilt()
+        signature = self.signature(title, content)
+        duplicates = self.findDuplicates(signature, exclude = mID)
+        with self._lock:
+            self._insert(self._signatures, self._buckets, mID, signature)
+            if self._pending is not None:
+                self._pending.append((mID, signature))
+        return duplicates
+
+    def _insert(self, signatures, buckets, mID, signature):
+        """
+        Summary:
+            Stores a signature in the given index replacing the previous one of the same multimedia post, if
+            any. The caller must hold the lock when the index is the current one.
+        """
+        self._discard(signatures, buckets, mID)
+        signatures[mID] = signature
+        for band, key in enumerate(self._bandKeys(signature)):
+            buckets[band].setdefault(key, set()).add(mID)
+
+    def remove(self, mID):
+        """
+        Summary:
+            Removes a multimedia post from the index.
+
+        Params:
+            mID: the id of the multimedia post to remove.
+        """
+        self.ensureBuilt()
+        with self._lock:
+            self._discard(self._signatures, self._buckets, mID)
+            if self._pending is not None:
+                self._pending.append((mID, None))
+
+    def _discard(self, signatures, buckets, mID):
+        """
+        Summary:
+            Removes a multimedia post from the given index. The caller must hold the lock when the index is
+            the current one.
+        """
+        signature = signatures.pop(mID, None)
+        if signature is None:
+            return
+        for band, key in enumerate(self._bandKeys(signature)):
+            bucket = buckets[band].get(key)
+            if bucket is not None:
+                bucket.discard(mID)
+                if not bucket:
+                    del buckets[band][key]
+
+    def rebuild(self, batchSize = 1000):
+        """
+        Summary:
+            Indexes every valid multimedia post in the database into a new index, streaming them in batches
+            through a server side cursor so the whole table is never loaded at once, and swaps it in once
+            the posts added or removed meanwhile are applied to it. The current index keeps answering until
+            then, and is kept if the table cannot be read.
+
+        Params:
+            batchSize: the amount of rows fetched from the database on each round trip.
+
+        Returns:
+            The amount of multimedia posts indexed.
+        """
+        with self._rebuildLock:
+            dao = self.multimediaDAO()
+            signatures = {}
+            buckets = [{} for _ in range(self.bands)]
+            with self._lock:
+                self._pending = []
+
+            try:
+                for mid, title, content in dao.getMultimediaCorpus(batchSize):
+                    self._insert(signatures, buckets, mid, self.signature(title, content))
+            except Exception:
+                logger.exception("Error in MultimediaDuplicateIndex.rebuild")
+                with self._lock:
+                    self._pending = None
+                return len(self._signatures)
+            finally:
+                dao._closeConnection()
+
+            with self._lock:
+                for mID, signature in self._pending:
+                    if signature is None:
+                        self._discard(signatures, buckets, mID)
+                    else:
+                        self._insert(signatures, buckets, mID, signature)
+                self._signatures, self._buckets, self._pending = signatures, buckets, None
+                self.ready = True
+            return len(signatures)
+
+    def rebuildInBackground(self, batchSize = 1000):
+        """
+        Summary:
+            Starts rebuilding the index in a daemon thread so the application keeps serving requests while
+            the table is being read.
+        """
+        thread = threading.Thread(target = self._build, args = (batchSize,), name = 'multimedia-duplicates', daemon = True)
+        thread.start()
+        return thread
+
+    def _build(self, batchSize):
+        """
+        Summary:
+            Rebuilds the index, retrying with a growing delay until the first build succeeds.
+        """
+        delay = RETRY_DELAY
+        self.rebuild(batchSize)
+        while not self.ready:
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+            self.rebuild(batchSize)
+
+    def buildOnStart(self):
+        """
+        Summary:
+            Starts building the index in the background in this process and in every worker forked from it
+            before it is built, so workers have it ready by their first writes.
+        """
+        os.register_at_fork(after_in_child = self._afterFork)
+        self.ensureBuilt()
+
+    def _afterFork(self):
+        #Locks held by the threads of the parent when it forked are never released in the child
+        self._lock = threading.Lock()
+        self._rebuildLock = threading.Lock()
+        self.ensureBuilt()
+
+    def ensureBuilt(self):
+        """
+        Summary:
+            Starts building the index in the background unless it is built or this process already builds it.
+        """
+        if self.ready or self._builderPID == os.getpid():
+            return
+        with self._lock:
+            #Threads do not survive the fork of a worker, a worker forked mid build starts its own
+            if self.ready or self._builderPID == os.getpid():
+                return
+            self._builderPID = os.getpid()
+        self.rebuildInBackground()
+
+
+#Index shared by every request handled by this worker
+duplicateIndex = MultimediaDuplicateIndex()
@@ -0,0 +1,92 @@
+"""
+Exporter of the read-only SQLite snapshot served by edge nodes with MULTIMEDIA_BACKEND=sqlite.
+
+Copies the valid multimedia posts and their precomputed related posts out of Postgres into a
+temporary SQLite file, then copies it into the live snapshot with the SQLite backup API. The live
+snapshot uses WAL journaling, so edge workers keep reading the previous snapshot until the copy commits.
+
+Usage:
+    python -m handler.multimedia_snapshot [PATH]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+from .dao.multimedia_dao import MultimediaDAO
+from .dao.multimedia_sqlite_dao import SCHEMA
+
+BATCH_SIZE = 1000
+
+
+def _insertBatches(connection, query, rows):
+    """
+    Summary:
+        Inserts the given rows into the SQLite snapshot in batches.
+    """
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            connection.executemany(query, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        connection.executemany(query, batch)
+        count += len(batch)
+    return count
+
+
+def exportMultimediaSnapshot(path = None):
+    """
+    Summary:
+        Exports the valid multimedia posts and their related posts from Postgres into the SQLite snapshot.
+
+    Params:
+        path: the path of the snapshot, MULTIMEDIA_SQLITE_PATH if not given.
+
+    Returns:
+        A dictionary with the amount of multimedia posts and related rows exported.
+    """
+    path = path or os.getenv('MULTIMEDIA_SQLITE_PATH', 'multimedia.db')
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporaryPath = tempfile.mkstemp(suffix = '.db', dir = directory)
+    os.close(fd)
+
+    dao = MultimediaDAO()
+
+    try:
+        #Build the snapshot without journaling since the temporary file is discarded on failure
+        staging = sqlite3.connect(temporaryPath)
+        staging.execute("pragma journal_mode = off")
+        staging.execute("pragma synchronous = off")
+        staging.executescript(SCHEMA)
+
+        posts = _insertBatches(staging, "insert into multimedia values (?, ?, ?, ?, ?, ?)",
+            ((mid, title, content, mType, datePublished.isoformat(), duid)
+             for mid, title, content, mType, datePublished, duid in dao.getMultimediaSnapshot(BATCH_SIZE)))
+        related = _insertBatches(staging, "insert into multimedia_related values (?, ?, ?, ?)",
+            dao.getAllRelatedMultimedia(BATCH_SIZE))
+        staging.commit()
+        staging.execute("analyze")
+
+        #Replace the live snapshot in a single transaction readers never see half done
+        live = sqlite3.connect(path)
+        live.execute("pragma journal_mode = wal")
+        staging.backup(live)
+        live.execute("pragma wal_checkpoint(truncate)")
+        live.close()
+        staging.close()
+
+        return {'multimedia': posts, 'related': related}
+    finally:
+        dao._closeConnection()
+        os.remove(temporaryPath)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Exports the valid multimedia posts into a SQLite snapshot.")
+    parser.add_argument('path', nargs = '?', help = "snapshot path, MULTIMEDIA_SQLITE_PATH by default")
+    args = parser.parse_args()
+
+    print(exportMultimediaSnapshot(args.path))
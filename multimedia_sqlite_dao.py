@@ -0,0 +1,208 @@
+import datetime
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+#Schema of the read-only snapshot of the valid multimedia posts written by handler.multimedia_snapshot
+SCHEMA = """
+create table multimedia (
+    mid integer primary key,
+    title text not null,
+    content text not null,
+    type text not null,
+    date_published text not null,
+    duid integer not null
+);
+create index multimedia_type_idx on multimedia (type);
+create index multimedia_duid_idx on multimedia (duid);
+create index multimedia_date_idx on multimedia (date_published);
+
+create table multimedia_related (
+    mid integer not null,
+    rank integer not null,
+    related_mid integer not null,
+    score real not null,
+    primary key (mid, rank)
+) without rowid;
+"""
+
+#Size of the memory mapped region of the snapshot file, large enough to map the whole table
+MMAP_SIZE = 1 << 30
+
+
+class MultimediaSQLiteDAO:
+    """
+    Read-only MultimediaDAO backed by a local SQLite snapshot of the valid multimedia posts, used by
+    edge nodes that serve the public multimedia routes without a Postgres connection. It is selected
+    with MULTIMEDIA_BACKEND=sqlite and reads the file at MULTIMEDIA_SQLITE_PATH.
+    """
+
+    def __init__(self, path = None):
+        path = path or os.getenv('MULTIMEDIA_SQLITE_PATH', 'multimedia.db')
+
+        #Establish a connection with the local snapshot. The snapshot only holds valid multimedia
+        #posts, so no query needs to filter by is_invalid.
+        self.conn = sqlite3.connect(path, check_same_thread = False)
+        self.conn.execute("pragma query_only = on")
+        self.conn.execute("pragma mmap_size = {}".format(MMAP_SIZE))
+
+    def _mapRow(self, row):
+        """
+        Summary:
+            Converts the stored ISO date of a snapshot row back into a datetime, as returned by psycopg2.
+        """
+        if row is None:
+            return None
+        return row[0], row[1], row[2], row[3], datetime.datetime.fromisoformat(row[4])
+
+    def _fetchAll(self, query, params = ()):
+        """
+        Summary:
+            Runs a query and returns all of its rows mapped like the MultimediaDAO records.
+        """
+        try:
+            return [self._mapRow(row) for row in self.conn.execute(query, params)]
+        except sqlite3.DatabaseError:
+            logger.exception("Error in MultimediaSQLiteDAO._fetchAll")
+            return "Ocurrió un error interno buscando publicaciones multimedia."
+
+    def getAllMultimedia(self):
+        """
+        Summary:
+            Returns a list of all multimedia posts in the snapshot with their corresponding information.
+
+        Returns:
+            A list containing all the valid multimedia posts with their information.
+        """
+        return self._fetchAll("""select mid, title, content, type, date_published
+                                 from multimedia
+                              """)
+
+    def getMultimediaByID(self, mID):
+        """
+        Summary:
+            Returns a single multimedia post in the snapshot with the given multimedia post id.
+
+        Params:
+            mID: the id of the multimedia post id to be fetched.
+
+        Returns:
+            A tuple containing all the information of the multimedia post with the given multimedia post id.
+        """
+        try:
+            cursor = self.conn.execute("""select mid, title, content, type, date_published
+                                          from multimedia
+                                          where mid = ?
+                                       """, (mID,))
+            return self._mapRow(cursor.fetchone())
+        except sqlite3.DatabaseError:
+            logger.exception("Error in MultimediaSQLiteDAO.getMultimediaByID")
+            return "Ocurrió un error interno buscando una publicación multimedia por su identificador."
+
+    def getMultimediaByType(self, mType):
+        """
+        Summary:
+            Returns a list of multimedia posts in the snapshot of the given type.
+
+        Params:
+            mType: the type of multimedia post.
+
+        Returns:
+            A list containing all the valid multimedia posts with their information and are of the given type.
+        """
+        return self._fetchAll("""select mid, title, content, type, date_published
+                                 from multimedia
+                                 where type = ?
+                              """, (mType,))
+
+    def getMultimediaByAuthor(self, duid):
+        """
+        Summary:
+            Returns a list of multimedia posts in the snapshot authored by the dashboard user with the given id.
+
+        Params:
+            duid: the dashboard user id of the author of the multimedia post.
+
+        Returns:
+            A list containing all the valid multimedia posts with their information and are authored by the
+            dashboard user with the given id.
+        """
+        return self._fetchAll("""select mid, title, content, type, date_published
+                                 from multimedia
+                                 where duid = ?
+                              """, (duid,))
+
+    def getMultimediaByMonth(self, start, end):
+        """
+        Summary:
+            Returns a list of multimedia posts in the snapshot published between the given dates.
+
+        Params:
+            start: the first date of the month, inclusive.
+            end: the first date of the following month, exclusive.
+
+        Returns:
+            A list containing all the valid multimedia posts with their information published in the given month.
+        """
+        return self._fetchAll("""select mid, title, content, type, date_published
+                                 from multimedia
+                                 where date_published >= ?
+                                 and date_published < ?
+                                 order by date_published
+                              """, (start.isoformat(), end.isoformat(),))
+
+    def getRelatedMultimedia(self, mID):
+        """
+        Summary:
+            Returns a list of the precomputed related multimedia posts of the multimedia post with the given id,
+            ordered from most to least similar. The existence of the multimedia post is checked by the same query.
+
+        Params:
+            mID: the id of the multimedia post whose related posts are fetched.
+
+        Returns:
+            A list containing the related multimedia posts with their information, or None if there is no
+            multimedia post with the given id in the snapshot.
+        """
+        try:
+            rows = self.conn.execute("""select M.mid, M.title, M.content, M.type, M.date_published
+                                        from multimedia as P
+                                        left join multimedia_related as R on R.mid = P.mid
+                                        left join multimedia as M on M.mid = R.related_mid
+                                        where P.mid = ?
+                                        order by R.rank
+                                     """, (mID,)).fetchall()
+        except sqlite3.DatabaseError:
+            logger.exception("Error in MultimediaSQLiteDAO.getRelatedMultimedia")
+            return "Ocurrió un error interno buscando las publicaciones multimedia relacionadas."
+        if not rows:
+            return None
+        return [self._mapRow(row) for row in rows if row[0] is not None]
+
+    def multimediaExists(self, mID):
+        """
+        Summary:
+            Confirms the existence of a multimedia post in the snapshot by the multimedia post id given.
+
+        Params:
+            mID: the id of the multimedia post in question.
+
+        Returns:
+            True if the multimedia post exists, false otherwise. Errors reading the snapshot are raised, so
+            callers answer a 500 instead of a 404.
+        """
+        try:
+            return self.conn.execute("select 1 from multimedia where mid = ?", (mID,)).fetchone() is not None
+        except sqlite3.DatabaseError:
+            logger.exception("Error in MultimediaSQLiteDAO.multimediaExists")
+            raise
+
+    def _closeConnection(self):
+        """
+        Summary:
+            Closes the connection with the snapshot.
+        """
+        if self.conn is not None:
+            self.conn.close()
@@ -0,0 +1,110 @@
+"""
+Encoding of the edit history of multimedia posts.
+
+Versions are stored as zlib compressed deltas against the previous version, with a full snapshot
+every SNAPSHOT_INTERVAL versions, so rebuilding any version applies at most SNAPSHOT_INTERVAL - 1 deltas.
+"""
+import difflib
+import json
+import re
+import zlib
+
+#A full snapshot is stored for versions 1, 1 + SNAPSHOT_INTERVAL, 1 + 2 * SNAPSHOT_INTERVAL...
+SNAPSHOT_INTERVAL = 10
+
+#Words with their trailing whitespace, so joining the tokens gives back the exact text
+TOKEN_PATTERN = re.compile(r"\S+\s*|\s+")
+
+
+def isSnapshotVersion(version):
+    """
+    Summary:
+        Tells whether the given version number is stored as a full snapshot.
+    """
+    return (version - 1) % SNAPSHOT_INTERVAL == 0
+
+
+def encodeSnapshot(content):
+    """
+    Summary:
+        Compresses the full content of a multimedia post version.
+
+    Params:
+        content: the content of the multimedia post.
+
+    Returns:
+        The compressed content as bytes.
+    """
+    return zlib.compress(content.encode('utf-8'), 9)
+
+
+def encodeDelta(previous, content):
+    """
+    Summary:
+        Computes the compressed delta that turns the previous content into the given content. The delta
+        is a list of operations over the word tokens of the previous content: [i1, i2] copies tokens
+        i1 to i2 and a string inserts new text.
+
+    Params:
+        previous: the content of the previous version.
+        content: the content of the new version.
+
+    Returns:
+        The compressed delta as bytes.
+    """
+    oldTokens = TOKEN_PATTERN.findall(previous)
+    newTokens = TOKEN_PATTERN.findall(content)
+
+    operations = []
+    matcher = difflib.SequenceMatcher(None, oldTokens, newTokens)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            operations.append([i1, i2])
+        elif j2 > j1:
+            operations.append(''.join(newTokens[j1:j2]))
+
+    return zlib.compress(json.dumps(operations, ensure_ascii = False, separators = (',', ':')).encode('utf-8'), 9)
+
+
+def applyDelta(previous, delta):
+    """
+    Summary:
+        Applies a delta computed by encodeDelta to the content of the previous version.
+
+    Params:
+        previous: the content of the previous version.
+        delta: the compressed delta as bytes.
+
+    Returns:
+        The content of the new version.
+    """
+    oldTokens = TOKEN_PATTERN.findall(previous)
+    parts = []
+    for operation in json.loads(zlib.decompress(delta).decode('utf-8')):
+        if isinstance(operation, str):
+            parts.append(operation)
+        else:
+            parts.append(''.join(oldTokens[operation[0]:operation[1]]))
+    return ''.join(parts)
+
+
+def reconstructVersion(rows):
+    """
+    Summary:
+        Rebuilds the content of a multimedia post version from its nearest previous snapshot and
+        the deltas that follow it.
+
+    Params:
+        rows: a list of (version, is_snapshot, title, data, date_edited) records ordered by version,
+              starting with a snapshot and ending with the requested version.
+
+    Returns:
+        A (version, title, content, date_edited) tuple of the requested version.
+    """
+    content = None
+    for version, isSnapshot, title, data, dateEdited in rows:
+        if isSnapshot:
+            content = zlib.decompress(bytes(data)).decode('utf-8')
+        else:
+            content = applyDelta(content, bytes(data))
+    return version, title, content, dateEdited
@@ -27,6 +27,16 @@ export default{
         state.multimedias = multimedias
     },
 
+    /**
+     * Mutation to set the loaded related multimedia posts list in the state.
+     * @param {*} state vuex state object
+     * @param {*} relatedMultimedias loaded related multimedia posts list with objects containing multimedia post data
+     */
+    SET_RELATED_MULTIMEDIAS(state,relatedMultimedias){
+        //Set loaded related multimedia posts list
+        state.relatedMultimedias = relatedMultimedias
+    },
+
     /**
      * Mutation to filter the state's multimedia posts effectively deleting them.
      * @param {*} state vuex state object
@@ -0,0 +1,267 @@
+"""
+On-demand profiling of a running worker.
+
+StackSampler samples the stacks of every other thread of the process at a fixed interval for a few
+seconds, using sys._current_frames() from its own thread, so the profiled threads run untouched. The
+samples are returned as collapsed stacks, the input of flamegraph.pl, or as a speedscope file.
+
+MemoryProfiler traces the allocations of the process with tracemalloc once started, and reports the
+allocation sites whose memory grew the most since its previous report.
+
+registerRequestProfiling() profiles single requests with cProfile when they carry the X-Profile header
+set to PROFILE_SECRET. The stats of each profiled request are written in the pstats format to
+PROFILE_DIR, and their path is returned in the X-Profile-Path response header.
+
+Configuration:
+    PROFILE_SECRET: value of the X-Profile header enabling the profiling of a request, disabled when unset.
+    PROFILE_DIR: directory of the request profiles, profiles by default.
+"""
+import cProfile
+import gc
+import json
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from flask import g, request
+
+PROFILE_HEADER = 'X-Profile'
+
+#Characters removed from the request id before it names a profile file
+UNSAFE_FILE_CHARACTERS = re.compile(r'[^A-Za-z0-9_-]')
+
+MAX_DURATION = 60.0
+DEFAULT_INTERVAL = 0.01
+
+#Frames kept per traced allocation, more frames tell apart more callers at a higher overhead
+DEFAULT_TRACE_FRAMES = 10
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class StackSampler:
+    """
+    Stack sampling profiler over the threads of the process. Only one profile runs at a time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def sample(self, duration, interval = DEFAULT_INTERVAL):
+        """
+        Summary:
+            Samples the stacks of every other thread during the given seconds.
+
+        Returns:
+            A dictionary from (thread name, stack) to the amount of samples, where the stack is a tuple of
+            (function, file, line) from the outermost frame to the innermost.
+        """
+        if not self.lock.acquire(blocking = False):
+            raise ProfilerBusy()
+        try:
+            samples = {}
+            current = threading.get_ident()
+            deadline = time.monotonic() + min(duration, MAX_DURATION)
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == current:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_name, code.co_filename, frame.f_lineno))
+                        frame = frame.f_back
+                    key = (names.get(ident, str(ident)), tuple(reversed(stack)))
+                    samples[key] = samples.get(key, 0) + 1
+                time.sleep(interval)
+            return samples
+        finally:
+            self.lock.release()
+
+
+def collapsedStacks(samples):
+    """
+    Summary:
+        Formats the samples as collapsed stacks, one "thread;outer;...;inner count" line per stack.
+    """
+    lines = []
+    for (thread, stack), count in sorted(samples.items(), key = lambda item: -item[1]):
+        frames = ['{} ({}:{})'.format(name, os.path.basename(filename), line) for name, filename, line in stack]
+        lines.append('{} {}'.format(';'.join([thread] + frames), count))
+    return '\n'.join(lines) + '\n'
+
+
+def speedscopeProfile(samples, interval = DEFAULT_INTERVAL):
+    """
+    Summary:
+        Formats the samples as a speedscope file with one sampled profile per thread.
+    """
+    frames = []
+    frameIndexes = {}
+    profiles = {}
+    for (thread, stack), count in samples.items():
+        indexes = []
+        for frame in stack:
+            index = frameIndexes.get(frame)
+            if index is None:
+                index = frameIndexes[frame] = len(frames)
+                frames.append({'name': frame[0], 'file': frame[1], 'line': frame[2]})
+            indexes.append(index)
+        profile = profiles.setdefault(thread, {'samples': [], 'weights': []})
+        profile['samples'].append(indexes)
+        profile['weights'].append(count * interval)
+
+    return json.dumps({
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': thread,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(profile['weights']),
+            'samples': profile['samples'],
+            'weights': profile['weights'],
+        } for thread, profile in sorted(profiles.items())],
+        'name': 'pid {}'.format(os.getpid()),
+        'exporter': __name__,
+    })
+
+
+class MemoryProfiler:
+    """
+    Allocation tracing with tracemalloc, reported as the difference between consecutive snapshots.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.previous = None
+
+    def start(self, frames = DEFAULT_TRACE_FRAMES):
+        """
+        Summary:
+            Starts tracing the allocations and takes the snapshot the first report is compared against.
+        """
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self.previous = _takeSnapshot()
+
+    def stop(self):
+        """
+        Summary:
+            Stops tracing the allocations and frees the traces.
+        """
+        with self.lock:
+            tracemalloc.stop()
+            self.previous = None
+
+    def report(self, groupBy = 'lineno', limit = 25):
+        """
+        Summary:
+            Compares a new snapshot with the previous one, which it then replaces.
+
+        Params:
+            groupBy: 'lineno', 'filename' or 'traceback', how the allocations are grouped.
+            limit: amount of allocation sites reported, from the largest growth.
+
+        Returns:
+            A dictionary with the traced and resident memory of the process and the allocation sites
+            that grew the most, or None when the allocations are not being traced.
+        """
+        with self.lock:
+            if not tracemalloc.is_tracing() or self.previous is None:
+                return None
+            snapshot = _takeSnapshot()
+            statistics = snapshot.compare_to(self.previous, groupBy)
+            self.previous = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'traced_bytes': current,
+            'traced_peak_bytes': peak,
+            'resident_bytes': _residentMemory(),
+            'gc_garbage': len(gc.garbage),
+            'allocations': [{
+                'size_diff': statistic.size_diff,
+                'count_diff': statistic.count_diff,
+                'size': statistic.size,
+                'count': statistic.count,
+                'traceback': statistic.traceback.format(),
+            } for statistic in statistics[:limit]],
+        }
+
+
+def _takeSnapshot():
+    #The allocations of tracemalloc and the import machinery are noise in every report
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    ))
+
+
+def _residentMemory():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def registerRequestProfiling(app):
+    """
+    Summary:
+        Installs the request hooks that profile with cProfile the requests carrying the profiling header.
+    """
+    secret = os.getenv('PROFILE_SECRET')
+    directory = os.getenv('PROFILE_DIR', 'profiles')
+    if not secret:
+        return
+
+    @app.before_request
+    def startProfile():
+        if request.headers.get(PROFILE_HEADER) != secret:
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            #Another profiler is already active in this thread
+            return
+        g.profiler = profiler
+
+    @app.after_request
+    def saveProfile(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        os.makedirs(directory, exist_ok = True)
+        #The request id comes from the client, only a short run of safe characters names the file
+        requestId = UNSAFE_FILE_CHARACTERS.sub('', g.get('requestId') or '')[:64]
+        path = os.path.join(directory, '{}_{}_{}.prof'.format(
+            time.strftime('%Y%m%dT%H%M%S'), request.endpoint, requestId or uuid.uuid4().hex))
+        profiler.dump_stats(path)
+        response.headers['X-Profile-Path'] = path
+        app.logger.info("Profiled %s %s into %s", request.method, request.path, path)
+        return response
+
+    @app.teardown_request
+    def stopProfile(exception):
+        #Requests ending in an unhandled exception skip the after request hooks
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+
+
+#Profilers shared by the worker threads of this process
+stackSampler = StackSampler()
+memoryProfiler = MemoryProfiler()
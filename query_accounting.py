@@ -0,0 +1,635 @@
+"""
+Per-request accounting of the database work done by the DAOs.
+
+DAOs open their connections through connect(), whose connections and cursors count the connections
+opened, statements executed, round trips, rows fetched and time spent in the database by the current
+Flask request. registerQueryAccounting() reports the totals of each request in a Server-Timing header
+and the debug log, warns about statements repeated often enough to suggest an N+1 pattern and, when
+testing, fails requests that exceed the query budget declared on their route with queryBudget(). The
+statements of traced requests are also recorded as spans.
+
+Every connection and cursor opened during a request is registered with the frames that opened it. The
+ones still open when the request ends are closed, and each leaked connection and cursor is logged as a
+warning with the stack that opened it. The cursors of a connection shared by a unit of work are closed
+and reported when the unit ends, before the connection goes back to the pool.
+
+AccountingCursor.executeBatch() sends a batch of dependent statements in a single round trip, the closest
+psycopg2 gets to the pipeline mode of libpq.
+
+Routes declare with timeBudget() how long their statements may take altogether, DB_STATEMENT_TIMEOUT
+milliseconds by default. Every statement of a request is limited with statement_timeout to what is
+left of its budget, set in the same round trip as the statement, and statements sent once the budget
+is used up fail without reaching the database. A request whose statement was canceled by the timeout
+is answered with a 503 and a Retry-After header of DB_TIMEOUT_RETRY_AFTER seconds instead of its error.
+
+connect() and the statements report whether the database answered to its circuit breaker. Failing to
+connect and losing the connection count as failures, while statement errors, statement timeouts and a
+pool with every connection in use do not.
+
+Pooled connections also keep server side prepared statements of the hot DAO statements, executed with
+prepare = True, keyed by their text and deallocated once the least recently used of them exceed
+PREPARED_STATEMENT_CACHE_SIZE.
+"""
+import collections
+import os
+import re
+import sys
+import time
+import traceback
+import weakref
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from flask import g, has_request_context, jsonify, request
+from .circuit_breaker import circuitBreaker
+from .read_replicas import replicaRouter
+from .slow_query_log import slowQueryLog
+from ..tracing import span, isTracing, SPAN_KIND_CLIENT
+
+#Executions of the same statement in one request reported as a possible N+1 pattern
+N_PLUS_ONE_THRESHOLD = 5
+
+#Connections and cursors not yet garbage collected, for the memory profiling endpoint
+liveConnections = weakref.WeakSet()
+liveCursors = weakref.WeakSet()
+
+#Frames of the stack that opened a connection or cursor kept for the leak warnings
+LEAK_STACK_LIMIT = 12
+
+#Prepared statements kept per pooled connection
+PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv('PREPARED_STATEMENT_CACHE_SIZE', '100'))
+
+PLACEHOLDER_PATTERN = re.compile(r"%%|%s")
+
+#Seconds a new connection waits for the database to answer before failing
+CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))
+
+#Database time budget in milliseconds of the routes that do not declare one
+DEFAULT_TIME_BUDGET = int(os.getenv('DB_STATEMENT_TIMEOUT', '30000'))
+
+#Seconds clients are asked to wait before retrying a request whose statement timed out
+TIMEOUT_RETRY_AFTER = int(os.getenv('DB_TIMEOUT_RETRY_AFTER', '5'))
+
+
+class QueryStats:
+    """
+    Database work done while handling one request.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.connectTime = 0.0
+        self.queries = 0
+        self.roundTrips = 0
+        self.rows = 0
+        self.duration = 0.0
+        self.statements = {}
+
+    def recordQuery(self, query, duration, rows, roundTrips = 1):
+        self.queries += 1
+        self.roundTrips += roundTrips
+        self.rows += rows
+        self.duration += duration
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        key = str(query)
+        self.statements[key] = self.statements.get(key, 0) + 1
+
+    def recordRoundTrip(self, duration, rows = 0):
+        self.roundTrips += 1
+        self.rows += rows
+        self.duration += duration
+
+
+def currentQueryStats():
+    """
+    Summary:
+        Returns the QueryStats of the current request, or None outside of a request.
+    """
+    if not has_request_context():
+        return None
+    stats = g.get('queryStats')
+    if stats is None:
+        stats = g.queryStats = QueryStats()
+    return stats
+
+
+def _statementSummary(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return ' '.join(str(query).split())[:200]
+
+
+def _trackResource(resource):
+    """
+    Summary:
+        Registers a connection or cursor opened during the current request with the stack that opened it.
+
+    Returns:
+        The stack that opened the resource, or None outside of a request.
+    """
+    if not has_request_context():
+        return None
+    resources = g.get('openResources')
+    if resources is None:
+        resources = g.openResources = []
+    #Source lines are only read if the resource leaks
+    stack = traceback.StackSummary.extract(traceback.walk_stack(sys._getframe(2)), limit = LEAK_STACK_LIMIT, lookup_lines = False)
+    resources.append((resource, stack))
+    return stack
+
+
+def formatStack(stack):
+    """
+    Summary:
+        Returns the stack registered for a leaked resource formatted as a traceback, outermost frame first.
+    """
+    if stack is None:
+        return "(opened outside of a request)\n"
+    return ''.join(traceback.StackSummary.from_list(list(reversed(stack))).format())
+
+
+def _recordTimeout():
+    if has_request_context():
+        g.statementTimedOut = True
+
+
+def _recordFailure(connection, error):
+    #The DAOs turn every database error into a generic one, the request is answered as a timeout later
+    if isinstance(error, psycopg2.extensions.QueryCanceledError):
+        _recordTimeout()
+    if connection.breaker is None:
+        return
+    #Only a lost connection means the database is not answering, the errors and timeouts of a statement
+    #are answers of a working database
+    if connection.closed:
+        connection.breaker.recordFailure()
+    else:
+        connection.breaker.recordSuccess()
+
+
+def _recordSuccess(connection):
+    if connection.breaker is not None:
+        connection.breaker.recordSuccess()
+
+
+def _numberPlaceholders(query):
+    """
+    Summary:
+        Converts the %s placeholders of a statement to the $1, $2... parameters of PREPARE.
+
+    Returns:
+        The converted statement and its amount of parameters.
+    """
+    parameters = 0
+
+    def replace(match):
+        nonlocal parameters
+        if match.group(0) == '%%':
+            return '%'
+        parameters += 1
+        return '${}'.format(parameters)
+
+    return PLACEHOLDER_PATTERN.sub(replace, query), parameters
+
+
+class AccountingCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that records its statements and, for server side cursors, each fetch round trip, and
+    hands its statements to the slow query log.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        liveCursors.add(self)
+        stack = _trackResource(self)
+        if self.connection.openCursors is not None:
+            self.connection.openCursors.append((self, stack))
+
+    def execute(self, query, vars = None, prepare = False):
+        """
+        Summary:
+            Executes the statement. With prepare, statements with positional parameters run on a pooled
+            connection through a prepared statement, which Postgres parses and plans only once.
+        """
+        stats = currentQueryStats()
+        attributes = {'db.system': 'postgresql', 'db.statement': _statementSummary(query)} if isTracing() else None
+        start = time.perf_counter()
+        error = None
+        try:
+            with span('db.query', attributes, SPAN_KIND_CLIENT):
+                statement = query
+                #Preparing can fail as the statement itself, and is accounted to it
+                if prepare and self.name is None and self.connection.preparedStatements is not None and isinstance(vars, (tuple, list)):
+                    statement = self.connection.prepare(query)
+                result = super().execute(self._limited(statement), vars)
+        except psycopg2.Error as e:
+            error = e
+            _recordFailure(self.connection, e)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            if stats is not None:
+                #Client side cursors receive every row with the statement
+                rows = self.rowcount if self.name is None and self.rowcount > 0 else 0
+                stats.recordQuery(query, duration, rows)
+            #Failed and canceled statements are often the slowest ones
+            slowQueryLog.observe(self, query, vars, duration, error)
+        _recordSuccess(self.connection)
+        return result
+
+    def _limited(self, statement):
+        """
+        Summary:
+            Returns the statement limited to what is left of the database time budget of the request, raising
+            QueryCanceledError without sending it if the budget is used up.
+        """
+        timeout = remainingTimeBudget()
+        if timeout is None:
+            return statement
+        if timeout <= 0:
+            _recordTimeout()
+            raise psycopg2.extensions.QueryCanceledError("The database time budget of the request was used up")
+        #Server side cursors wrap the statement in a DECLARE and VACUUM cannot run in a multi-statement
+        #message, so they set the timeout in a round trip of their own
+        if self.name is not None or self.connection.autocommit:
+            self.connection.setStatementTimeout(timeout)
+            return statement
+        prefix = "select set_config('statement_timeout', '{}', true);\n".format(timeout)
+        if isinstance(statement, bytes):
+            return prefix.encode() + statement
+        return prefix + statement
+
+    def executemany(self, query, vars_list):
+        stats = currentQueryStats()
+        if stats is None:
+            return super().executemany(query, vars_list)
+        vars_list = list(vars_list)
+        timeout = remainingTimeBudget()
+        if timeout is not None:
+            self.connection.setStatementTimeout(max(timeout, 1))
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            #executemany sends one statement per set of parameters
+            stats.recordQuery(query, time.perf_counter() - start, 0, len(vars_list))
+
+    def executeBatch(self, statements):
+        """
+        Summary:
+            Sends several dependent statements to the database in a single round trip, inside the current
+            transaction, instead of waiting for the result of each one. Only the result of the last
+            statement can be fetched, and a failing statement aborts the ones after it.
+
+        Params:
+            statements: a list of (query, vars) pairs.
+        """
+        batch = b";\n".join(self.mogrify(query, vars) for query, vars in statements)
+        stats = currentQueryStats()
+        attributes = {'db.system': 'postgresql', 'db.statement': _statementSummary(batch)} if isTracing() else None
+        start = time.perf_counter()
+        error = None
+        try:
+            with span('db.batch', attributes, SPAN_KIND_CLIENT):
+                result = super().execute(self._limited(batch))
+        except psycopg2.Error as e:
+            error = e
+            _recordFailure(self.connection, e)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            if stats is not None:
+                #The statements share the round trip and its time
+                for index, (query, vars) in enumerate(statements):
+                    rows = self.rowcount if index == len(statements) - 1 and self.rowcount > 0 else 0
+                    stats.recordQuery(query, duration / len(statements), rows, int(index == 0))
+            slowQueryLog.observe(self, batch, None, duration, error)
+        _recordSuccess(self.connection)
+        return result
+
+    def _fetch(self, fetch, *args):
+        stats = currentQueryStats()
+        if stats is None or self.name is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        try:
+            result = fetch(*args)
+        except psycopg2.Error as e:
+            _recordFailure(self.connection, e)
+            raise
+        rows = len(result) if isinstance(result, list) else int(result is not None)
+        stats.recordRoundTrip(time.perf_counter() - start, rows)
+        return result
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size = None):
+        return self._fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __iter__(self):
+        if self.name is None:
+            return super().__iter__()
+        return self._iterateServerSide()
+
+    def _iterateServerSide(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+
+class AccountingConnection(psycopg2.extensions.connection):
+    """
+    Connection that records its opening and transaction ends and hands out AccountingCursors.
+
+    While it belongs to a unit of work, the commits and closes of the DAOs are deferred to the end of
+    the request and their rollbacks make the whole unit roll back.
+    """
+
+    unitOfWork = None
+
+    #Cursors opened while the connection belongs to a unit of work, with the stacks that opened them
+    openCursors = None
+
+    #Circuit breaker of the database, told the outcome of every statement
+    breaker = None
+
+    #Pooled connections keep an LRU of the statements they prepared, from query text to the EXECUTE
+    #statement and name of each prepared statement
+    pooled = False
+    preparedStatements = None
+
+    def __init__(self, *args, **kwargs):
+        start = time.perf_counter()
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = AccountingCursor
+        liveConnections.add(self)
+        _trackResource(self)
+        stats = currentQueryStats()
+        if stats is not None:
+            stats.connections += 1
+            stats.connectTime += time.perf_counter() - start
+
+    def _timed(self, operation):
+        stats = currentQueryStats()
+        if stats is None:
+            return operation()
+        start = time.perf_counter()
+        try:
+            return operation()
+        finally:
+            stats.recordRoundTrip(time.perf_counter() - start)
+
+    def commit(self):
+        if self.unitOfWork is not None:
+            return None
+        return self._timed(super().commit)
+
+    def rollback(self):
+        if self.unitOfWork is not None:
+            self.unitOfWork.failed = True
+        return self._timed(super().rollback)
+
+    def close(self):
+        if self.unitOfWork is not None:
+            return None
+        return super().close()
+
+    def release(self, commit):
+        """
+        Summary:
+            Ends the transaction of the unit of work the connection belongs to and detaches it from the unit.
+
+        Params:
+            commit: whether the transaction is committed or rolled back.
+
+        Returns:
+            The cursors the DAOs left open, with the stacks that opened them, closed before ending the transaction.
+        """
+        leaked = [(cursor, stack) for cursor, stack in self.openCursors or () if not cursor.closed]
+        self.unitOfWork, self.openCursors = None, None
+        for cursor, stack in leaked:
+            cursor.close()
+        if commit:
+            self.commit()
+        else:
+            self.rollback()
+        return leaked
+
+    def setStatementTimeout(self, timeout):
+        """
+        Summary:
+            Sets the statement_timeout of the current transaction, or of the session with autocommit, in a
+            round trip not counted as a statement of the request, so it does not use up the query budgets.
+        """
+        cursor = psycopg2.extensions.cursor(self)
+        try:
+            self._timed(lambda: cursor.execute("select set_config('statement_timeout', %s, %s)", (str(timeout), not self.autocommit)))
+        finally:
+            cursor.close()
+
+    def enablePreparedStatements(self):
+        """
+        Summary:
+            Marks the connection as pooled, so it outlives the DAOs using it and keeps prepared statements.
+        """
+        self.pooled = True
+        self.preparedStatements = collections.OrderedDict()
+        self.preparedCount = 0
+
+    def prepare(self, query):
+        """
+        Summary:
+            Returns the EXECUTE statement of the prepared statement of the query, preparing it first if it
+            is not cached and deallocating the least recently used one if the cache is full.
+        """
+        cached = self.preparedStatements.get(query)
+        if cached is not None:
+            self.preparedStatements.move_to_end(query)
+            return cached[0]
+
+        text, parameters = _numberPlaceholders(query)
+        name = 'dao_statement_{}'.format(self.preparedCount)
+        self.preparedCount += 1
+        cursor = psycopg2.extensions.cursor(self)
+        try:
+            if len(self.preparedStatements) >= PREPARED_STATEMENT_CACHE_SIZE:
+                #Evicted only once deallocated, so a failed DEALLOCATE is retried instead of orphaning the statement
+                evicted = next(iter(self.preparedStatements))
+                self._timed(lambda: cursor.execute('deallocate ' + self.preparedStatements[evicted][1]))
+                del self.preparedStatements[evicted]
+            self._timed(lambda: cursor.execute('prepare {} as {}'.format(name, text)))
+        finally:
+            cursor.close()
+
+        statement = 'execute ' + name
+        if parameters:
+            statement += ' ({})'.format(', '.join(['%s'] * parameters))
+        self.preparedStatements[query] = (statement, name)
+        return statement
+
+
+def remainingTimeBudget():
+    """
+    Summary:
+        Returns the milliseconds left of the database time budget of the current request, 0 or less once
+        it is used up, or None outside of a request or when the budget is disabled.
+    """
+    deadline = g.get('timeBudgetDeadline') if has_request_context() else None
+    if deadline is None:
+        return None
+    return int((deadline - time.perf_counter()) * 1000)
+
+
+def connect(dsn):
+    """
+    Summary:
+        Opens a database connection whose work is accounted to the current request. Inside a request with a unit of work, returns the connection the unit of work shares
+        between its DAOs instead. Read-only requests connect to the replica chosen for them.
+
+        Raises CircuitOpenError at once while the circuit breaker of the database is open.
+    """
+    dsn = replicaRouter.route(dsn)
+    breaker = circuitBreaker(dsn)
+    breaker.allow()
+    unitOfWork = g.get('unitOfWork') if has_request_context() else None
+    try:
+        if unitOfWork is not None:
+            connection = unitOfWork.connection(dsn)
+        else:
+            connection = psycopg2.connect(dsn, connection_factory = AccountingConnection, connect_timeout = CONNECT_TIMEOUT)
+    except psycopg2.pool.PoolError:
+        #Every pooled connection being in use is an overload of the app, not a failure of the database
+        raise
+    except psycopg2.OperationalError:
+        breaker.recordFailure()
+        raise
+    connection.breaker = breaker
+    return connection
+
+
+def liveObjectCounts():
+    """
+    Summary:
+        Returns the amount of DAO connections and cursors still referenced, open and closed.
+    """
+    connections = list(liveConnections)
+    cursors = list(liveCursors)
+    openConnections = sum(1 for connection in connections if not connection.closed)
+    openCursors = sum(1 for cursor in cursors if not cursor.closed)
+    return {
+        'connections_open': openConnections,
+        'connections_closed': len(connections) - openConnections,
+        'cursors_open': openCursors,
+        'cursors_closed': len(cursors) - openCursors,
+    }
+
+
+def queryBudget(limit):
+    """
+    Summary:
+        Declares the maximum amount of statements a route may execute per request. Requests over the
+        budget fail while testing and are logged otherwise.
+    """
+    def decorator(func):
+        func.queryBudget = limit
+        return func
+    return decorator
+
+
+def timeBudget(milliseconds):
+    """
+    Summary:
+        Declares the maximum time the statements of a route may take altogether per request, enforced
+        with statement_timeout. None disables the limit.
+    """
+    def decorator(func):
+        func.timeBudget = milliseconds
+        return func
+    return decorator
+
+
+def registerQueryAccounting(app):
+    """
+    Summary:
+        Installs the hooks that report the database work of every request of the app and enforce their
+        database time budgets.
+    """
+    enforce = bool(os.getenv('QUERY_BUDGET_ENFORCE'))
+
+    @app.before_request
+    def startTimeBudget():
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'timeBudget', DEFAULT_TIME_BUDGET)
+        if budget:
+            g.timeBudgetDeadline = time.perf_counter() + budget / 1000
+
+    @app.after_request
+    def reportQueryStats(response):
+        if g.pop('statementTimedOut', False):
+            app.logger.warning("%s %s canceled a statement over its database time budget", request.method, request.path)
+            response = jsonify(Error = "La base de datos tardó demasiado en responder, intente nuevamente.")
+            response.status_code = 503
+            response.headers['Retry-After'] = str(TIMEOUT_RETRY_AFTER)
+
+        stats = g.get('queryStats')
+        if stats is None:
+            return response
+
+        response.headers.add('Server-Timing', 'db;dur={:.3f};desc="{} queries, {} round trips, {} rows"'.format(
+            stats.duration * 1000, stats.queries, stats.roundTrips, stats.rows))
+        response.headers.add('Server-Timing', 'dbconnect;dur={:.3f};desc="{} connections"'.format(
+            stats.connectTime * 1000, stats.connections))
+
+        app.logger.debug("%s %s: %d connections, %d queries, %d round trips, %d rows, %.3f ms in the database",
+            request.method, request.path, stats.connections, stats.queries, stats.roundTrips, stats.rows,
+            (stats.duration + stats.connectTime) * 1000)
+
+        for statement, count in stats.statements.items():
+            if count >= N_PLUS_ONE_THRESHOLD:
+                app.logger.warning("Possible N+1 queries in %s %s, statement executed %d times: %s",
+                    request.method, request.path, count, ' '.join(statement.split())[:200])
+
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'queryBudget', None)
+        if budget is not None and stats.queries > budget:
+            message = "{} {} executed {} queries over its budget of {}".format(request.method, request.path, stats.queries, budget)
+            if app.testing or enforce:
+                raise AssertionError(message)
+            app.logger.warning(message)
+
+        return response
+
+    @app.teardown_request
+    def closeLeakedResources(exception):
+        resources = g.pop('openResources', None)
+        if not resources:
+            return
+
+        #The cursors of units of work were already reported when their unit ended
+        for resource, stack in resources:
+            if not isinstance(resource, psycopg2.extensions.cursor) or resource.closed or resource.connection.closed:
+                continue
+            app.logger.warning("Cursor leaked by %s %s, closing it. Opened at:\n%s", request.method, request.path, formatStack(stack))
+            try:
+                resource.close()
+            except psycopg2.Error:
+                app.logger.exception("Error closing a leaked cursor")
+
+        for resource, stack in resources:
+            #Connections of a unit of work or a pool are closed by them
+            if (not isinstance(resource, psycopg2.extensions.connection) or resource.closed
+                    or resource.unitOfWork is not None or resource.pooled):
+                continue
+            app.logger.warning("Connection leaked by %s %s, closing it. Opened at:\n%s", request.method, request.path, formatStack(stack))
+            try:
+                resource.close()
+            except psycopg2.Error:
+                app.logger.exception("Error closing a leaked connection")
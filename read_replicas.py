@@ -0,0 +1,244 @@
+"""
+Routing of the read-only routes to the read replicas of the database.
+
+The DAO connections of the routes marked with readReplica() are opened on one of the replicas listed
+in DB_REPLICAS, comma separated host or host:port entries sharing the database, user and password of
+the primary. Every other route, and every statement run outside of a request, stays on the primary.
+All the DAOs of a request use the same replica, so the request reads a single consistent database.
+
+A background thread checks every REPLICA_CHECK_INTERVAL seconds, 5 by default, that each replica is
+reachable, streaming from the primary and no more than REPLICA_MAX_LAG seconds, 10 by default, behind
+it. Requests are spread over the healthy replicas whose circuit breaker is closed, and stay on the
+primary when there is none. The asynchronous app in asgi.py keeps an asyncpg pool per replica and
+spreads its reads with the same router and health checks.
+
+Clients read their own writes: requests sent with an Authorization header, as the dashboard users
+that edit the data send them, always read from the primary, and a request that changed data sets a
+cookie keeping the reads of the client on the primary until the replicas had time to replay the change.
+
+To try it with two local Postgres instances, clone the primary into a streaming replica on port 5433:
+    pg_basebackup -D replica -R -h localhost -U <user>
+    pg_ctl -D replica -o "-p 5433" start
+and run the app with DB_REPLICAS=localhost:5433.
+"""
+import logging
+import os
+import random
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+from flask import g, has_request_context, request
+from .circuit_breaker import circuitBreaker
+
+logger = logging.getLogger(__name__)
+
+#Cookie holding until when the reads of a client that wrote stay on the primary
+PRIMARY_COOKIE = 'db_primary_until'
+
+#Replication lag of a replica in seconds, 0 once it replayed everything it received
+LAG_QUERY = """select pg_is_in_recovery(),
+                      exists (select 1 from pg_stat_wal_receiver where status = 'streaming'),
+                      case when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+                           else extract(epoch from now() - pg_last_xact_replay_timestamp()) end
+            """
+
+
+class Replica:
+    """
+    Health of one read replica, as seen by its last check.
+    """
+
+    def __init__(self, host, port = None):
+        self.host = host
+        self.port = port
+        self.healthy = False
+        self.lag = None
+        self.error = None
+        self.checkConnection = None
+
+    def dsn(self, primaryDsn):
+        """
+        Summary:
+            Returns the connection string of the replica, with the credentials of the given primary one.
+        """
+        if self.port is None:
+            return psycopg2.extensions.make_dsn(primaryDsn, host = self.host)
+        return psycopg2.extensions.make_dsn(primaryDsn, host = self.host, port = self.port)
+
+    def check(self, primaryDsn, maxLag):
+        """
+        Summary:
+            Measures the replication lag of the replica and updates whether it can serve reads.
+        """
+        try:
+            if self.checkConnection is None or self.checkConnection.closed:
+                self.checkConnection = psycopg2.connect(psycopg2.extensions.make_dsn(self.dsn(primaryDsn), connect_timeout = 3))
+                self.checkConnection.autocommit = True
+            cursor = self.checkConnection.cursor()
+            cursor.execute(LAG_QUERY)
+            inRecovery, streaming, lag = cursor.fetchone()
+            cursor.close()
+        except psycopg2.Error as e:
+            if self.checkConnection is not None:
+                self.checkConnection.close()
+            self.healthy, self.lag, self.error = False, None, str(e).strip()
+            return self.healthy
+
+        self.lag = float(lag) if lag is not None else None
+        if not inRecovery:
+            self.error = "The server is not a replica."
+        elif not streaming:
+            self.error = "The replica is not streaming from the primary."
+        elif self.lag is None or self.lag > maxLag:
+            self.error = "The replica is {} seconds behind the primary.".format(self.lag)
+        else:
+            self.error = None
+        self.healthy = self.error is None
+        return self.healthy
+
+    def toDict(self):
+        return {'host': self.host, 'port': self.port, 'healthy': self.healthy, 'lag': self.lag, 'error': self.error}
+
+
+def _parseReplicas(value):
+    replicas = []
+    for entry in (value or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.partition(':')
+        replicas.append(Replica(host, int(port) if port else None))
+    return replicas
+
+
+class ReplicaRouter:
+    """
+    Chooses the database of the DAO connections of each request and keeps the health of the replicas.
+    """
+
+    def __init__(self):
+        self.replicas = _parseReplicas(os.getenv('DB_REPLICAS'))
+        self.maxLag = float(os.getenv('REPLICA_MAX_LAG', '10'))
+        self.interval = float(os.getenv('REPLICA_CHECK_INTERVAL', '5'))
+        self.lock = threading.Lock()
+        self.primaryDsn = None
+        self.thread = None
+        self.pid = None
+
+    @property
+    def stickiness(self):
+        #A change is replayed by every healthy replica after at most this many seconds
+        return self.maxLag + self.interval
+
+    def route(self, dsn):
+        """
+        Summary:
+            Returns the connection string the current request reads the given primary database from, the
+            one of its replica on read-only requests with a healthy replica, otherwise the given one.
+        """
+        if not self.replicas or not has_request_context() or not g.get('readReplica'):
+            return dsn
+        if 'replica' not in g:
+            g.replica = self.choose(dsn)
+        if g.replica is None:
+            return dsn
+        return g.replica.dsn(dsn)
+
+    def choose(self, dsn):
+        """
+        Summary:
+            Returns a random healthy replica of the given primary database whose circuit breaker is closed,
+            or None if there is none.
+        """
+        self.startChecks(dsn)
+        healthy = [replica for replica in self.replicas if replica.healthy and not circuitBreaker(replica.dsn(dsn)).isOpen]
+        return random.choice(healthy) if healthy else None
+
+    def startChecks(self, dsn):
+        """
+        Summary:
+            Starts the thread checking the replicas of the given primary database, unless this process
+            already runs it.
+        """
+        with self.lock:
+            #Threads do not survive the fork of a worker, every process checks on its own
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.primaryDsn = dsn
+            self.pid = os.getpid()
+            for replica in self.replicas:
+                replica.checkConnection = None
+            self.thread = threading.Thread(target = self._run, name = 'replica-health', daemon = True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+    def check(self):
+        """
+        Summary:
+            Checks every replica, logging the ones that stop or start serving reads.
+        """
+        for replica in self.replicas:
+            wasHealthy = replica.healthy
+            if replica.check(self.primaryDsn, self.maxLag) != wasHealthy:
+                if replica.healthy:
+                    logger.info("Replica %s is serving reads again", replica.host)
+                else:
+                    logger.warning("Replica %s stopped serving reads: %s", replica.host, replica.error)
+
+    def status(self):
+        return [replica.toDict() for replica in self.replicas]
+
+
+replicaRouter = ReplicaRouter()
+
+
+def readReplica(func):
+    """
+    Summary:
+        Marks a route as read-only, so its DAOs may read from a replica.
+    """
+    func.readReplica = True
+    return func
+
+
+def readsOwnWrites(headers, cookies):
+    """
+    Summary:
+        Returns whether a request with the given headers and cookies must read from the primary, as it comes
+        from a dashboard user or from a client that changed data a moment ago.
+    """
+    if headers.get('Authorization') is not None:
+        return True
+    try:
+        return float(cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def registerReadReplicas(app):
+    """
+    Summary:
+        Installs the hooks that send the read-only requests of the app to the replicas and keep the reads
+        of the clients that changed data on the primary.
+    """
+    if not replicaRouter.replicas:
+        return
+
+    @app.before_request
+    def chooseDatabase():
+        view = app.view_functions.get(request.endpoint)
+        g.readReplica = (getattr(view, 'readReplica', False) and request.method in ('GET', 'HEAD')
+                         and not readsOwnWrites(request.headers, request.cookies))
+
+    @app.after_request
+    def keepWritersOnPrimary(response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+            until = time.time() + replicaRouter.stickiness
+            response.set_cookie(PRIMARY_COOKIE, '{:.0f}'.format(until), max_age = int(replicaRouter.stickiness) + 1,
+                                httponly = True, samesite = 'Lax')
+        return response
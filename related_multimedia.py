@@ -0,0 +1,195 @@
+"""
+Offline job that precomputes the related multimedia posts shown on each multimedia post page.
+
+Builds TF-IDF vectors for the title and content of every valid multimedia post as a SciPy sparse
+matrix, computes the top N cosine neighbors of every post in batches and stores them in the
+multimedia_related table, so serving them is a single indexed lookup.
+
+Usage:
+    python -m handler.related_multimedia [--top N] [--batch-size B] [--mid MID ...]
+"""
+import argparse
+import re
+import numpy as np
+from scipy import sparse
+from .dao.multimedia_dao import MultimediaDAO
+
+#Words of at least two characters, accents included
+TOKEN_PATTERN = re.compile(r"\w\w+", re.UNICODE)
+
+#Titles are short but descriptive, so their terms count this many times
+TITLE_WEIGHT = 2
+
+DEFAULT_TOP_N = 5
+DEFAULT_BATCH_SIZE = 256
+
+
+def tokenize(text):
+    """
+    Summary:
+        Splits the given text into lowercase word tokens.
+
+    Params:
+        text: the text to tokenize.
+
+    Returns:
+        A list of tokens.
+    """
+    if not text:
+        return []
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def buildTfidfMatrix(documents):
+    """
+    Summary:
+        Builds the L2 normalized TF-IDF matrix of the given documents using sublinear term frequency
+        and smoothed inverse document frequency.
+
+    Params:
+        documents: an iterable of (title, content) tuples.
+
+    Returns:
+        A scipy.sparse CSR matrix with one row per document.
+    """
+    vocabulary = {}
+    indptr = [0]
+    indices = []
+    data = []
+
+    for title, content in documents:
+        counts = {}
+        for token in tokenize(title):
+            index = vocabulary.setdefault(token, len(vocabulary))
+            counts[index] = counts.get(index, 0) + TITLE_WEIGHT
+        for token in tokenize(content):
+            index = vocabulary.setdefault(token, len(vocabulary))
+            counts[index] = counts.get(index, 0) + 1
+        indices.extend(counts.keys())
+        data.extend(counts.values())
+        indptr.append(len(indices))
+
+    documentCount = len(indptr) - 1
+    matrix = sparse.csr_matrix(
+        (np.asarray(data, dtype = np.float32), np.asarray(indices, dtype = np.int32), np.asarray(indptr, dtype = np.int64)),
+        shape = (documentCount, len(vocabulary)))
+
+    #Sublinear term frequency and smoothed inverse document frequency
+    documentFrequency = np.bincount(matrix.indices, minlength = matrix.shape[1])
+    idf = (np.log((1 + documentCount) / (1 + documentFrequency)) + 1).astype(np.float32)
+    matrix.data = 1 + np.log(matrix.data)
+    matrix = matrix @ sparse.diags(idf)
+
+    #Normalize rows so that the dot product of two rows is their cosine similarity
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis = 1)).ravel())
+    norms[norms == 0] = 1
+    matrix = sparse.diags((1 / norms).astype(np.float32)) @ matrix
+
+    return matrix.tocsr()
+
+
+def topNeighbors(matrix, topN = DEFAULT_TOP_N, batchSize = DEFAULT_BATCH_SIZE, rows = None):
+    """
+    Summary:
+        Computes the top N cosine neighbors of the rows of a normalized TF-IDF matrix, multiplying
+        one batch of rows against the whole matrix at a time to bound memory usage.
+
+    Params:
+        matrix: a row normalized scipy.sparse CSR matrix.
+        topN: the amount of neighbors kept for each row.
+        batchSize: the amount of rows compared against the whole matrix at once.
+        rows: optional list of row indexes to compute neighbors for, all rows otherwise.
+
+    Returns:
+        A generator of (row, rank, neighborRow, score) tuples, rank starting at 1.
+    """
+    rowCount = matrix.shape[0]
+    k = min(topN, rowCount - 1)
+    if k < 1:
+        return
+
+    rows = np.arange(rowCount) if rows is None else np.asarray(rows)
+    transposed = matrix.T.tocsc()
+
+    for start in range(0, len(rows), batchSize):
+        batchRows = rows[start:start + batchSize]
+        similarities = (matrix[batchRows] @ transposed).toarray()
+
+        #A post is never related to itself
+        similarities[np.arange(len(batchRows)), batchRows] = -1
+
+        candidates = np.argpartition(-similarities, k - 1, axis = 1)[:, :k]
+        scores = np.take_along_axis(similarities, candidates, axis = 1)
+        order = np.argsort(-scores, axis = 1)
+        candidates = np.take_along_axis(candidates, order, axis = 1)
+        scores = np.take_along_axis(scores, order, axis = 1)
+
+        for i, row in enumerate(batchRows):
+            rank = 1
+            for neighbor, score in zip(candidates[i], scores[i]):
+                if score <= 0:
+                    break
+                yield int(row), rank, int(neighbor), float(score)
+                rank += 1
+
+
+def rebuildRelatedMultimedia(topN = DEFAULT_TOP_N, batchSize = DEFAULT_BATCH_SIZE, mIDs = None):
+    """
+    Summary:
+        Recomputes and stores the related multimedia posts. The TF-IDF model is always built from the
+        whole corpus, but when multimedia post ids are given only their neighbors are recomputed, which
+        is used to incrementally cover newly added, edited or removed posts between full rebuilds. The
+        posts whose stored related posts include a given one and its new neighbors are recomputed too, as
+        their lists change with it. Other posts it now belongs to the list of get it at the next full rebuild.
+
+    Params:
+        topN: the amount of related posts stored for each multimedia post.
+        batchSize: the amount of multimedia posts compared against the corpus at once.
+        mIDs: optional list of multimedia post ids to recompute.
+
+    Returns:
+        The amount of related multimedia rows stored, or an error message string otherwise.
+    """
+    dao = MultimediaDAO()
+
+    try:
+        mids = []
+        documents = []
+        for mid, title, content in dao.getMultimediaCorpus():
+            mids.append(mid)
+            documents.append((title, content))
+
+        matrix = buildTfidfMatrix(documents)
+        del documents
+
+        if mIDs is None:
+            related = ((mids[row], rank, mids[neighbor], score)
+                       for row, rank, neighbor, score in topNeighbors(matrix, topN, batchSize))
+            return dao.replaceRelatedMultimedia(related, None)
+
+        position = {mid: row for row, mid in enumerate(mids)}
+        rows = [position[mid] for mid in mIDs if mid in position]
+        related = [(mids[row], rank, mids[neighbor], score)
+                   for row, rank, neighbor, score in topNeighbors(matrix, topN, batchSize, rows)]
+
+        #Posts listing a changed post, and the ones the changed posts are now similar to
+        affected = dao.getMultimediaRelatedTo(mIDs)
+        if isinstance(affected, str):
+            return affected
+        affected = (set(affected) | {relatedMID for _, _, relatedMID, _ in related}) - set(mIDs)
+        rows = [position[mid] for mid in sorted(affected) if mid in position]
+        related.extend((mids[row], rank, mids[neighbor], score)
+                       for row, rank, neighbor, score in topNeighbors(matrix, topN, batchSize, rows))
+        return dao.replaceRelatedMultimedia(related, list(mIDs) + sorted(affected))
+    finally:
+        dao._closeConnection()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Precomputes the related multimedia posts.")
+    parser.add_argument('--top', type = int, default = DEFAULT_TOP_N, help = "related posts kept per post")
+    parser.add_argument('--batch-size', type = int, default = DEFAULT_BATCH_SIZE, help = "posts compared at once")
+    parser.add_argument('--mid', type = int, nargs = '*', help = "only recompute these multimedia post ids")
+    args = parser.parse_args()
+
+    print(rebuildRelatedMultimedia(args.top, args.batch_size, args.mid))
@@ -0,0 +1,398 @@
+"""
+Load generator that replays a captured JSONL request log against the app.
+
+Each line of the log is a JSON object with the request method, path and capture time, and optionally
+its query string, headers and JSON body:
+
+    {"ts": 1634567890.123, "method": "GET", "path": "/multimedia/12", "query": "", "headers": {}, "body": null}
+
+"ts" may also be an ISO 8601 date. Requests are sent at their original offsets divided by --speed from a
+pool of threads or asyncio workers, and their latency is measured from the time they were due, so a
+saturated server shows up as growing latency instead of a slower sender. With --ramp the log is replayed
+at increasing speeds until the error rate or p99 latency passes its limit, which is reported as the
+saturation point.
+
+Without --url the app is served by a child process, so the server does not share the interpreter lock
+of the load generator.
+
+Usage:
+    python replay_load.py capture.jsonl --speed 1
+    python replay_load.py capture.jsonl --ramp 1,2,4,8,16 --workers 64 --mode asyncio
+    python replay_load.py capture.jsonl --url http://127.0.0.1:8000 --token "Bearer ..."
+"""
+import argparse
+import asyncio
+import datetime
+import http.client
+import json
+import math
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_multimedia import percentile, bypassAuthentication
+
+#Upper bounds in milliseconds of the latency histogram buckets, doubling from 0.25 ms to ~65 s
+HISTOGRAM_BOUNDS = [0.25 * 2 ** exponent for exponent in range(19)]
+
+#Captured headers describing the original connection, set again for the replayed one
+CONNECTION_HEADERS = ('host', 'connection', 'content-length', 'transfer-encoding')
+
+
+def loadRequestLog(path):
+    """
+    Summary:
+        Reads a JSONL request log and returns its requests ordered by capture time, with their offset in
+        seconds from the first request.
+
+    Returns:
+        A list of (offset, method, target, headers, body) tuples.
+    """
+    entries = []
+    with open(path) as log:
+        for line in log:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            ts = entry.get('ts', 0)
+            if isinstance(ts, str):
+                ts = datetime.datetime.fromisoformat(ts.replace('Z', '+00:00')).timestamp()
+            target = entry['path'] + ('?' + entry['query'] if entry.get('query') else '')
+            entries.append((float(ts), entry.get('method', 'GET').upper(), target, entry.get('headers') or {}, entry.get('body')))
+
+    entries.sort(key = lambda entry: entry[0])
+    start = entries[0][0] if entries else 0
+    return [(ts - start, method, target, headers, body) for ts, method, target, headers, body in entries]
+
+
+class RouteNamer:
+    """
+    Maps request paths to the route they hit, using the rules of the app when it is available and
+    replacing numeric path segments otherwise.
+    """
+
+    def __init__(self, app = None):
+        self.adapter = app.url_map.bind('localhost') if app is not None else None
+
+    def __call__(self, method, target):
+        path = urllib.parse.urlsplit(target).path
+        if self.adapter is not None:
+            try:
+                rule, _ = self.adapter.match(path, method = method, return_rule = True)
+                return '{} {}'.format(method, rule.rule)
+            except Exception:
+                return '{} <unmatched>'.format(method)
+        return '{} {}'.format(method, re.sub(r'/\d+(?=/|$)', '/<int>', path))
+
+
+class Collector:
+    """
+    Thread safe accumulator of the latencies and statuses of each route.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, route, latency, status):
+        with self.lock:
+            stats = self.routes.setdefault(route, {'latencies': [], 'errors': 0})
+            stats['latencies'].append(latency)
+            if status >= 500:
+                stats['errors'] += 1
+
+    def summary(self, elapsed):
+        """
+        Summary:
+            Returns the request count, error rate, percentiles and histogram of every route and of all of them.
+        """
+        result = {}
+        allLatencies = []
+        allErrors = 0
+        for route, stats in sorted(self.routes.items()):
+            latencies = sorted(stats['latencies'])
+            allLatencies.extend(latencies)
+            allErrors += stats['errors']
+            result[route] = self._summarize(latencies, stats['errors'], elapsed)
+        result['*'] = self._summarize(sorted(allLatencies), allErrors, elapsed)
+        return result
+
+    def _summarize(self, latencies, errors, elapsed):
+        histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        for latency in latencies:
+            milliseconds = latency * 1000
+            bucket = 0 if milliseconds <= HISTOGRAM_BOUNDS[0] else min(len(HISTOGRAM_BOUNDS), int(math.ceil(math.log2(milliseconds / HISTOGRAM_BOUNDS[0]))))
+            histogram[bucket] += 1
+        return {
+            'requests': len(latencies),
+            'error_rate': round(errors / len(latencies), 4) if latencies else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            'histogram': histogram,
+        }
+
+
+def _prepare(entry, token):
+    offset, method, target, headers, body = entry
+    headers = {name: value for name, value in headers.items() if name.lower() not in CONNECTION_HEADERS}
+    if token:
+        headers['Authorization'] = token
+    payload = None
+    if body is not None:
+        payload = json.dumps(body).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    headers['Content-Length'] = str(len(payload) if payload else 0)
+    return offset, method, target, headers, payload
+
+
+def replayWithThreads(entries, host, port, speed, workers, token, namer):
+    """
+    Summary:
+        Replays the requests at the given speed from a pool of threads, each keeping its own connection.
+    """
+    collector = Collector()
+    local = threading.local()
+
+    def send(entry, due):
+        offset, method, target, headers, payload = entry
+        connection = getattr(local, 'connection', None)
+        if connection is None:
+            connection = local.connection = http.client.HTTPConnection(host, port, timeout = 60)
+        try:
+            connection.request(method, target, body = payload, headers = headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            if response.version == 10 or response.getheader('Connection', '').lower() == 'close':
+                connection.close()
+                local.connection = None
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            local.connection = None
+            status = 599
+        collector.record(namer(method, target), time.perf_counter() - due, status)
+
+    prepared = [_prepare(entry, token) for entry in entries]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        for entry in prepared:
+            due = started + entry[0] / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, entry, due)
+    return collector.summary(time.perf_counter() - started)
+
+
+async def _asyncRequest(host, port, method, target, headers, payload):
+    """
+    Summary:
+        Sends one HTTP/1.1 request over a new connection and returns the response status. The Host and
+        Connection headers are set here, so the given headers must not include them.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        lines = ['{} {} HTTP/1.1'.format(method, target), 'Host: {}:{}'.format(host, port), 'Connection: close']
+        lines.extend('{}: {}'.format(name, value) for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (payload or b''))
+        await writer.drain()
+        statusLine = await reader.readline()
+        status = int(statusLine.split()[1])
+        await reader.read()
+        return status
+    finally:
+        writer.close()
+
+
+def replayWithAsyncio(entries, host, port, speed, workers, token, namer):
+    """
+    Summary:
+        Replays the requests at the given speed from asyncio tasks, with at most the given amount of
+        requests in flight.
+    """
+    collector = Collector()
+    prepared = [_prepare(entry, token) for entry in entries]
+
+    async def run():
+        semaphore = asyncio.Semaphore(workers)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        startedClock = time.perf_counter()
+
+        async def send(entry, due):
+            offset, method, target, headers, payload = entry
+            async with semaphore:
+                try:
+                    status = await asyncio.wait_for(_asyncRequest(host, port, method, target, headers, payload), 60)
+                except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+                    status = 599
+            collector.record(namer(method, target), time.perf_counter() - due, status)
+
+        tasks = []
+        for entry in prepared:
+            delay = started + entry[0] / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(send(entry, startedClock + entry[0] / speed)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - startedClock
+
+    elapsed = asyncio.run(run())
+    return collector.summary(elapsed)
+
+
+def _freePort():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def _waitForServer(port, process, timeout = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("The {} server exited with status {}".format(process.args, process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout = 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit("The server on port {} did not start".format(port))
+
+
+def serve(port, token):
+    """
+    Summary:
+        Serves the app on the given port until killed. Runs in the child process started by startServer.
+    """
+    import main
+    from werkzeug.serving import make_server
+    if not token:
+        bypassAuthentication(main)
+    make_server('127.0.0.1', port, main.app, threaded = True).serve_forever()
+
+
+def startServer(log, token):
+    """
+    Summary:
+        Starts serving the app in a child process, so the server and the load generator do not share the
+        interpreter lock, and waits until it accepts connections.
+
+    Returns:
+        The child process and its port.
+    """
+    port = _freePort()
+    command = [sys.executable, __file__, log, '--serve', '--port', str(port)] + (['--token', token] if token else [])
+    process = subprocess.Popen(command)
+    try:
+        _waitForServer(port, process)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    return process, port
+
+
+def findSaturation(entries, host, port, speeds, args, namer):
+    """
+    Summary:
+        Replays the log at each speed until the overall error rate or p99 latency passes its limit, or the
+        achieved throughput falls behind the offered one.
+
+    Returns:
+        A (results, saturationSpeed) tuple, saturationSpeed being None when every speed was sustained.
+    """
+    replay = replayWithAsyncio if args.mode == 'asyncio' else replayWithThreads
+    duration = max(entries[-1][0], 1e-3)
+    results = {}
+
+    for speed in speeds:
+        summary = replay(entries, host, port, speed, args.workers, args.token, namer)
+        results[speed] = summary
+        overall = summary['*']
+        offered = len(entries) / (duration / speed)
+        print("speed x{:<6} offered {:>9.1f} req/s  achieved {:>9.1f} req/s  p99 {:>10} ms  errors {:.2%}".format(
+            speed, offered, overall['rps'], overall['p99_ms'], overall['error_rate']))
+        if overall['error_rate'] > args.max_error_rate or overall['p99_ms'] > args.max_p99_ms or overall['rps'] < 0.9 * offered:
+            return results, speed
+
+    return results, None
+
+
+def printSummary(summary):
+    print("{:<60} {:>8} {:>8} {:>10} {:>10} {:>10}".format('route', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for route, stats in summary.items():
+        print("{:<60} {:>8} {:>8.2%} {:>10} {:>10} {:>10}".format(
+            route, stats['requests'], stats['error_rate'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+        populated = [(bound, count) for bound, count in zip(HISTOGRAM_BOUNDS + [float('inf')], stats['histogram']) if count]
+        widest = max((count for _, count in populated), default = 1)
+        for bound, count in populated:
+            print("    <= {:>10} ms {:>8} {}".format(bound, count, '#' * max(1, int(40 * count / widest))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Replays a JSONL request log against the app.")
+    parser.add_argument('log', help = "JSONL request log")
+    parser.add_argument('--url', help = "replay against a running server instead of an in process one")
+    parser.add_argument('--speed', type = float, default = 1.0, help = "replay speed multiplier of the original timing")
+    parser.add_argument('--ramp', help = "comma separated speeds to search for the saturation point")
+    parser.add_argument('--mode', choices = ('threads', 'asyncio'), default = 'threads')
+    parser.add_argument('--workers', type = int, default = 32, help = "threads, or requests in flight with asyncio")
+    parser.add_argument('--token', help = "Authorization header value replacing the captured one")
+    parser.add_argument('--max-error-rate', type = float, default = 0.01)
+    parser.add_argument('--max-p99-ms', type = float, default = 1000.0)
+    parser.add_argument('--output', help = "write the results to this JSON file")
+    parser.add_argument('--serve', action = 'store_true', help = argparse.SUPPRESS)
+    parser.add_argument('--port', type = int, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.token)
+        sys.exit(0)
+
+    entries = loadRequestLog(args.log)
+    if not entries:
+        parser.error("the request log is empty")
+
+    app = None
+    server = None
+    if args.url:
+        parsed = urllib.parse.urlparse(args.url)
+        host, port = parsed.hostname, parsed.port or 80
+    else:
+        #Only the routes of the app are used here, to name the requests
+        import main
+        app = main.app
+        server, port = startServer(args.log, args.token)
+        host = '127.0.0.1'
+
+    namer = RouteNamer(app)
+
+    if args.ramp:
+        speeds = [float(speed) for speed in args.ramp.split(',')]
+        results, saturation = findSaturation(entries, host, port, speeds, args, namer)
+        last = results[max(results)]
+        printSummary(last)
+        print("saturation point: {}".format('x{}'.format(saturation) if saturation else 'not reached'))
+        output = {'speeds': {str(speed): summary for speed, summary in results.items()}, 'saturation_speed': saturation}
+    else:
+        replay = replayWithAsyncio if args.mode == 'asyncio' else replayWithThreads
+        summary = replay(entries, host, port, args.speed, args.workers, args.token, namer)
+        printSummary(summary)
+        output = summary
+
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(output, outputFile, indent = 2)
+
+    if server is not None:
+        server.kill()
+        server.wait()
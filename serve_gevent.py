@@ -0,0 +1,73 @@
+"""
+Cooperative gevent serving mode of the app.
+
+Every request runs in a greenlet instead of a thread. The standard library is monkey patched before the
+app is imported, so the locks, thread locals and background threads of the app and its caches (the
+session store, the near-duplicate index, the metrics, the log queue) become greenlet-aware. psycopg2
+waits for the database through gevent's sockets with a wait callback, so a greenlet blocked on a query
+lets the others run.
+
+Set DB_POOL_MAX so the greenlets share a bounded amount of database connections: without it, every
+request in flight opens its own connection. It also sizes the admission limits of the load shedding,
+which otherwise stay at those of a threaded server; set ADMISSION_LIMIT_PUBLIC, ADMISSION_LIMIT_READ
+and ADMISSION_LIMIT_WRITE to override them.
+
+Usage:
+    DB_POOL_MAX=50 python serve_gevent.py --port 5000 --connections 2000
+
+or under gunicorn, whose gevent worker patches the standard library itself:
+    DB_POOL_MAX=50 gunicorn -k gevent --worker-connections 2000 serve_gevent:app
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import psycopg2
+import psycopg2.extensions
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from gevent.socket import wait_read, wait_write
+
+
+def waitCallback(connection, timeout = None):
+    """
+    Summary:
+        psycopg2 wait callback that yields to the other greenlets while the connection waits on the database.
+    """
+    while True:
+        state = connection.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout = timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout = timeout)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: {}".format(state))
+
+
+def installWaitCallback():
+    """
+    Summary:
+        Makes every psycopg2 connection of the process cooperative. Server side COPY is not supported
+        while the callback is installed.
+    """
+    psycopg2.extensions.set_wait_callback(waitCallback)
+
+
+installWaitCallback()
+
+from main import app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Serves the app with gevent.")
+    parser.add_argument('--host', default = '0.0.0.0')
+    parser.add_argument('--port', type = int, default = 5000)
+    parser.add_argument('--connections', type = int, default = 1000,
+                        help = "maximum amount of client connections handled at once")
+    args = parser.parse_args()
+
+    #The access log would be one more synchronous write per request, the metrics cover it
+    server = WSGIServer((args.host, args.port), app, spawn = Pool(args.connections), log = None)
+    server.serve_forever()
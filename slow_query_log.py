@@ -0,0 +1,156 @@
+"""
+Slow query log of the DAO statements.
+
+Statements executed through the accounting cursors that take longer than SLOW_QUERY_THRESHOLD_MS are
+written as JSON lines to a rotating local file, with their parameters, the DAO method that ran them and,
+for a sampled fraction of the select statements, their plan. Statements that failed or were canceled by
+statement_timeout are logged too, with their error and without a plan.
+
+The plan is a plain EXPLAIN, which does not run the statement. Only the statements of the read-only DAO
+methods in ANALYZE_METHODS, and the ones added with SLOW_QUERY_ANALYZE_METHODS, are run a second time
+under EXPLAIN (ANALYZE, BUFFERS) for their actual row counts and timings: a select can have side
+effects, as the ones calling create_multimedia_partitions().
+
+Configuration:
+    SLOW_QUERY_THRESHOLD_MS: minimum duration of a logged statement, 200 by default.
+    SLOW_QUERY_SAMPLE_RATE: fraction of the slow statements logged, 1 by default.
+    SLOW_QUERY_EXPLAIN_RATE: fraction of the logged select statements explained, 0 by default.
+    SLOW_QUERY_ANALYZE_METHODS: comma separated DAO methods, as MultimediaDAO.getAllMultimedia, whose
+        statements are also explained with ANALYZE.
+    SLOW_QUERY_LOG: path of the log file, slow_queries.log by default.
+"""
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import random
+import sys
+import psycopg2.extensions
+
+#Longest logged representation of a single statement parameter, contents can be 63 KB long
+MAX_PARAMETER_LENGTH = 200
+
+#Read-only DAO methods whose statements are safe to run again under EXPLAIN ANALYZE
+ANALYZE_METHODS = frozenset((
+    'MultimediaDAO.getAllMultimedia',
+    'MultimediaDAO.getMultimediaByID',
+    'MultimediaDAO.getMultimediaByType',
+    'MultimediaDAO.getMultimediaByMonth',
+    'MultimediaDAO.getMultimediaByAuthor',
+    'MultimediaDAO.getRelatedMultimedia',
+    'MultimediaDAO.getLatestMultimediaVersion',
+    'MultimediaDAO.getMultimediaVersionChain',
+    'MultimediaDAO.multimediaExists',
+))
+
+
+class SlowQueryLog:
+
+    def __init__(self):
+        self.threshold = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '200')) / 1000
+        self.sampleRate = float(os.getenv('SLOW_QUERY_SAMPLE_RATE', '1'))
+        self.explainRate = float(os.getenv('SLOW_QUERY_EXPLAIN_RATE', '0'))
+        self.path = os.getenv('SLOW_QUERY_LOG', 'slow_queries.log')
+        self.analyzeMethods = ANALYZE_METHODS | {method.strip() for method in os.getenv('SLOW_QUERY_ANALYZE_METHODS', '').split(',') if method.strip()}
+        self.logger = None
+
+    def _getLogger(self):
+        #The file is only opened once the first slow statement shows up
+        if self.logger is None:
+            logger = logging.getLogger('slow_queries')
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            if not logger.handlers:
+                logger.addHandler(logging.handlers.RotatingFileHandler(self.path, maxBytes = 10 * 1024 * 1024, backupCount = 5))
+            self.logger = logger
+        return self.logger
+
+    def observe(self, cursor, query, vars, duration, error = None):
+        """
+        Summary:
+            Logs the statement if it was slower than the threshold and is sampled.
+
+        Params:
+            cursor: the cursor that executed the statement.
+            query: the statement.
+            vars: the parameters of the statement.
+            duration: the execution time of the statement in seconds.
+            error: the exception the statement failed with, if it failed.
+        """
+        if duration < self.threshold or random.random() >= self.sampleRate:
+            return
+
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        query = str(query)
+
+        caller = _findCaller()
+        entry = {
+            'time': datetime.datetime.now().isoformat(),
+            'duration_ms': round(duration * 1000, 3),
+            'caller': caller,
+            'query': ' '.join(query.split()),
+            'parameters': _summarizeParameters(vars),
+        }
+
+        if error is not None:
+            #The transaction of a failed statement is aborted, it cannot be explained
+            entry['error'] = '{}: {}'.format(type(error).__name__, str(error).strip())
+        elif self.explainRate and query.lstrip().lower().startswith('select') and random.random() < self.explainRate:
+            entry['plan'] = _explain(cursor, query, vars, caller in self.analyzeMethods)
+
+        self._getLogger().info(json.dumps(entry, default = str))
+
+
+def _findCaller():
+    """
+    Summary:
+        Returns the DAO class and method that executed the statement, e.g. MultimediaDAO.getMultimediaByType.
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        instance = frame.f_locals.get('self')
+        if instance is not None and type(instance).__name__.endswith('DAO'):
+            return '{}.{}'.format(type(instance).__name__, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def _summarizeParameters(vars):
+    if vars is None:
+        return None
+    values = vars.values() if isinstance(vars, dict) else vars
+    return [value if isinstance(value, (int, float, bool)) or value is None else repr(value)[:MAX_PARAMETER_LENGTH]
+            for value in values]
+
+
+def _explain(cursor, query, vars, analyze):
+    """
+    Summary:
+        Explains the statement on the same connection and returns its plan. With analyze, the statement is
+        run again under EXPLAIN (ANALYZE, BUFFERS).
+    """
+    connection = cursor.connection
+    #A failed explain must not abort the transaction of the DAO
+    savepoint = not connection.autocommit
+    explainCursor = psycopg2.extensions.cursor(connection)
+    try:
+        if savepoint:
+            explainCursor.execute('savepoint slow_query_explain')
+        options = 'analyze, buffers, format json' if analyze else 'format json'
+        explainCursor.execute('explain ({}) '.format(options) + query, vars)
+        plan = explainCursor.fetchone()[0]
+        if savepoint:
+            explainCursor.execute('release savepoint slow_query_explain')
+        return plan
+    except psycopg2.Error as e:
+        if savepoint:
+            explainCursor.execute('rollback to savepoint slow_query_explain')
+        return 'explain failed: {}'.format(e)
+    finally:
+        explainCursor.close()
+
+
+#Log shared by every DAO connection of this process
+slowQueryLog = SlowQueryLog()
@@ -12,4 +12,8 @@ export default() =>({
      * List of all multimedia posts.
      */
     multimedias: [],//Used in in the all multimedia posts viewer page.
+    /**
+     * List of the related multimedia posts of the loaded multimedia post.
+     */
+    relatedMultimedias: [],//Used in the single multimedia post viewer page.
 })
\ No newline at end of file
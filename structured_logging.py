@@ -0,0 +1,173 @@
+"""
+Structured, non-blocking logging of the app.
+
+configureLogging() routes every logger of the process through a queue: the request thread only builds
+the record and enqueues it, and a listener thread formats it as one JSON line and writes it to stdout.
+Records emitted while handling a request carry its request id, taken from the X-Request-ID header or
+generated, which is also returned in the X-Request-ID header of the response. Errors repeated from the
+same place are rate limited, and the next one let through reports how many were suppressed.
+
+Handlers and DAOs only use the standard logging module through logging.getLogger(__name__).
+
+Configuration:
+    LOG_LEVEL: minimum level of the logged records, INFO by default.
+    LOG_QUEUE_SIZE: records waiting to be written before new ones are dropped, 10000 by default.
+    LOG_ERROR_BURST: errors logged from the same place per window, 5 by default.
+    LOG_ERROR_WINDOW: length in seconds of the rate limiting window, 60 by default.
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+#Attributes every LogRecord has, anything else was passed through extra and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'requestId', 'method', 'path', 'suppressed'}
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Adds the id, method and path of the current request to the records emitted while handling it.
+    """
+
+    def filter(self, record):
+        if has_request_context():
+            record.requestId = g.get('requestId')
+            record.method = request.method
+            record.path = request.path
+        return True
+
+
+class ErrorRateLimitFilter(logging.Filter):
+    """
+    Lets through at most burst errors from the same logger and line per window.
+    """
+
+    def __init__(self, burst, window):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def filter(self, record):
+        if record.levelno < logging.ERROR:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None or now - counter[0] >= self.window:
+                #A new window starts, reporting the errors suppressed in the previous one
+                suppressed = counter[2] if counter is not None else 0
+                counter = self.counters[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if counter[1] >= self.burst:
+                counter[2] += 1
+                return False
+            counter[1] += 1
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records instead of blocking or failing when the queue is full.
+    """
+
+    def __init__(self, logQueue):
+        super().__init__(logQueue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        #The traceback is formatted here since the exception and its frames cannot outlive the request
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for attribute in ('requestId', 'method', 'path', 'suppressed'):
+            value = getattr(record, attribute, None)
+            if value is not None:
+                entry[attribute] = value
+        for attribute, value in vars(record).items():
+            if attribute not in _RECORD_ATTRIBUTES:
+                entry[attribute] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default = str)
+
+
+def configureLogging(app):
+    """
+    Summary:
+        Sends the records of every logger through the non-blocking JSON handler and installs the hooks that
+        assign and return the request ids of the app.
+
+    Returns:
+        The QueueListener writing the records, stopped when the process exits.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+
+    logQueue = queue.Queue(int(os.getenv('LOG_QUEUE_SIZE', '10000')))
+    queueHandler = NonBlockingQueueHandler(logQueue)
+    #Filters run on the request thread, while its context is still available
+    queueHandler.addFilter(RequestContextFilter())
+    queueHandler.addFilter(ErrorRateLimitFilter(int(os.getenv('LOG_ERROR_BURST', '5')), float(os.getenv('LOG_ERROR_WINDOW', '60'))))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queueHandler)
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    #The app logger would otherwise also write every record synchronously to stderr
+    app.logger.removeHandler(default_handler)
+
+    listener = logging.handlers.QueueListener(logQueue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    @app.before_request
+    def assignRequestId():
+        g.requestId = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+
+    @app.after_request
+    def returnRequestId(response):
+        if 'requestId' in g:
+            response.headers[REQUEST_ID_HEADER] = g.requestId
+        return response
+
+    return listener
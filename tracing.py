@@ -0,0 +1,302 @@
+"""
+Lightweight request tracing exported to a local file.
+
+registerTracing() opens a server span for every sampled request and span() opens child spans inside it:
+the token check, the session lookup, the handler methods, every DAO statement and the JSON serialization
+are instrumented. Finished traces are buffered and a background thread appends them every few seconds
+to TRACE_FILE, one OTLP/JSON ExportTraceServiceRequest per line, the format read by the OpenTelemetry
+collector otlpjsonfile receiver.
+
+A request is traced when its traceparent header is sampled, otherwise with probability TRACE_SAMPLE_RATE.
+When TRACE_SLOW_MS is set, every request records its spans and the ones slower than the threshold are
+kept even if they were not sampled, for tail latency investigations.
+
+Configuration:
+    TRACE_SAMPLE_RATE: fraction of the requests traced, 0.01 by default.
+    TRACE_SLOW_MS: duration over which requests are always kept, disabled by default.
+    TRACE_FILE: path of the exported traces, traces.jsonl by default.
+    TRACE_SERVICE_NAME: service.name resource attribute, dashboard-api by default.
+"""
+import atexit
+import functools
+import inspect
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+FLUSH_INTERVAL = 5.0
+#Spans waiting to be written before new traces are dropped
+MAX_BUFFERED_SPANS = 20000
+
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+#Handler helpers called once per record, as mapMultimediaToDict, which would add a span per row
+PER_RECORD_PATTERN = re.compile(r"^map\w*ToDict$")
+
+
+class Span:
+
+    __slots__ = ('name', 'kind', 'spanId', 'parentSpanId', 'start', 'end', 'attributes', 'status', 'statusMessage')
+
+    def __init__(self, name, kind, parentSpanId, attributes):
+        self.name = name
+        self.kind = kind
+        self.spanId = '{:016x}'.format(random.getrandbits(64))
+        self.parentSpanId = parentSpanId
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.status = STATUS_UNSET
+        self.statusMessage = None
+
+    def toDict(self, traceId):
+        span = {
+            'traceId': traceId,
+            'spanId': self.spanId,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': _attributes(self.attributes),
+            'status': {'code': self.status},
+        }
+        if self.parentSpanId:
+            span['parentSpanId'] = self.parentSpanId
+        if self.statusMessage:
+            span['status']['message'] = self.statusMessage
+        return span
+
+
+class Trace:
+    """
+    Spans of one request, with the stack of the spans currently open.
+    """
+
+    def __init__(self, traceId, parentSpanId, sampled):
+        self.traceId = traceId
+        self.sampled = sampled
+        self.spans = []
+        self.stack = [parentSpanId]
+
+    def open(self, name, kind, attributes):
+        span = Span(name, kind, self.stack[-1], attributes)
+        self.spans.append(span)
+        self.stack.append(span.spanId)
+        return span
+
+    def close(self, span):
+        span.end = time.time_ns()
+        self.stack.pop()
+
+
+class TraceExporter:
+    """
+    Buffers finished traces and appends them to the trace file from a background thread.
+    """
+
+    def __init__(self):
+        self.path = os.getenv('TRACE_FILE', 'traces.jsonl')
+        self.serviceName = os.getenv('TRACE_SERVICE_NAME', 'dashboard-api')
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered = 0
+        self.dropped = 0
+        self.thread = None
+
+    def export(self, trace):
+        with self.lock:
+            if self.buffered + len(trace.spans) > MAX_BUFFERED_SPANS:
+                self.dropped += 1
+                return
+            self.buffer.append(trace)
+            self.buffered += len(trace.spans)
+            if self.thread is None:
+                self.thread = threading.Thread(target = self._run, name = 'trace-exporter', daemon = True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            traces, self.buffer, self.buffered = self.buffer, [], 0
+        if not traces:
+            return
+        document = {
+            'resourceSpans': [{
+                'resource': {'attributes': _attributes({'service.name': self.serviceName, 'process.pid': os.getpid()})},
+                'scopeSpans': [{
+                    'scope': {'name': __name__},
+                    'spans': [span.toDict(trace.traceId) for trace in traces for span in trace.spans],
+                }],
+            }],
+        }
+        with open(self.path, 'a') as output:
+            output.write(json.dumps(document, separators = (',', ':')) + '\n')
+
+
+def _attributes(attributes):
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            result.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            result.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            result.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            result.append({'key': key, 'value': {'stringValue': str(value)}})
+    return result
+
+
+def _currentTrace():
+    if not has_request_context():
+        return None
+    return g.get('trace')
+
+
+def isTracing():
+    """
+    Summary:
+        Returns whether the current request is being traced, to skip building the attributes of its spans.
+    """
+    return _currentTrace() is not None
+
+
+@contextmanager
+def span(name, attributes = None, kind = SPAN_KIND_INTERNAL):
+    """
+    Summary:
+        Times the enclosed block as a child of the span currently open in the traced request. Outside of
+        a traced request it does nothing.
+
+    Params:
+        name: name of the span.
+        attributes: dictionary of attributes of the span.
+        kind: OpenTelemetry span kind.
+    """
+    trace = _currentTrace()
+    if trace is None:
+        yield None
+        return
+    current = trace.open(name, kind, attributes or {})
+    try:
+        yield current
+    except BaseException as e:
+        current.status = STATUS_ERROR
+        current.statusMessage = type(e).__name__
+        raise
+    finally:
+        trace.close(current)
+
+
+def traced(name):
+    """
+    Summary:
+        Decorator that runs every call of the function inside a span.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def decorated(*args, **kwargs):
+            if _currentTrace() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def traceMethods(cls, exclude = ()):
+    """
+    Summary:
+        Runs every public method defined by the class inside a span named after the class and method,
+        except the per record mapping helpers and the given method names, so a trace holds one span per
+        handler call and not one per row it returns.
+    """
+    for attribute, value in list(vars(cls).items()):
+        if (inspect.isfunction(value) and not attribute.startswith('_') and attribute not in exclude
+                and not PER_RECORD_PATTERN.match(attribute)):
+            setattr(cls, attribute, traced('{}.{}'.format(cls.__name__, attribute))(value))
+    return cls
+
+
+def registerTracing(app):
+    """
+    Summary:
+        Installs the request hooks that open, close and export the trace of every sampled request of the
+        app and the JSON provider that traces jsonify.
+    """
+    sampleRate = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+    slowThreshold = int(float(os.getenv('TRACE_SLOW_MS', '0')) * 1000000)
+    exporter = TraceExporter()
+
+    jsonProvider = type(app.json)
+
+    class TracingJSONProvider(jsonProvider):
+
+        def response(self, *args, **kwargs):
+            with span('jsonify'):
+                return super().response(*args, **kwargs)
+
+    app.json = TracingJSONProvider(app)
+
+    @app.before_request
+    def startTrace():
+        match = TRACEPARENT_PATTERN.match(request.headers.get('traceparent', ''))
+        if match:
+            traceId, parentSpanId = match.group(1), match.group(2)
+            sampled = bool(int(match.group(3), 16) & 1)
+        else:
+            traceId, parentSpanId = '{:032x}'.format(random.getrandbits(128)), None
+            sampled = random.random() < sampleRate
+        if not sampled and not slowThreshold:
+            return
+
+        trace = g.trace = Trace(traceId, parentSpanId, sampled)
+        rule = request.url_rule
+        g.traceRoot = trace.open('{} {}'.format(request.method, rule.rule if rule is not None else '<unmatched>'),
+            SPAN_KIND_SERVER, {'http.request.method': request.method, 'url.path': request.path})
+
+    @app.after_request
+    def tagTrace(response):
+        trace = g.get('trace')
+        if trace is not None:
+            g.traceRoot.attributes['http.response.status_code'] = response.status_code
+            if response.status_code >= 500:
+                g.traceRoot.status = STATUS_ERROR
+            if trace.sampled:
+                response.headers['traceparent'] = '00-{}-{}-01'.format(trace.traceId, g.traceRoot.spanId)
+        return response
+
+    @app.teardown_request
+    def endTrace(exception):
+        trace = g.get('trace')
+        if trace is None:
+            return
+        root = g.traceRoot
+        if exception is not None:
+            root.status = STATUS_ERROR
+            root.statusMessage = type(exception).__name__
+        #Spans left open by an exception end with the request
+        now = time.time_ns()
+        for openSpan in trace.spans:
+            if openSpan.end is None:
+                openSpan.end = now
+        g.trace = None
+        if trace.sampled or root.end - root.start >= slowThreshold:
+            exporter.export(trace)
@@ -0,0 +1,190 @@
+"""
+Request-scoped unit of work shared by the DAOs.
+
+Once registerUnitOfWork() is installed, every DAO created while handling a request gets the same
+connection from connect(), so a request opens a single connection and all of its statements run in one
+transaction. The commits and closes of the DAOs are deferred: the transaction is committed once before
+the response is sent when the request succeeds, and rolled back when it fails, returns an error status
+or any DAO rolled back. Cursors the DAOs left open on the shared connection are closed and logged with
+the stack that opened them before the transaction ends.
+
+The connections of the units of work come from a per process pool keeping up to DB_POOL_SIZE idle
+connections, 10 by default, so requests skip the connection setup and reuse the statements their
+connection already prepared. Without DB_POOL_MAX the pool never blocks: when it has no idle connection
+a new one is opened. With it, at most DB_POOL_MAX connections are in use at once and requests wait up
+to DB_POOL_TIMEOUT seconds, 30 by default, for one to be released, as needed when thousands of
+greenlets serve requests concurrently.
+"""
+import logging
+import os
+import threading
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from flask import g, has_request_context, jsonify, request
+from .query_accounting import AccountingConnection, CONNECT_TIMEOUT, formatStack
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    Idle connections to one database, reused most recent first.
+    """
+
+    def __init__(self, dsn, size, limit = None, timeout = 30.0):
+        self.dsn = dsn
+        self.size = size
+        self.limit = limit
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(limit) if limit else None
+        self.pid = os.getpid()
+
+    def acquire(self):
+        with self.lock:
+            #Connections inherited from the parent of a forked worker belong to it
+            if self.pid != os.getpid():
+                self.idle, self.pid = [], os.getpid()
+                self.slots = threading.BoundedSemaphore(self.limit) if self.limit else None
+        if self.slots is not None and not self.slots.acquire(timeout = self.timeout):
+            raise psycopg2.pool.PoolError("No database connection was released in {} seconds".format(self.timeout))
+        try:
+            with self.lock:
+                while self.idle:
+                    connection = self.idle.pop()
+                    if not connection.closed:
+                        return connection
+            connection = psycopg2.connect(self.dsn, connection_factory = AccountingConnection, connect_timeout = CONNECT_TIMEOUT)
+            connection.enablePreparedStatements()
+            return connection
+        except BaseException:
+            if self.slots is not None:
+                self.slots.release()
+            raise
+
+    def release(self, connection):
+        """
+        Summary:
+            Returns a connection taken with acquire() to the pool, or closes it if it is broken, in a
+            transaction or the pool already holds enough idle connections.
+        """
+        try:
+            if connection.closed:
+                return
+            if connection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                with self.lock:
+                    if len(self.idle) < self.size and self.pid == os.getpid():
+                        self.idle.append(connection)
+                        return
+            connection.pooled = False
+            connection.close()
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+
+def getPool(dsn):
+    """
+    Summary:
+        Returns the connection pool of the given database, creating it on first use.
+    """
+    with _poolsLock:
+        pool = _pools.get(dsn)
+        if pool is None:
+            limit = os.getenv('DB_POOL_MAX')
+            pool = _pools[dsn] = ConnectionPool(dsn, int(os.getenv('DB_POOL_SIZE', '10')), int(limit) if limit else None,
+                                                float(os.getenv('DB_POOL_TIMEOUT', '30')))
+        return pool
+
+
+def _reportLeakedCursor(stack):
+    where = "{} {}".format(request.method, request.path) if has_request_context() else "a unit of work"
+    logger.warning("Cursor leaked by %s, closing it. Opened at:\n%s", where, formatStack(stack))
+
+
+class UnitOfWork:
+
+    def __init__(self):
+        self.connections = {}
+        self.failed = False
+
+    def connection(self, dsn):
+        """
+        Summary:
+            Returns the shared connection to the given database, taking it from the pool on first use.
+        """
+        connection = self.connections.get(dsn)
+        if connection is None or connection.closed:
+            if connection is not None:
+                #A broken connection gives its slot back before being replaced
+                self.failed = True
+                getPool(dsn).release(connection)
+            connection = self.connections[dsn] = getPool(dsn).acquire()
+            connection.unitOfWork = self
+            connection.openCursors = []
+        return connection
+
+    def end(self, commit):
+        """
+        Summary:
+            Commits or rolls back the transaction of every shared connection and returns them to the pool.
+
+        Params:
+            commit: whether the transaction is committed, it is rolled back anyway if the unit failed.
+        """
+        commit = commit and not self.failed
+        connections, self.connections = list(self.connections.items()), {}
+        error = None
+        for dsn, connection in connections:
+            if not connection.closed:
+                try:
+                    for cursor, stack in connection.release(commit):
+                        _reportLeakedCursor(stack)
+                except psycopg2.Error as e:
+                    #A failed commit rolls back the remaining connections
+                    error = error or e
+                    commit = False
+            getPool(dsn).release(connection)
+        if error is not None:
+            raise error
+
+
+def registerUnitOfWork(app):
+    """
+    Summary:
+        Installs the request hooks that open and end the unit of work of every request of the app. It must
+        be registered after registerQueryAccounting(), so the unit ends before leaked connections are closed.
+    """
+
+    @app.before_request
+    def beginUnitOfWork():
+        g.unitOfWork = UnitOfWork()
+
+    @app.after_request
+    def endUnitOfWork(response):
+        unitOfWork = g.pop('unitOfWork', None)
+        if unitOfWork is None:
+            return response
+        try:
+            unitOfWork.end(response.status_code < 400)
+        except psycopg2.Error:
+            app.logger.exception("Error committing the unit of work")
+            response = jsonify(Error = "Ocurrió un error interno guardando los cambios.")
+            response.status_code = 500
+        return response
+
+    @app.teardown_request
+    def abortUnitOfWork(exception):
+        #Requests ending in an unhandled exception skip the after request hooks
+        unitOfWork = g.pop('unitOfWork', None)
+        if unitOfWork is not None:
+            try:
+                unitOfWork.end(False)
+            except psycopg2.Error:
+                app.logger.exception("Error rolling back the unit of work")